@@ -5,3 +5,4 @@ Astrophysical population models
 from .spatial import *
 from .velocity import *
 from .simulate import *
+from .synthesis import *
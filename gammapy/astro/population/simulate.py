@@ -253,15 +253,18 @@ def make_base_catalog_galactic(n_sources, rad_dis='YK04', vel_dis='H05',
         vel_dis = velocity_distributions[vel_dis]
 
     # Draw r and z values from the given distribution
-    r = Quantity(draw(RMIN.value, RMAX.value, n_sources, pdf(rad_dis())), 'kpc')
-    z = Quantity(draw(ZMIN.value, ZMAX.value, n_sources, Exponential()), 'kpc')
+    r = Quantity(draw(RMIN.value, RMAX.value, n_sources, pdf(rad_dis()),
+                      random_state=random_state), 'kpc')
+    z = Quantity(draw(ZMIN.value, ZMAX.value, n_sources, Exponential(),
+                      random_state=random_state), 'kpc')
 
     # Draw values from velocity distribution
-    v = Quantity(draw(VMIN.value, VMAX.value, n_sources, vel_dis()), 'km/s')
+    v = Quantity(draw(VMIN.value, VMAX.value, n_sources, vel_dis(),
+                      random_state=random_state), 'km/s')
 
     # Apply spiralarm modelling or not
     if spiralarms:
-        r, theta, spiralarm = FaucherSpiral()(r)
+        r, theta, spiralarm = FaucherSpiral()(r, random_state=random_state)
     else:
         theta = Quantity(random_state.uniform(0, 2 * pi, n_sources), 'rad')
         spiralarm = None
@@ -292,7 +295,7 @@ def make_base_catalog_galactic(n_sources, rad_dis='YK04', vel_dis='H05',
     # For now we only simulate shell-type SNRs.
     # Later we might want to simulate certain fractions of object classes
     # index = random_integers(0, 0, n_sources)
-    index = 2 * np.ones(n_sources, dtype=np.int)
+    index = 2 * np.ones(n_sources, dtype=int)
     morph_type = np.array(list(morph_types.keys()))[index]
 
     table = Table()
@@ -357,7 +360,8 @@ def add_pulsar_parameters(table, B_mean=12.05, B_stdv=0.55,
 
     # Draw the initial values for the period and magnetic field
     P_dist = lambda x: exp(-0.5 * ((x - P_mean) / P_stdv) ** 2)
-    P0_birth = Quantity(draw(0, 2, len(table), P_dist), 's')
+    P0_birth = Quantity(draw(0, 2, len(table), P_dist,
+                             random_state=random_state), 's')
     logB = random_state.normal(B_mean, B_stdv, len(table))
 
     # Set up pulsar model
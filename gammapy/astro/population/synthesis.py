@@ -0,0 +1,281 @@
+# Licensed under a 3-clause BSD style license - see LICENSE.rst
+"""Population synthesis for large numbers of sources.
+
+The catalog is simulated in chunks of fixed size. Each chunk has its own
+random number generator, seeded from a master seed, so results are
+reproducible independent of the number of processes and any chunk
+can be re-simulated on its own. Chunks can be written to disk and / or
+reduced to summaries (e.g. logN-logS histograms) as they are produced,
+so the full catalog never has to be held in memory.
+"""
+from __future__ import print_function, division
+import numpy as np
+from astropy.table import vstack
+from ...utils.random import get_random_state
+from .simulate import (make_base_catalog_galactic,
+                       add_snr_parameters,
+                       add_pulsar_parameters,
+                       add_pwn_parameters,
+                       add_observed_parameters,
+                       add_observed_source_parameters,
+                       )
+
+__all__ = ['make_catalog_galactic',
+           'HistogramSummary',
+           'PopulationSynthesis',
+           ]
+
+
+def make_catalog_galactic(n_sources, random_state='random-seed', **kwargs):
+    """Make a catalog of Galactic sources with all parameters.
+
+    Runs `make_base_catalog_galactic` and all ``add_*_parameters`` steps.
+
+    Parameters
+    ----------
+    n_sources : int
+        Number of sources to simulate.
+    random_state : {int, 'random-seed', 'global-rng', `~numpy.random.RandomState`}
+        Defines random number generator initialisation.
+        Passed to `~gammapy.utils.random.get_random_state`.
+    kwargs : dict
+        Passed to `make_base_catalog_galactic`
+
+    Returns
+    -------
+    table : `~astropy.table.Table`
+        Source catalog
+    """
+    random_state = get_random_state(random_state)
+    table = make_base_catalog_galactic(n_sources, random_state=random_state, **kwargs)
+    table = add_snr_parameters(table)
+    table = add_pulsar_parameters(table, random_state=random_state)
+    table = add_pwn_parameters(table)
+    table = add_observed_parameters(table)
+    table = add_observed_source_parameters(table)
+    return table
+
+
+class HistogramSummary(object):
+    """Histogram of a catalog column, summed over chunks.
+
+    Parameters
+    ----------
+    column : str
+        Column name
+    bins : array_like
+        Bin edges, in the unit of the column
+    log : bool
+        Histogram ``log10`` of the column values?
+
+    Examples
+    --------
+    A logN-logS distribution of the PWN fluxes::
+
+        summary = HistogramSummary('S_PWN', bins=np.linspace(-16, -8, 81), log=True)
+        counts = synthesis.run(n_sources=1e7, summaries=dict(logn_logs=summary))['logn_logs']
+        # Number of sources above flux threshold
+        n_above = counts[::-1].cumsum()[::-1]
+    """
+
+    def __init__(self, column, bins, log=False):
+        self.column = column
+        self.bins = np.asarray(bins)
+        self.log = log
+
+    def __call__(self, table):
+        values = np.asarray(table[self.column])
+        if self.log:
+            with np.errstate(divide='ignore', invalid='ignore'):
+                values = np.log10(values)
+        return np.histogram(values, bins=self.bins)[0]
+
+
+def _run_chunk(make_catalog, n_sources, seed, kwargs, filename, summaries,
+               return_table):
+    """Simulate one chunk, write it and compute summaries."""
+    table = make_catalog(n_sources, random_state=np.random.RandomState(seed), **kwargs)
+    table.meta['SEED'] = seed
+
+    if filename is not None:
+        table.write(filename, overwrite=True)
+
+    results = dict((name, summary(table)) for name, summary in summaries.items())
+    if return_table:
+        return table, results
+    else:
+        return None, results
+
+
+def _run_chunk_star(args):
+    return _run_chunk(*args)
+
+
+class PopulationSynthesis(object):
+    """Chunked, parallel population synthesis.
+
+    The catalog of ``n_sources`` sources is simulated in chunks of
+    ``chunk_size`` sources with ``make_catalog``. The random number
+    generator of chunk ``i`` is seeded with ``chunk_seeds(n_chunks)[i]``,
+    which only depends on ``seed``, i.e. the results don't depend on
+    ``parallel`` or ``processes``.
+
+    Parameters
+    ----------
+    make_catalog : callable
+        Function ``make_catalog(n_sources, random_state, **kwargs)``
+        returning a catalog `~astropy.table.Table`.
+        For ``parallel=True`` it must be picklable (defined at module level).
+    chunk_size : int
+        Number of sources per chunk
+    seed : int
+        Master seed for the chunk random number generators
+    parallel : bool
+        Simulate chunks in parallel with a `multiprocessing.Pool`?
+    processes : int, optional
+        Number of processes for ``parallel=True``, default: number of CPUs.
+    kwargs : dict
+        Passed to ``make_catalog``
+
+    Examples
+    --------
+    Simulate 10 million sources, write them in chunk files
+    and compute a histogram of the Galactic latitudes::
+
+        import numpy as np
+        from gammapy.astro.population import PopulationSynthesis, HistogramSummary
+        synthesis = PopulationSynthesis(chunk_size=100000, seed=0, parallel=True)
+        summaries = dict(glat=HistogramSummary('GLAT', bins=np.linspace(-90, 90, 181)))
+        results = synthesis.run(n_sources=int(1e7), filename='catalog_{chunk:04d}.fits',
+                                summaries=summaries)
+    """
+
+    def __init__(self, make_catalog=make_catalog_galactic, chunk_size=100000,
+                 seed=0, parallel=False, processes=None, **kwargs):
+        self.make_catalog = make_catalog
+        self.chunk_size = int(chunk_size)
+        self.seed = seed
+        self.parallel = parallel
+        self.processes = processes
+        self.kwargs = kwargs
+
+    def chunk_seeds(self, n_chunks):
+        """Random seeds of the chunks.
+
+        The first chunk seeds don't change if more chunks are simulated.
+
+        Parameters
+        ----------
+        n_chunks : int
+            Number of chunks
+
+        Returns
+        -------
+        seeds : `~numpy.ndarray`
+            Seeds
+        """
+        random_state = np.random.RandomState(self.seed)
+        return random_state.randint(0, 2 ** 31 - 1, size=n_chunks)
+
+    def iter_chunks(self, n_sources, filename=None, summaries=None,
+                    return_table=True):
+        """Simulate the catalog chunk by chunk.
+
+        Parameters
+        ----------
+        n_sources : int
+            Total number of sources
+        filename : str, optional
+            File name template with a ``{chunk}`` field, e.g.
+            ``'catalog_{chunk:04d}.fits'``. Chunk ``i`` is written to
+            ``filename.format(chunk=i)`` by the process computing it,
+            in the format given by the file extension (e.g. FITS or HDF5).
+        summaries : dict, optional
+            Summary functions ``summary(table)`` by name, e.g.
+            `HistogramSummary` instances.
+        return_table : bool
+            Yield the chunk tables? For ``False``, only ``None`` is yielded
+            instead, i.e. tables are not passed between processes.
+
+        Yields
+        ------
+        table : `~astropy.table.Table` or None
+            Chunk catalog
+        results : dict
+            Chunk summaries by name
+        """
+        n_sources = int(n_sources)
+        summaries = summaries or {}
+        if filename is not None and '{chunk' not in filename:
+            raise ValueError('File name needs a {{chunk}} field: {0}'.format(filename))
+
+        n_chunks = -(-n_sources // self.chunk_size)
+        tasks = []
+        for chunk, seed in enumerate(self.chunk_seeds(n_chunks)):
+            size = min(self.chunk_size, n_sources - chunk * self.chunk_size)
+            chunk_filename = None if filename is None else filename.format(chunk=chunk)
+            tasks.append((self.make_catalog, size, int(seed), self.kwargs,
+                          chunk_filename, summaries, return_table))
+
+        if self.parallel:
+            from multiprocessing import Pool, cpu_count
+            pool = Pool(processes=self.processes or cpu_count())
+            try:
+                for result in pool.imap(_run_chunk_star, tasks):
+                    yield result
+            except BaseException:
+                # Also for GeneratorExit: don't simulate the remaining chunks
+                pool.terminate()
+                raise
+            else:
+                pool.close()
+            finally:
+                pool.join()
+        else:
+            for task in tasks:
+                yield _run_chunk(*task)
+
+    def run(self, n_sources, filename=None, summaries=None):
+        """Simulate the catalog without keeping it in memory.
+
+        Parameters
+        ----------
+        n_sources : int
+            Total number of sources
+        filename : str, optional
+            File name template for the chunk catalogs, see `iter_chunks`.
+        summaries : dict, optional
+            Summary functions ``summary(table)`` by name.
+
+        Returns
+        -------
+        results : dict
+            Summaries by name, summed over the chunks.
+        """
+        summaries = summaries or {}
+        totals = dict((name, 0) for name in summaries)
+        for _, results in self.iter_chunks(n_sources, filename, summaries,
+                                           return_table=False):
+            for name, value in results.items():
+                totals[name] = totals[name] + value
+        return totals
+
+    def make_table(self, n_sources):
+        """Simulate the catalog and return it as one table.
+
+        The result is identical to the chunk catalogs written by `run`.
+
+        Parameters
+        ----------
+        n_sources : int
+            Total number of sources
+
+        Returns
+        -------
+        table : `~astropy.table.Table`
+            Source catalog
+        """
+        tables = [table for table, _ in self.iter_chunks(n_sources)]
+        table = vstack(tables, metadata_conflicts='silent')
+        table.meta.pop('SEED', None)
+        return table
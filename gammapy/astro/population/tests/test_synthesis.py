@@ -0,0 +1,113 @@
+# Licensed under a 3-clause BSD style license - see LICENSE.rst
+from __future__ import print_function, division
+import numpy as np
+from numpy.testing import assert_allclose, assert_equal
+from astropy.table import Table
+from ...population import (make_base_catalog_galactic,
+                           make_catalog_galactic,
+                           add_observed_parameters,
+                           HistogramSummary,
+                           PopulationSynthesis,
+                           )
+
+
+def make_catalog(n_sources, random_state, **kwargs):
+    table = make_base_catalog_galactic(n_sources, random_state=random_state, **kwargs)
+    return add_observed_parameters(table)
+
+
+def test_make_catalog_galactic():
+    table = make_catalog_galactic(n_sources=100, random_state=0, max_age=1e6)
+    assert len(table) == 100
+    for name in ['r_out', 'L_PSR', 'r_out_PWN', 'S_PWN']:
+        assert np.all(np.isfinite(table[name]))
+
+    # Reproducible
+    assert_allclose(make_catalog_galactic(100, random_state=0, max_age=1e6)['S_PWN'],
+                    table['S_PWN'])
+
+
+def test_population_synthesis_default():
+    synthesis = PopulationSynthesis(chunk_size=40, seed=0, max_age=1e6)
+    table = synthesis.make_table(n_sources=50)
+    assert len(table) == 50
+
+    # The first chunk is make_catalog_galactic with the first chunk seed
+    seed = synthesis.chunk_seeds(1)[0]
+    desired = make_catalog_galactic(40, random_state=np.random.RandomState(seed),
+                                    max_age=1e6)
+    assert_allclose(table['r_out_PWN'][:40], desired['r_out_PWN'])
+    assert_allclose(table['S_PWN'][:40], desired['S_PWN'])
+
+
+def test_population_synthesis(tmpdir):
+    synthesis = PopulationSynthesis(make_catalog, chunk_size=40, seed=0,
+                                    max_age=1e6)
+    table = synthesis.make_table(n_sources=100)
+    assert len(table) == 100
+    assert_equal(synthesis.chunk_seeds(2), synthesis.chunk_seeds(3)[:2])
+
+    # Reproducible
+    assert_allclose(synthesis.make_table(n_sources=100)['GLON'], table['GLON'])
+
+    bins = np.linspace(-90, 90, 19)
+    summaries = dict(glat=HistogramSummary('GLAT', bins))
+    filename = str(tmpdir.join('catalog_{chunk}.fits'))
+    results = synthesis.run(n_sources=100, filename=filename, summaries=summaries)
+    assert_equal(results['glat'], np.histogram(table['GLAT'], bins)[0])
+
+    chunk = Table.read(filename.format(chunk=2))
+    assert len(chunk) == 20
+    assert_allclose(chunk['GLAT'], table['GLAT'][80:])
+
+
+def test_population_synthesis_parallel():
+    kwargs = dict(chunk_size=30, seed=1, max_age=1e6)
+    serial = PopulationSynthesis(make_catalog, **kwargs).make_table(n_sources=100)
+    parallel = PopulationSynthesis(make_catalog, parallel=True, processes=2,
+                                   **kwargs).make_table(n_sources=100)
+    assert_allclose(parallel['GLON'], serial['GLON'])
+    assert_allclose(parallel['v_abs'], serial['v_abs'])
+
+
+class _RecordingPool(object):
+    """Pool that records how it is shut down."""
+    calls = []
+
+    def __init__(self, processes=None):
+        from multiprocessing.pool import Pool
+        self._pool = Pool(processes)
+
+    def imap(self, func, iterable):
+        return self._pool.imap(func, iterable)
+
+    def close(self):
+        self.calls.append('close')
+        self._pool.close()
+
+    def terminate(self):
+        self.calls.append('terminate')
+        self._pool.terminate()
+
+    def join(self):
+        self.calls.append('join')
+        self._pool.join()
+
+
+def test_population_synthesis_parallel_stop(monkeypatch):
+    import multiprocessing
+    monkeypatch.setattr(multiprocessing, 'Pool', _RecordingPool)
+    monkeypatch.setattr(_RecordingPool, 'calls', [])
+    synthesis = PopulationSynthesis(make_catalog, chunk_size=10, seed=1,
+                                    parallel=True, processes=2, max_age=1e6)
+
+    # Stopping early terminates the pool instead of running all chunks
+    chunks = synthesis.iter_chunks(n_sources=1000)
+    table, _ = next(chunks)
+    assert len(table) == 10
+    chunks.close()
+    assert _RecordingPool.calls == ['terminate', 'join']
+
+    _RecordingPool.calls[:] = []
+    assert len(list(synthesis.iter_chunks(n_sources=30))) == 3
+    assert _RecordingPool.calls == ['close', 'join']
@@ -90,16 +90,19 @@ class Pulsar(SimplePulsar):
 
     Parameters
     ----------
-    P_0 : float
+    P_0 : `~astropy.units.Quantity`
         Period at birth
-    logB : float
+    logB : float or array_like
         Logarithm of the magnetic field, which is constant
-    n : float
+    n : float or array_like
         Spin-down braking index
     I : float
         Moment of inertia
     R : float
         Radius
+
+    All parameters can be arrays (e.g. one entry per pulsar of a population),
+    the model quantities are then computed for all pulsars at once.
     """
 
     def __init__(self, P_0=Quantity(0.1, 's'), logB=10, n=3, I=DEFAULT_I,
@@ -107,10 +110,10 @@ class Pulsar(SimplePulsar):
         self.I = I
         self.R = R
         self.P_0 = P_0
-        self.logB = logB
+        self.logB = logB = np.asarray(logB, dtype=float)
         self.P_dot_0 = (Quantity(10 ** logB, 'gauss') / B_CONST) ** 2 / P_0
         self.tau_0 = P_0 / (2 * self.P_dot_0)
-        self.n = float(n)
+        self.n = n = np.asarray(n, dtype=float)
         self.beta = (n + 1.) / (n - 1.)
         self.morphology = morphology
         if age is not None:
@@ -118,6 +121,8 @@ class Pulsar(SimplePulsar):
             self.age = age
         if L_0 is None:
             self.L_0 = 4 * np.pi ** 2 * self.I * self.P_dot_0 / self.P_0 ** 3
+        else:
+            self.L_0 = L_0
 
     def luminosity_tev(self, t=None, fraction=0.1):
         """
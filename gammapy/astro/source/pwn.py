@@ -8,10 +8,13 @@ from astropy.units import Quantity
 from astropy.utils import lazyproperty
 import astropy.constants as const
 from ...extern.validator import validate_physical_type
+from ...utils.const import conversion_factor
 from ..source import SNRTrueloveMcKee
 from ..source import Pulsar
 
-__all__ = ['PWN']
+__all__ = ['PWN',
+           'evolve_electron_spectra',
+           ]
 
 
 class PWN(object):
@@ -61,18 +64,23 @@ class PWN(object):
         """
         Time of collision between the PWN and the reverse shock of the SNR.
 
+        The model parameters can be arrays, the collision times of all
+        PWNe are then computed at once with a vectorized bisection.
+
         Returns
         -------
         t_coll : `~astropy.units.Quantity`
             Time of collision.
         """
-        from scipy.optimize import fsolve
-
         def time_coll(t):
             t = Quantity(t, 'yr')
-            return (self._radius_free_expansion(t) - self.snr.radius_reverse_shock(t)).value
-        # 4e3 years is a typical value that works for fsolve
-        return Quantity(fsolve(time_coll, 4e3), 'yr')
+            return (self._radius_free_expansion(t) -
+                    self.snr.radius_reverse_shock(t)).to('cm').value
+
+        # Early on the reverse shock is outside of the PWN, after 10 t_ch
+        # the reverse shock radius formula is negative, i.e. inside.
+        t_c = self.snr.t_c.to('yr').value
+        return Quantity(_bisect(time_coll, 1e-6 * t_c, 10 * t_c), 'yr')
 
     def radius(self, t=None):
         """
@@ -149,6 +157,195 @@ class PWN(object):
         return fraction * self.pulsar.energy_integrated(t)
 
 
+def _bisect(func, lo, hi, n_iter=30):
+    """Vectorized bisection (in ``log(x)``) for positive roots.
+
+    Each element of ``lo`` and ``hi`` brackets one root, which are all
+    found at once, i.e. ``func`` is called with arrays. After ``n_iter``
+    bisection steps the root is linearly interpolated in the final bracket.
+
+    Parameters
+    ----------
+    func : callable
+        Function, ``func(lo)`` and ``func(hi)`` must have opposite signs.
+    lo, hi : `~numpy.ndarray`
+        Positive lower and upper bracket limits
+    n_iter : int
+        Number of bisection steps, the relative width of the final bracket
+        is ``log(hi / lo) / 2 ** n_iter``.
+
+    Returns
+    -------
+    x : `~numpy.ndarray`
+        Roots
+    """
+    lo, hi = np.broadcast_arrays(np.asarray(lo, dtype=float),
+                                 np.asarray(hi, dtype=float))
+    f_lo, f_hi = func(lo), func(hi)
+    for _ in range(n_iter):
+        mid = np.sqrt(lo * hi)
+        f_mid = func(mid)
+        replace_lo = np.sign(f_mid) == np.sign(f_lo)
+        lo, f_lo = np.where(replace_lo, mid, lo), np.where(replace_lo, f_mid, f_lo)
+        hi, f_hi = np.where(replace_lo, hi, mid), np.where(replace_lo, f_hi, f_mid)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        x = lo - f_lo * (hi - lo) / (f_hi - f_lo)
+    return np.where(np.isfinite(x), x, np.sqrt(lo * hi))
+
+
+def evolve_electron_spectra(energy, n, energy_loss_rate, injection=None,
+                            t_start=0, t_stop=1e3, dt=1, method='implicit',
+                            cfl=0.5):
+    """Evolve electron spectra with energy losses and injection.
+
+    Solves the continuity equation
+
+    .. math::
+
+        \\frac{\\partial n}{\\partial t} = \\frac{\\partial (p n)}{\\partial e} + q
+
+    for many spectra at once, e.g. for a population of PWNe.
+    The spectra are stacked along the first axis of ``n``.
+
+    Parameters
+    ----------
+    energy : `~numpy.ndarray`
+        Energy grid (TeV), increasing, shape ``(n_energy,)``
+    n : `~numpy.ndarray`
+        Electron spectra (TeV^-1) at ``t_start``,
+        shape ``(n_energy,)`` or ``(n_spectra, n_energy)``
+    energy_loss_rate : callable
+        Energy loss rate ``p(e, t)`` (TeV s^-1, positive for losses)
+        for energy (TeV) and time (yr). The result must broadcast
+        to the shape of ``n``, i.e. it can differ between the spectra.
+    injection : callable, optional
+        Injection spectrum ``q(e, t)`` (TeV^-1 s^-1), broadcasting to
+        the shape of ``n``. Default: no injection.
+    t_start, t_stop : float
+        Start and stop time (yr)
+    dt : float
+        Time step (yr), adjusted to give an integer number of steps.
+    method : {'implicit', 'explicit'}
+        Time stepping scheme, see Notes.
+    cfl : float
+        Maximum fraction of a bin that electrons may cool in one
+        sub-step of the explicit scheme.
+
+    Returns
+    -------
+    n : `~numpy.ndarray`
+        Electron spectra at ``t_stop``
+
+    Notes
+    -----
+    The ``'implicit'`` scheme is a backward Euler step with upwind
+    differences (electrons only move to lower energies), i.e. for each
+    time step the upper bidiagonal system
+
+    .. math::
+
+        n_i^{k+1} - n_i^k = \\Delta t \\left(\\frac{p_{i+1} n_{i+1}^{k+1}
+        - p_i n_i^{k+1}}{e_{i+1} - e_i} + q_i\\right)
+
+    is solved for all spectra at once with `scipy.linalg.solve_banded`.
+    It is stable and keeps the spectra positive for any time step,
+    which makes it suitable for stiff losses, where the cooling time
+    at high energies is much shorter than the time step.
+    It is first order accurate in time.
+
+    The ``'explicit'`` scheme is a forward Euler scheme with finite
+    differences. Spectra can have sharp cutoffs, i.e. infinite derivative
+    wrt. de. This will numerically blow up quickly to +- inf.
+    Even worse, this instability will propagate one energy bin to the
+    left in each time step, if the difference (right - center) is used.
+    If (center - left) is used, it will propagate to the right.
+    To avoid this problem, we compute both the left and the right difference
+    and then take the smaller absolute value::
+
+        dpn_right[i] = pn[i+1] - pn[i]
+        dpn_left[i] = pn[i] - pn[i-1]
+        dpn = where( abs(dpn_right) < abs(dpn_left), dpn_right, dpn_left)
+
+    Each time step is split into as many sub-steps as needed to satisfy
+    the stability condition ``p dt < cfl de``, so this scheme is only
+    efficient for slow losses.
+
+    The work arrays are allocated once and reused in every step.
+    """
+    from scipy.linalg import solve_banded
+
+    energy = np.asarray(energy, dtype=float)
+    n = np.array(n, dtype=float)
+    shape = n.shape
+    n = n.reshape(-1, len(energy))
+
+    n_steps = max(int(round((t_stop - t_start) / dt)), 1)
+    dt = (t_stop - t_start) / n_steps
+    dt_sec = dt * conversion_factor('yr', 's')
+
+    # Energy bin widths, the last one is repeated
+    de = np.ediff1d(energy, to_end=energy[-1] - energy[-2])
+
+    def evaluate(func, t):
+        return np.broadcast_to(func(energy, t), n.shape)
+
+    if method == 'implicit':
+        # Banded matrix (upper diagonal and diagonal) and right-hand side
+        ab = np.empty((2, n.size))
+        upper, diag = ab[0].reshape(n.shape), ab[1].reshape(n.shape)
+        rhs = np.empty(n.shape)
+        for step in range(n_steps):
+            t = t_start + (step + 1) * dt
+            loss = dt_sec * evaluate(energy_loss_rate, t)
+            np.divide(loss, de, out=diag)
+            diag += 1
+            # The upper diagonal element of row i is stored in column i + 1,
+            # the first column of each spectrum is zero (no coupling)
+            np.divide(loss[:, 1:], de[:-1], out=upper[:, 1:])
+            np.negative(upper, out=upper)
+            upper[:, 0] = 0
+            rhs[...] = n
+            if injection is not None:
+                rhs += dt_sec * evaluate(injection, t)
+            n = solve_banded((0, 1), ab, rhs.ravel(), overwrite_ab=True,
+                             overwrite_b=True, check_finite=False).reshape(n.shape)
+    elif method == 'explicit':
+        pn = np.empty(n.shape)
+        dpn_right = np.empty(n.shape)
+        dpn_left = np.empty(n.shape)
+        abs_right = np.empty(n.shape)
+        abs_left = np.empty(n.shape)
+        use_right = np.empty(n.shape, dtype=bool)
+        for step in range(n_steps):
+            t = t_start + step * dt
+            p = evaluate(energy_loss_rate, t)
+            n_sub = max(int(np.ceil(dt_sec * np.max(p / de) / cfl)), 1)
+            dt_sub = dt_sec / n_sub
+            q = None if injection is None else evaluate(injection, t)
+            for _ in range(n_sub):
+                np.multiply(n, p, out=pn)
+                # dpn_right[i] = pn[i + 1] - pn[i], dpn_left[i] = pn[i] - pn[i - 1]
+                np.subtract(pn[:, 1:], pn[:, :-1], out=dpn_right[:, :-1])
+                dpn_right[:, -1] = dpn_right[:, -2]
+                dpn_left[:, 1:] = dpn_right[:, :-1]
+                dpn_left[:, 0] = dpn_right[:, 0]
+                # Take the difference with the smaller absolute value
+                np.abs(dpn_right, out=abs_right)
+                np.abs(dpn_left, out=abs_left)
+                np.less(abs_right, abs_left, out=use_right)
+                np.copyto(dpn_left, dpn_right, where=use_right)
+                dpn_left /= de
+                if q is not None:
+                    dpn_left += q
+                dpn_left *= dt_sub
+                n += dpn_left
+    else:
+        raise ValueError('Invalid method: {0}'.format(method))
+
+    return n.reshape(shape)
+
+
 # TODO: The following PWN model should be adapted to use naima classes.
 class PWNElectronSpectrum(PWN):
     def __init__(self,  q_type='constant', r_type='constant', B_type='constant',
@@ -167,21 +364,38 @@ class PWNElectronSpectrum(PWN):
         #
         # self.B = Bs[B_type]['function'](Bs[B_type]['params'])
         # self.B = self.B_constant(B=10)
+        self.e = np.logspace(-3, 3, 121)
+        self.n = np.zeros_like(self.e)
+        self.p = self.energy_loss_rate()
+        if not hasattr(self, 'age'):
+            self.age = Quantity(0, 'yr')
 
     def q(self, e, t, norm=1, e0=1, index=-2, emin=1e1, emax=1e4, burst=False):
-        """Injection spectrum: exponential cutoff power law.
+        """Injection spectrum: power law between ``emin`` and ``emax``.
 
         Parameters
         ----------
-        TODO
+        e : `~numpy.ndarray`
+            Energy (TeV)
+        t : float
+            Time (yr)
+        norm : float
+            Injection rate at ``e0`` (TeV^-1 s^-1)
+        e0 : float
+            Reference energy (TeV)
+        index : float
+            Spectral index
+        emin, emax : float
+            Energy range (TeV)
+        burst : bool
+            Only inject at time 0?
         """
         # For burst-like injection only inject at the first time step
         if burst and t != 0:
             return np.zeros_like(e)
-        # q = power_law(e, norm, e0, index)
-        # q[(e < emin) | (e > emax)] = 0
-        # return q
-        raise NotImplementedError
+        q = norm * (e / e0) ** index
+        q[(e < emin) | (e > emax)] = 0
+        return q
 
     def energy_loss_rate(self, B=10, w_rad=0.25):
         """Energy losses: synchrotron, IC, adiabatic.
@@ -195,11 +409,11 @@ class PWNElectronSpectrum(PWN):
 
         def p(e, t):
             """Energy loss rate (TeV s^-1) at a given
-            energy (TeV) and time (s)"""
+            energy (TeV) and time (yr)"""
             return b * e ** 2
         return p
 
-    def evolve(self, age=1e3, dt=1):
+    def evolve(self, age=1e3, dt=1, method='implicit'):
         """Evolve the electron spectrum in time.
 
         From the current age to the new requested age.
@@ -207,38 +421,9 @@ class PWNElectronSpectrum(PWN):
         If the current age is larger than the requested age,
         the PWN is reset to age 0 and then evolved to the requested age.
 
-        *Method*
-
-        The evolution is described by the continuity equation::
-            $$dn / dt = d(pn) / de + q$$
-
-        e: energy array (TeV)
-        n: electron spectrum array (TeV^-1)
-        p = p(e, t): energy loss function
-        q = q(e, t): injection function
-
-        *Implementation*
-
-        We are using a simple finite difference method to solve the
-        partial differential equation.
-
-        Spectra can have sharp cutoffs, i.e. infinite derivative wrt. de.
-        This will numerically blow up quickly to +- inf.
-        Even worse, this instability will propagate one energy bin to the
-        left in each time step, if the difference (right - center) is used.
-        If (center - left) is used, it will propagate to the right.
-
-        To avoid this problem, we compute both the left and the right difference
-        and then take the smaller absolute value::
-
-            dpn_right[i] = pn[i+1] - pn[i]
-            dpn_left[i] = pn[i] - pn[i-1]
-            dpn = where( abs(dpn_right) < abs(dpn_left), dpn_right, dpn_left)
-
-        This avoids the numerical instability as long as the spectrum is smooth
-        on one of the two sides for each energy.
-        E.g. a power-law spectrum that is 0 outside a range [emin, emax] is not
-        a problem any more.
+        The electron spectrum ``n`` (TeV^-1) on the energy grid ``e`` (TeV)
+        is evolved with `evolve_electron_spectra`, with energy loss
+        function ``p(e, t)`` and injection function ``q(e, t)``.
 
         Parameters
         ----------
@@ -246,45 +431,24 @@ class PWNElectronSpectrum(PWN):
             Final age (yr)
         dt : float
             Time step (yr)
+        method : {'implicit', 'explicit'}
+            Time stepping scheme, see `evolve_electron_spectra`.
         """
-        if self.age > age:
+        current_age = self.age.to('yr').value
+        if current_age > age:
             log.debug('current age = {0} > requested age = {1}'
-                      ''.format(self.age, age))
+                      ''.format(current_age, age))
             log.debug('Resetting to age 0.')
-            self.age = 0
-            self.electron_spec.y = 0
-            self.evolve(age, dt)
-        # Make sure we evolve exactly to the requested age
-        nsteps = int((age - self.age) / dt)
-        dt = (age - self.age) / nsteps
-        log.debug('current age = {0}, requested age = {1},'
-                  ' dt = {2}, nsteps = {3}'
-                  ''.format(self.age, age, dt, nsteps))
-        # Convenient shortcuts for current electron spectrum
-        # Note that these are references, no copying takes place.
-        e = self.electron_spec.e
-        n = self.electron_spec.n
-        de = self._get_diff(e)
+            current_age = 0
+            self.n = np.zeros_like(self.e)
+
         log.debug('Starting evolution')
-        for t in np.linspace(self.age, age, nsteps):
-            pn = n * self.p(e, t)
-            # See docstring for an explanation why we implement
-            # the difference in this way:
-            dpn_right = self._get_diff(pn, side='right')
-            dpn_left = self._get_diff(pn, side='left')
-            dpn = np.where(abs(dpn_right) < abs(dpn_left), dpn_right, dpn_left)
-            n += dt * (dpn / de + self.q(e, t))
+        self.n = evolve_electron_spectra(self.e, self.n, self.p, self.q,
+                                         t_start=current_age, t_stop=age,
+                                         dt=dt, method=method)
+        self.age = Quantity(age, 'yr')
         log.debug('Evolution finished')
 
-    def _get_diff(self, e, side='right'):
-        """Implement diff for an array, including handling of end points.
-
-        side = 'right': diff[i] = e[i + 1] - e[i]
-        side = 'left': diff[i] = e[i] - e[i - 1]
-        """
-        e = e if side == 'right' else e[::-1]
-        return np.ediff1d(e, to_end=e[-1] - e[-2])
-
     def B_constant(self, B):
         def B_constant(e, t):
             return B
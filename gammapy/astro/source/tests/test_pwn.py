@@ -4,7 +4,8 @@ from numpy.testing import assert_allclose
 import numpy as np
 from astropy.units import Quantity
 from astropy.tests.helper import pytest
-from ...source import PWN
+from ...source import PWN, Pulsar, SNRTrueloveMcKee, evolve_electron_spectra
+from ..pwn import PWNElectronSpectrum
 
 try:
     import scipy
@@ -31,3 +32,95 @@ def test_magnetic_field():
     reference = [np.nan, 1.75348134e-03, 8.78822460e-05, 4.40454585e-06,
                  2.20750154e-07, 4.68544888e-07, 1.48162794e-06]
     assert_allclose(pwn.magnetic_field(t).to('gauss'), reference)
+
+
+@pytest.mark.skipif('not HAS_SCIPY')
+def test_pwn_array_parameters():
+    """Array parameters give the same results as one PWN per element."""
+    P_0 = Quantity([0.01, 0.1, 0.3], 's')
+    logB = np.array([12, 13, 11.5])
+    n_ISM = Quantity([0.1, 1, 10], 'cm^-3')
+    age = Quantity([1e3, 3e3, 1e5], 'yr')
+    pwns = PWN(Pulsar(P_0, logB), SNRTrueloveMcKee(n_ISM=n_ISM))
+
+    radius = pwns.radius(age)
+    magnetic_field = pwns.magnetic_field(age)
+    assert radius.shape == (3,)
+    for idx in range(3):
+        pwn = PWN(Pulsar(P_0[idx], logB[idx]), SNRTrueloveMcKee(n_ISM=n_ISM[idx]))
+        assert_allclose(pwns._collision_time[idx], pwn._collision_time)
+        assert_allclose(radius[idx], pwn.radius(age[idx]))
+        assert_allclose(magnetic_field[idx], pwn.magnetic_field(age[idx]))
+
+    # Radii of all PWNe at several ages by broadcasting
+    radius = pwns.radius(age[:, np.newaxis])
+    assert radius.shape == (3, 3)
+    assert_allclose(np.diag(radius), pwns.radius(age))
+
+
+def cooled_power_law(e, t, b=1e-9, e_cut=100):
+    """Analytical solution for synchrotron cooling of a power law (t in s)."""
+    cooling = b * e * t
+    e0 = e / (1 - np.clip(cooling, 0, 0.999))
+    return np.where(cooling < 1, e ** -2 * np.exp(-e0 / e_cut), 0)
+
+
+@pytest.mark.skipif('not HAS_SCIPY')
+@pytest.mark.parametrize(('method', 'dt', 'rtol'), [('implicit', 1, 0.08),
+                                                    ('implicit', 0.1, 0.04),
+                                                    ('explicit', 10, 0.015)])
+def test_evolve_electron_spectra_cooling(method, dt, rtol):
+    """Accuracy of the time stepping schemes vs. the analytical solution.
+
+    The implicit scheme is first order in time, the explicit scheme
+    is sub-stepped to its stability limit, i.e. it is more accurate
+    but needs many more steps for stiff losses.
+    """
+    e = np.logspace(-1, 3, 81)
+    n = evolve_electron_spectra(e, cooled_power_law(e, 0), lambda e, t: 1e-9 * e ** 2,
+                                t_start=0, t_stop=10, dt=dt, method=method)
+    desired = cooled_power_law(e, Quantity(10, 'yr').to('s').value)
+    mask = (e > 0.3) & (e < 2)
+    assert_allclose(n[mask], desired[mask], rtol=rtol)
+
+
+def injection(e, t):
+    q = e ** -2.
+    q[(e < 1) | (e > 100)] = 0
+    return q
+
+
+@pytest.mark.skipif('not HAS_SCIPY')
+def test_evolve_electron_spectra_stacked():
+    e = np.logspace(-1, 3, 41)
+    b = np.array([[1e-9], [1e-8], [1e-7]])
+
+    # Implicit steps are stable for cooling times << dt
+    n = evolve_electron_spectra(e, np.zeros((3, len(e))), lambda e, t: b * e ** 2,
+                                injection, t_start=0, t_stop=1e3, dt=10)
+    assert np.all(n >= 0)
+
+    # Steady state of the discretised equation: n = sum_e^inf q de / p
+    de = np.ediff1d(e, to_end=e[-1] - e[-2])
+    desired = np.cumsum((injection(e, 0) * de)[::-1])[::-1] / (b * e ** 2)
+    mask = e > 1.5
+    assert_allclose(n[:, mask], desired[:, mask], rtol=1e-3)
+
+    for idx in range(3):
+        actual = evolve_electron_spectra(e, np.zeros(len(e)), lambda e, t: b[idx] * e ** 2,
+                                         injection, t_start=0, t_stop=1e3, dt=10)
+        assert_allclose(actual, n[idx])
+
+
+@pytest.mark.skipif('not HAS_SCIPY')
+def test_pwn_electron_spectrum_evolve():
+    pwn = PWNElectronSpectrum()
+    pwn.evolve(age=100, dt=10)
+    assert_allclose(pwn.age.to('yr').value, 100)
+    n = pwn.n.copy()
+    pwn.evolve(age=200, dt=10)
+    assert np.all(pwn.n >= n)
+
+    # Reset to age 0 for smaller ages
+    pwn.evolve(age=100, dt=10)
+    assert_allclose(pwn.n, n)
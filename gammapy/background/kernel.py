@@ -4,7 +4,6 @@ import os
 
 import numpy as np
 from astropy.io import fits
-import gc
 from ..stats import significance
 from ..image import binary_dilation_circle
 
@@ -54,6 +53,14 @@ class GammaImages(object):
 class IterativeKernelBackgroundEstimator(object):
     """Iteratively estimate a background model.
 
+    The background is the counts image convolved with the background kernel,
+    excluding pixels in the exclusion mask and normalised by the convolved mask.
+    The Fourier transforms of the counts and kernels are computed once and
+    re-used in all iterations. Between iterations only the contribution of
+    pixels whose mask value changed is added to the convolved sums.
+
+    Only the current and previous iteration are kept in memory.
+
     Parameters
     ----------
     images : `~gammapy.background.GammaImages`
@@ -68,8 +75,8 @@ class IterativeKernelBackgroundEstimator(object):
     mask_dilation_radius : float
         Amount by which mask is dilated with each iteration.
     delete_intermediate_results : bool
-        Specify whether results of intermediate iterations should be deleted.
-        (Otherwise, these are held in memory). Default True.
+        Deprecated, has no effect: results of previous iterations
+        are never kept.
     save_intermediate_results : bool
         Specify whether to save intermediate results as FITS files to disk.
         Default False.
@@ -79,27 +86,55 @@ class IterativeKernelBackgroundEstimator(object):
 
     def __init__(self, images, source_kernel, background_kernel,
                  significance_threshold, mask_dilation_radius,
-                 delete_intermediate_results=True,
+                 delete_intermediate_results=None,
                  save_intermediate_results=False, filebase='temp'):
+        from ..utils.fft import FFTConvolver
+        if delete_intermediate_results is not None:
+            import warnings
+            from astropy.utils.exceptions import AstropyDeprecationWarning
+            warnings.warn('delete_intermediate_results is deprecated and has no effect, '
+                          'results of previous iterations are never kept.',
+                          AstropyDeprecationWarning)
 
         self.source_kernel = source_kernel
         self.background_kernel = background_kernel
 
-        images.initial_background(background_kernel)
-        # self._data[i] is a GammaImages object representing iteration number `i`.
-        self._data = list()
-        self._data.append(images)
-
         self.header = images.header
 
         self.significance_threshold = significance_threshold
         self.mask_dilation_radius = mask_dilation_radius
 
-        self.delete_intermediate_results = delete_intermediate_results
         self.save_intermediate_results = save_intermediate_results
-        # Calculate initial significance image
-        self._data[-1].compute_correlated_maps(self.source_kernel)
-        gc.collect()
+
+        counts = np.asanyarray(images.counts)
+        shape = counts.shape
+        self._convolver = FFTConvolver(shape, [background_kernel, source_kernel])
+        self._initial_mask = images.mask.copy()
+        self.n_iterations = 0
+
+        # Convolved sums for the exclusion mask `self._sums_mask`, starting
+        # with the initial background, where nothing is excluded.
+        # The correlated counts never change and are computed only once.
+        self._sums_mask = np.ones(shape, dtype=bool)
+        self._weighted_counts = self._convolver.convolve(counts, index=0)
+        self._weighted_norm = self._convolver.convolve(np.ones(shape), index=0)
+
+        # Preallocated buffers for the current and previous state
+        self._mask_previous = np.ones(shape, dtype=bool)
+        self._images = GammaImages(counts, self._weighted_counts.copy(),
+                                   self._sums_mask.copy())
+        self._images.counts_corr = self._convolver.convolve(counts, index=1)
+        self._images.background_corr = np.empty(shape)
+        self._images.significance = np.empty(shape)
+        self._compute_significance()
+
+    def _compute_significance(self):
+        """Compute correlated background and significance for the current background."""
+        images = self._images
+        self._convolver.convolve(images.background, index=1,
+                                 out=images.background_corr, propagate_nan=True)
+        images.significance[...] = np.nan_to_num(significance(images.counts_corr,
+                                                              images.background_corr))
 
     def run(self, filebase=None, max_iterations=10):
         """Run iterations until mask does not change (stopping condition).
@@ -132,26 +167,21 @@ class IterativeKernelBackgroundEstimator(object):
             if self.save_intermediate_results:
                 self.save_files(filebase, index=ii)
 
-            # Dilate old mask to compare with new mask
-            old_mask = self._data[0].mask
-            new_mask = self._data[-1].mask
+            # Stop if the mask did not change. The first iteration uses
+            # the dilated mask, so it is not compared.
+            if self.n_iterations >= 2 and not self.mask_changed:
+                break
 
-            if ii >= 3:
-                # Prevents early termination in first two steps when
-                # mask is not yet correct
-                if np.alltrue(old_mask == new_mask):
-                    continue
-
-            if self.delete_intermediate_results:
-                # Remove results from previous iteration
-                del self._data[0]
-                gc.collect()
-
-        mask = self._data[-1].mask.astype(np.uint8)
-        background = self._data[-1].background
+        mask = self._images.mask.astype(np.uint8)
+        background = self._images.background
 
         return mask, background
 
+    @property
+    def mask_changed(self):
+        """Number of pixels where the mask changed in the last iteration (int)"""
+        return np.count_nonzero(self._images.mask != self._mask_previous)
+
     def run_iteration(self, update_mask=True):
         """Run one iteration.
 
@@ -162,35 +192,37 @@ class IterativeKernelBackgroundEstimator(object):
             `~gammapy.background.GammaImages` object with the exclusion mask
             newly calculated in this method.
         """
-        from scipy.ndimage import convolve
-        # Start with images from the last iteration. If not, makes one.
-        # Check if initial mask exists:
-        if len(self._data) >= 2:
-            mask = np.where(self._data[-1].significance > self.significance_threshold, 0, 1)
+        images = self._images
+        exclude = images.significance > self.significance_threshold
+        if self.n_iterations >= 1:
+            mask = np.invert(exclude)
         else:
-            # Compute new exclusion mask:
+            # Compute initial exclusion mask:
             if update_mask:
-
-                mask = np.where(self._data[-1].significance > self.significance_threshold, 0, 1)
-                mask = np.invert(binary_dilation_circle(mask == 0, radius=self.mask_dilation_radius))
+                mask = np.invert(binary_dilation_circle(exclude, radius=self.mask_dilation_radius))
             else:
-                mask = self._data[-1].mask.copy()
-
-        # Compute new background estimate:
-        # Convolve old background estimate with background kernel,
-        # excluding sources via the old mask.
-        weighted_counts = convolve(mask * self._data[-1].counts,
-                                   self.background_kernel)
-        weighted_counts_normalisation = convolve(mask.astype(float),
-                                                 self.background_kernel)
-
-        background = weighted_counts / weighted_counts_normalisation
-        counts = self._data[-1].counts
-        mask = mask.astype(int)
-
-        images = GammaImages(counts, background, mask)
-        images.compute_correlated_maps(self.source_kernel)
-        self._data.append(images)
+                mask = self._initial_mask.copy()
+
+        # Update background estimate:
+        # Convolve counts with background kernel, excluding sources via the
+        # mask. Only pixels where the mask changed contribute to the update.
+        delta = mask.astype(np.int8) - self._sums_mask.astype(np.int8)
+        if delta.any():
+            self._convolver.update(delta * images.counts, self._weighted_counts, index=0)
+            self._convolver.update(delta, self._weighted_norm, index=0)
+            self._sums_mask[...] = mask
+
+        self._mask_previous, images.mask = images.mask, self._mask_previous
+        images.mask[...] = mask
+        # Pixels without any non-excluded pixel in the kernel get a NaN
+        # background. Round-off from the updates is below `norm_min`.
+        norm_min = 1e-10 * np.abs(self.background_kernel).sum()
+        with np.errstate(invalid='ignore', divide='ignore'):
+            np.divide(self._weighted_counts, self._weighted_norm, out=images.background)
+        images.background[np.abs(self._weighted_norm) < norm_min] = np.nan
+
+        self._compute_significance()
+        self.n_iterations += 1
 
     def save_files(self, filebase, index):
         """Saves files to fits."""
@@ -198,16 +230,16 @@ class IterativeKernelBackgroundEstimator(object):
         header = self.header
 
         filename = os.path.join(filebase, '{0:02d}_mask.fits'.format(index))
-        hdu = fits.ImageHDU(data=self._data[-1].mask.astype(np.uint8),
+        hdu = fits.ImageHDU(data=self._images.mask.astype(np.uint8),
                             header=header)
         hdu.writeto(filename, clobber=True)
 
         filename = os.path.join(filebase, '{0:02d}_background.fits'.format(index))
-        hdu = fits.ImageHDU(data=self._data[-1].background, header=header)
+        hdu = fits.ImageHDU(data=self._images.background, header=header)
         hdu.writeto(filename, clobber=True)
 
         filename = os.path.join(filebase, '{0:02d}_significance.fits'.format(index))
-        hdu = fits.ImageHDU(data=self._data[-1].significance, header=header)
+        hdu = fits.ImageHDU(data=self._images.significance, header=header)
         hdu.writeto(filename, clobber=True)
 
     @property
@@ -215,7 +247,7 @@ class IterativeKernelBackgroundEstimator(object):
         """Mask (`~astropy.io.fits.ImageHDU`)"""
 
         header = self.header
-        return fits.ImageHDU(data=self._data[-1].mask.astype(np.uint8),
+        return fits.ImageHDU(data=self._images.mask.astype(np.uint8),
                              header=header)
 
     @property
@@ -223,7 +255,7 @@ class IterativeKernelBackgroundEstimator(object):
         """Background estimate (`~astropy.io.fits.ImageHDU`)"""
 
         header = self.header
-        return fits.ImageHDU(data=self._data[-1].background,
+        return fits.ImageHDU(data=self._images.background,
                              header=header)
 
     @property
@@ -231,5 +263,5 @@ class IterativeKernelBackgroundEstimator(object):
         """Significance estimate (`~astropy.io.fits.ImageHDU`)"""
 
         header = self.header
-        return fits.ImageHDU(data=self._data[-1].significance,
+        return fits.ImageHDU(data=self._images.significance,
                              header=header)
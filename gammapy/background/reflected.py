@@ -2,9 +2,15 @@
 """Reflected region background estimation.
 """
 from __future__ import print_function, division
+import logging
+log = logging.getLogger(__name__)
+from functools import partial
 import numpy as np
 from numpy import sin, cos, arctan2, sqrt
-from ..image import exclusion_distance, lookup
+from astropy.units import Quantity
+from astropy.table import Table
+from ..extern.bunch import Bunch
+from ..image import exclusion_distance
 
 __all__ = ['ReflectedRegionMaker', 'ReflectedBgMaker']
 
@@ -30,61 +36,131 @@ class ReflectedRegionMaker(object):
         # up the distance of the corresponding pixel in this map.
         header = exclusion.header
         CDELT = exclusion.header['CDELT2']
-        distance = CDELT * exclusion_distance(exclusion.data)
+        distance = CDELT * exclusion_distance(exclusion.data.astype(bool))
         from astropy.io.fits import ImageHDU
+        from astropy.wcs import WCS
         self.exclusion_distance = ImageHDU(distance, header)
+        self._wcs = WCS(header)
 
     def compute(self, x_on, y_on, r_on):
-        self.regions = []
+        """Find reflected regions for one ON region.
+
+        The result is stored as a list of region dicts in ``self.regions``.
+
+        Parameters
+        ----------
+        x_on, y_on, r_on : float
+            ON region position and radius (deg)
+        """
         self.on_region = dict(x=x_on, y=y_on, r=r_on)
-        angle_on = self._compute_angle(x_on, y_on)
-        offset_on = self._compute_offset(x_on, y_on)
-        angles = angle_on + np.arange(0, np.radians(360), np.radians(self.angle_increment))
-        for angle in angles:
-            x, y = self._compute_xy(offset_on, angle)
-            if self._is_position_ok(x, y, r_on):
-                region = dict(x=x, y=y, r=r_on)
-                self.regions.append(region)
-
-    def _is_position_ok(self, x, y, r):
-        if self._is_exclusion_ok(x, y, r):
-            if self._is_other_regions_ok(x, y, r):
-                return True
-        return False
-
-    def _is_exclusion_ok(self, x, y, r):
-        return lookup(self.exclusion_distance, x, y) > r
-
-    def _is_other_regions_ok(self, x, y, r):
-        other_regions = self.regions + [self.on_region]
-        for region in other_regions:
-            x2 = (region['x'] - x) ** 2
-            y2 = (region['y'] - y) ** 2
-            distance = sqrt(x2 + y2)
-            min_distance = r + region['r']
-            if distance < min_distance:
-                return False
-        return True
-
-    def _compute_offset(self, x, y):
-        x2 = (x - self.fov['x']) ** 2
-        y2 = (y - self.fov['y']) ** 2
-        return sqrt(x2 + y2)
-
-    def _compute_angle(self, x, y):
-        """Compute position angle wrt. the FOV center"""
-        dx = x - self.fov['x']
-        dy = y - self.fov['y']
-        angle = arctan2(dx, dy)
-        return angle
-
-    def _compute_xy(self, offset, angle):
-        """Compute x, y position for a given position angle"""
-        dx = offset * sin(angle)
-        dy = offset * cos(angle)
-        x = self.fov['x'] + dx
-        y = self.fov['y'] + dy
-        return x, y
+        fov = (self.fov['x'], self.fov['y'])
+        x, y = self._find_regions(np.array([fov]), x_on, y_on, r_on)[0]
+        self.regions = [dict(x=_x, y=_y, r=r_on) for _x, _y in zip(x, y)]
+
+    def compute_batch(self, fovs, x_on, y_on, r_on):
+        """Find reflected regions for many runs and ON regions at once.
+
+        Candidate positions for all runs and ON regions are computed and
+        checked against the exclusion mask in one vectorised step.
+
+        Parameters
+        ----------
+        fovs : list of dict
+            FOV center ``x``, ``y`` (deg) for each run.
+        x_on, y_on, r_on : array_like
+            ON region positions and radii (deg)
+
+        Returns
+        -------
+        regions : list
+            ``regions[i_run][i_on]`` is the list of OFF region dicts
+            for run ``i_run`` and ON region ``i_on``.
+        """
+        x_on, y_on, r_on = np.broadcast_arrays(np.atleast_1d(x_on),
+                                               np.atleast_1d(y_on),
+                                               np.atleast_1d(r_on))
+        fov = np.array([(_['x'], _['y']) for _ in fovs], dtype=float)
+
+        # Flatten the (run, ON region) pairs into one batch
+        n_runs, n_on = len(fov), len(x_on)
+        fov = np.repeat(fov, n_on, axis=0)
+        x_on, y_on, r_on = [np.tile(_, n_runs) for _ in (x_on, y_on, r_on)]
+
+        results = self._find_regions(fov, x_on, y_on, r_on)
+
+        regions = []
+        for i_run in range(n_runs):
+            run_regions = []
+            for i_on in range(n_on):
+                idx = i_run * n_on + i_on
+                x, y = results[idx]
+                run_regions.append([dict(x=_x, y=_y, r=r_on[idx])
+                                    for _x, _y in zip(x, y)])
+            regions.append(run_regions)
+        return regions
+
+    def _find_regions(self, fov, x_on, y_on, r_on):
+        """Find reflected regions for arrays of FOV centers and ON regions.
+
+        Parameters
+        ----------
+        fov : `~numpy.ndarray`
+            FOV center positions, shape ``(n, 2)``
+        x_on, y_on, r_on : array_like
+            ON regions, shape ``(n,)``
+
+        Returns
+        -------
+        regions : list of tuple
+            ``(x, y)`` arrays of OFF region positions for each ON region.
+        """
+        x_on, y_on, r_on = [np.atleast_1d(_).astype(float)[:, np.newaxis]
+                            for _ in (x_on, y_on, r_on)]
+        x_fov, y_fov = fov[:, 0:1], fov[:, 1:2]
+
+        # Candidate positions, shape (n, n_angles).
+        # The ON region position is at angle 0.
+        dx, dy = x_on - x_fov, y_on - y_fov
+        offset = sqrt(dx ** 2 + dy ** 2)
+        angles = np.arange(0, np.radians(360), np.radians(self.angle_increment))
+        angles = arctan2(dx, dy) + angles
+        x = x_fov + offset * sin(angles)
+        y = y_fov + offset * cos(angles)
+
+        # Positions have to be far enough from exclusion regions and
+        # must not overlap the ON region
+        ok = self._exclusion_distance_at(x, y) > r_on
+        ok &= sqrt((x - x_on) ** 2 + (y - y_on) ** 2) >= 2 * r_on
+
+        # Greedy selection in order of increasing angle: accept the first
+        # remaining candidate and drop all candidates overlapping it.
+        regions = []
+        for ok_, x_, y_, r_ in zip(ok, x, y, r_on[:, 0]):
+            candidates = np.flatnonzero(ok_)
+            selected = []
+            while len(candidates) > 0:
+                idx = candidates[0]
+                selected.append(idx)
+                distance = sqrt((x_[candidates] - x_[idx]) ** 2 +
+                                (y_[candidates] - y_[idx]) ** 2)
+                candidates = candidates[distance >= 2 * r_]
+            regions.append((x_[selected], y_[selected]))
+
+        return regions
+
+    def _exclusion_distance_at(self, x, y):
+        """Look up exclusion distance at world positions (0 outside the map)."""
+        origin = 0  # convention for gammapy
+        x_pix, y_pix = self._wcs.wcs_world2pix(x, y, origin)
+        x_pix = np.round(x_pix).astype(int)
+        y_pix = np.round(y_pix).astype(int)
+
+        data = self.exclusion_distance.data
+        ny, nx = data.shape
+        inside = (x_pix >= 0) & (x_pix < nx) & (y_pix >= 0) & (y_pix < ny)
+        distance = np.zeros(x_pix.shape)
+        distance[inside] = data[y_pix[inside], x_pix[inside]]
+        return distance
 
     def write_off_regions(self, filename):
         fmt = 'galactic; circle({x},{y},{r})\n'
@@ -95,5 +171,246 @@ class ReflectedRegionMaker(object):
 
 
 class ReflectedBgMaker(object):
-    """Compute background using the reflected background method"""
-    pass
+    """Compute ON / OFF spectra using the reflected background method.
+
+    For each run the reflected OFF regions are found with
+    `ReflectedRegionMaker` (for all runs in one batch), the ON and OFF
+    counts are histogrammed in reconstructed energy and the results of
+    all runs are stacked into PHA-like arrays.
+
+    Only the event columns needed for the analysis are read
+    from the (memory-mapped) event list files.
+
+    Parameters
+    ----------
+    data_store : `~gammapy.obs.DataStore`
+        Data store
+    exclusion : `~astropy.io.fits.ImageHDU`
+        Exclusion mask (0 = excluded). The ON region position is given
+        in the world coordinates of this image.
+    on_region : dict
+        ON region position ``x``, ``y`` and radius ``r`` (deg)
+    ebounds : `~astropy.units.Quantity`
+        Reconstructed energy bin edges
+    angle_increment : float
+        Angle increment for the reflected region search (deg)
+
+    Examples
+    --------
+    >>> maker = ReflectedBgMaker(data_store, exclusion,
+    ...                          on_region=dict(x=184.56, y=-5.78, r=0.1),
+    ...                          ebounds=Quantity(np.logspace(-1, 2, 31), 'TeV'))
+    >>> result = maker.run(obs_ids, parallel=True)
+    >>> excess = result.n_on - result.alpha * result.n_off
+    """
+
+    def __init__(self, data_store, exclusion, on_region, ebounds,
+                 angle_increment=0.1):
+        self.data_store = data_store
+        self.exclusion = exclusion
+        self.on_region = on_region
+        self.ebounds = Quantity(ebounds)
+        self.angle_increment = angle_increment
+        self.result = None
+
+        ctype = exclusion.header['CTYPE1']
+        self.frame = 'galactic' if 'GLON' in ctype else 'icrs'
+
+    def make_off_regions(self, obs_ids):
+        """Find reflected OFF regions for given runs.
+
+        Parameters
+        ----------
+        obs_ids : array_like
+            Observation IDs
+
+        Returns
+        -------
+        regions : list of list of dict
+            List of OFF region dicts for each run.
+        """
+        table = self.data_store.index_table
+        rows = dict((obs_id, idx) for idx, obs_id in enumerate(table['OBS_ID']))
+        index = np.array([rows[_] for _ in obs_ids], dtype=int)
+        if self.frame == 'galactic':
+            x, y = table['GLON'][index], table['GLAT'][index]
+        else:
+            x, y = table['RA'][index], table['DEC'][index]
+
+        fovs = [dict(x=_x, y=_y) for _x, _y in zip(x, y)]
+        maker = ReflectedRegionMaker(self.exclusion, fovs[0],
+                                     angle_increment=self.angle_increment)
+        on = self.on_region
+        regions = maker.compute_batch(fovs, on['x'], on['y'], on['r'])
+        return [_[0] for _ in regions]
+
+    def run(self, obs_ids=None, parallel=False, processes=None):
+        """Compute stacked ON / OFF spectra.
+
+        Parameters
+        ----------
+        obs_ids : array_like, optional
+            Observation IDs (default: all runs in the data store).
+        parallel : bool
+            Process runs in a pool of worker processes.
+        processes : int, optional
+            Number of worker processes (default: number of CPUs).
+
+        Returns
+        -------
+        result : `~gammapy.extern.bunch.Bunch`
+            Stacked spectra: ``n_on``, ``n_off`` (arrays with one entry per
+            energy bin), exposure weighted ``alpha``, ``livetime`` and the
+            per-run summary table ``runs``.
+        """
+        if obs_ids is None:
+            obs_ids = self.data_store.index_table['OBS_ID']
+        obs_ids = np.atleast_1d(obs_ids)
+
+        off_regions = self.make_off_regions(obs_ids)
+
+        tasks = []
+        for obs_id, regions in zip(obs_ids, off_regions):
+            if not regions:
+                log.warning('No OFF regions found for OBS_ID = {0}, skipping run.'
+                            ''.format(obs_id))
+                continue
+            filename = self.data_store.filename(obs_id, filetype='events')
+            x_off = np.array([_['x'] for _ in regions])
+            y_off = np.array([_['y'] for _ in regions])
+            tasks.append((obs_id, filename, x_off, y_off))
+
+        wrap = partial(_reflected_spectrum_run, on_region=self.on_region,
+                       frame=self.frame, ebounds=self.ebounds)
+
+        pool = None
+        if parallel:
+            from multiprocessing import Pool
+            pool = Pool(processes)
+            results = pool.imap_unordered(wrap, tasks)
+        else:
+            results = map(wrap, tasks)
+
+        # Reduce the per-run results as they come in
+        n_bins = len(self.ebounds) - 1
+        n_on, n_off = np.zeros(n_bins), np.zeros(n_bins)
+        # The stacked alpha is the ratio of the ON and OFF exposures,
+        # i.e. livetime times region size, summed over runs.
+        exposure_off, livetime = 0., 0.
+        rows = []
+        try:
+            for run in results:
+                n_on += run['n_on']
+                n_off += run['n_off']
+                exposure_off += run['livetime'] / run['alpha']
+                livetime += run['livetime']
+                rows.append((run['obs_id'], run['n_on'].sum(), run['n_off'].sum(),
+                             run['alpha'], run['livetime']))
+        except BaseException:
+            # Don't process the remaining runs
+            if pool is not None:
+                pool.terminate()
+            raise
+        else:
+            if pool is not None:
+                pool.close()
+        finally:
+            if pool is not None:
+                pool.join()
+
+        rows.sort()
+        names = ['OBS_ID', 'N_ON', 'N_OFF', 'ALPHA', 'LIVETIME']
+        if rows:
+            runs = Table(rows=rows, names=names)
+        else:
+            runs = Table(names=names)
+        runs['LIVETIME'].unit = 's'
+
+        alpha = livetime / exposure_off if exposure_off > 0 else np.nan
+        self.result = Bunch(ebounds=self.ebounds, n_on=n_on, n_off=n_off,
+                            alpha=alpha, livetime=Quantity(livetime, 's'),
+                            runs=runs)
+        return self.result
+
+
+def _reflected_spectrum_run(task, on_region, frame, ebounds):
+    """Compute ON / OFF spectra for one run.
+
+    This is a module-level function so that it can be used with `multiprocessing`.
+    """
+    from astropy.io import fits
+    obs_id, filename, x_off, y_off = task
+
+    with fits.open(filename, memmap=True) as hdu_list:
+        hdu = hdu_list['EVENTS']
+        data = hdu.data
+        livetime = hdu.header.get('LIVETIME', hdu.header.get('ONTIME', 0))
+
+        if frame == 'galactic' and 'GLON' in data.columns.names:
+            lon, lat = np.array(data['GLON']), np.array(data['GLAT'])
+        elif frame == 'galactic':
+            from astropy.coordinates import SkyCoord
+            galactic = SkyCoord(data['RA'], data['DEC'], unit='deg').galactic
+            lon, lat = galactic.l.degree, galactic.b.degree
+        else:
+            lon, lat = np.array(data['RA']), np.array(data['DEC'])
+
+        unit = data.columns['ENERGY'].unit or 'TeV'
+        energy = np.array(data['ENERGY'])
+
+    energy_edges = ebounds.to(unit).value
+    vectors = _unit_vectors(lon, lat)
+    r_on = on_region['r']
+
+    on = _in_circle(vectors, on_region['x'], on_region['y'], r_on)
+    n_on = _histogram_log(energy[on], energy_edges)
+
+    off = np.zeros(len(energy), dtype=bool)
+    for x, y in zip(x_off, y_off):
+        off |= _in_circle(vectors, x, y, r_on)
+    n_off = _histogram_log(energy[off], energy_edges)
+
+    # All reflected regions have the ON region size
+    alpha = 1. / len(x_off)
+
+    return dict(obs_id=obs_id, n_on=n_on, n_off=n_off,
+                alpha=alpha, livetime=livetime)
+
+
+def _unit_vectors(lon, lat):
+    """Cartesian unit vectors for arrays of sky positions (deg)."""
+    lon, lat = np.radians(lon), np.radians(lat)
+    cos_lat = np.cos(lat)
+    return np.array([cos_lat * np.cos(lon), cos_lat * np.sin(lon), np.sin(lat)])
+
+
+def _in_circle(vectors, x, y, r):
+    """Which unit vectors are within a circle of radius ``r`` at ``(x, y)`` (deg)?
+
+    Uses the chord length, which doesn't suffer from round-off at small angles.
+    """
+    center = _unit_vectors(x, y)
+    chord2 = ((vectors - center[:, np.newaxis]) ** 2).sum(axis=0)
+    return chord2 <= (2 * np.sin(np.radians(r) / 2)) ** 2
+
+
+def _histogram_log(values, edges):
+    """Histogram values, using a fast path for log-spaced bins.
+
+    For bins with equal log spacing the bin index is computed directly
+    and counted with `~numpy.bincount`, otherwise `~numpy.histogram` is used.
+    """
+    log_edges = np.log10(edges)
+    step = np.diff(log_edges)
+    if not np.allclose(step, step[0]):
+        return np.histogram(values, edges)[0].astype(float)
+
+    n_bins = len(edges) - 1
+    values = values[(values >= edges[0]) & (values <= edges[-1])]
+    index = ((np.log10(values) - log_edges[0]) / step[0]).astype(int)
+    index = np.clip(index, 0, n_bins - 1)
+    # Correct for round-off in the log for values close to bin edges.
+    # Values on the upper edge go into the last bin, like for `~numpy.histogram`.
+    index -= (values < edges[index]) & (index > 0)
+    index += (values >= edges[index + 1]) & (index < n_bins - 1)
+    return np.bincount(index, minlength=n_bins).astype(float)
@@ -144,6 +144,8 @@ class TestIterativeKernelBackgroundEstimator(object):
         """Tests run script."""
         mask, background = self.ibe2.run()
 
+        # Stops early once the mask doesn't change any more
+        assert self.ibe2.n_iterations < 10
         assert_allclose(mask.sum(), 97)
         assert_allclose(background, 42 * np.ones((10, 10)))
 
@@ -165,3 +167,14 @@ class TestIterativeKernelBackgroundEstimator(object):
         assert_allclose(mask_data.sum(), 97)
         assert_allclose(significance_data.sum(), 157.316195729298)
         assert_allclose(background_data.sum(), 4200)
+
+
+@pytest.mark.skipif('not HAS_SCIPY')
+def test_delete_intermediate_results_deprecated():
+    from astropy.utils.exceptions import AstropyDeprecationWarning
+    hdu = make_empty_image(nxpix=10, nypix=10, binsz=1, fill=42)
+    images = GammaImages(hdu.data, header=hdu.header)
+    kernel = np.ones((3, 3))
+    with pytest.warns(AstropyDeprecationWarning):
+        IterativeKernelBackgroundEstimator(images, kernel, kernel, 4, 1,
+                                           delete_intermediate_results=True)
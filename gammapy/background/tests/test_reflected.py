@@ -1,8 +1,17 @@
 # Licensed under a 3-clause BSD style license - see LICENSE.rst
 from __future__ import print_function, division
 import unittest
+import numpy as np
+from numpy.testing import assert_allclose
 from astropy.tests.helper import pytest
-from ...background import Maps, ReflectedRegionMaker
+from ...background import Maps, ReflectedRegionMaker, ReflectedBgMaker
+from ...image import make_empty_image
+
+try:
+    import scipy
+    HAS_SCIPY = True
+except ImportError:
+    HAS_SCIPY = False
 
 
 @pytest.mark.xfail
@@ -18,3 +27,141 @@ class TestReflectedBgMaker(unittest.TestCase):
             reflected_bg_maker.make_n_reflected_map(run, run_map)
             total_maps.add(run_map)
         total_maps.save('n_reflected.fits')
+
+
+@pytest.mark.skipif('not HAS_SCIPY')
+def test_ReflectedRegionMaker():
+    exclusion = make_empty_image(nxpix=200, nypix=200, binsz=0.02, fill=1)
+    exclusion.data[50:70, 60:90] = 0
+
+    fov = dict(x=0.1, y=-0.2, r=2)
+    maker = ReflectedRegionMaker(exclusion, fov)
+    maker.compute(x_on=0.5, y_on=0.3, r_on=0.1)
+
+    assert len(maker.regions) == 16
+    assert_allclose(maker.regions[0]['x'], 0.63486, atol=1e-4)
+    assert_allclose(maker.regions[0]['y'], 0.15188, atol=1e-4)
+
+    # OFF regions must not overlap each other or the ON region
+    x = np.array([_['x'] for _ in maker.regions] + [0.5])
+    y = np.array([_['y'] for _ in maker.regions] + [0.3])
+    distance = np.hypot(x[:, np.newaxis] - x, y[:, np.newaxis] - y)
+    distance[np.diag_indices_from(distance)] = np.inf
+    assert distance.min() >= 0.2
+
+    regions = maker.compute_batch([fov, dict(x=0, y=0)],
+                                  x_on=[0.5, -0.6], y_on=[0.3, 0.2], r_on=0.1)
+    assert len(regions) == 2
+    assert len(regions[0]) == 2
+    assert regions[0][0] == maker.regions
+
+
+def make_test_data_store(dir, n_runs=3, n_events=10000, random_state=0):
+    """Write a small HESS-scheme data store with uniform events."""
+    from astropy.io import fits
+    from astropy.table import Table
+    from ...obs.datastore import _make_filename_hess_scheme
+    random_state = np.random.RandomState(random_state)
+
+    obs_id = np.arange(1, n_runs + 1)
+    ones = np.ones(n_runs)
+    index_table = Table()
+    index_table['OBS_ID'] = obs_id
+    index_table['RA_PNT'] = 83.6 + 0.5 * np.arange(n_runs)
+    index_table['DEC_PNT'] = 22.0 * ones
+    for name in ['ALT_PNT', 'AZ_PNT', 'MUONEFF', 'TSTART', 'TSTOP',
+                 'TRGRATE', 'MEANTEMP', 'TELLIST']:
+        index_table[name] = ones
+    index_table['ONTIME'] = 1800 * ones
+    index_table['LIVETIME'] = 1600 * ones
+    index_table.write(str(dir.join('runinfo.fits')))
+
+    for row in index_table:
+        events = Table()
+        events['RA'] = row['RA_PNT'] + random_state.uniform(-2, 2, n_events)
+        events['DEC'] = row['DEC_PNT'] + random_state.uniform(-2, 2, n_events)
+        events['ENERGY'] = 10 ** random_state.uniform(-1, 2, n_events)
+        events['ENERGY'].unit = 'TeV'
+        hdu = fits.BinTableHDU(np.array(events), name='EVENTS')
+        hdu.header['TUNIT3'] = 'TeV'
+        hdu.header['LIVETIME'] = row['LIVETIME']
+        filename = dir.join(_make_filename_hess_scheme(row['OBS_ID']))
+        filename.dirpath().ensure(dir=True)
+        hdu.writeto(str(filename))
+
+
+@pytest.mark.skipif('not HAS_SCIPY')
+def test_ReflectedBgMaker(tmpdir):
+    from astropy.units import Quantity
+    from ...obs import DataStore
+    make_test_data_store(tmpdir)
+    data_store = DataStore(dir=str(tmpdir))
+
+    exclusion = make_empty_image(nxpix=400, nypix=200, binsz=0.02,
+                                 xref=84, yref=22, coordsys='CEL', fill=1)
+    on_region = dict(x=84.1, y=22.5, r=0.2)
+    ebounds = Quantity(np.logspace(-1, 2, 7), 'TeV')
+    maker = ReflectedBgMaker(data_store, exclusion, on_region, ebounds)
+    result = maker.run()
+
+    assert len(result.runs) == 3
+    assert_allclose(result.livetime.value, 4800)
+    assert_allclose(result.n_on.sum(), result.runs['N_ON'].sum())
+    # Uniform events: the background estimate should match the ON counts
+    assert_allclose(result.n_on.sum(), result.alpha * result.n_off.sum(), rtol=0.2)
+
+    # Parallel processing gives the same results
+    parallel = maker.run(parallel=True, processes=2)
+    assert_allclose(parallel.n_on, result.n_on)
+    assert_allclose(parallel.n_off, result.n_off)
+    assert_allclose(parallel.alpha, result.alpha)
+    assert_allclose(parallel.runs['N_OFF'], result.runs['N_OFF'])
+
+
+class _RecordingPool(object):
+    """Pool that records how it is shut down."""
+    calls = []
+
+    def __init__(self, processes=None):
+        from multiprocessing.pool import Pool
+        self._pool = Pool(processes)
+
+    def imap_unordered(self, func, iterable):
+        return self._pool.imap_unordered(func, iterable)
+
+    def close(self):
+        self.calls.append('close')
+        self._pool.close()
+
+    def terminate(self):
+        self.calls.append('terminate')
+        self._pool.terminate()
+
+    def join(self):
+        self.calls.append('join')
+        self._pool.join()
+
+
+@pytest.mark.skipif('not HAS_SCIPY')
+def test_ReflectedBgMaker_parallel_error(tmpdir, monkeypatch):
+    import multiprocessing
+    from astropy.units import Quantity
+    from ...obs import DataStore
+    make_test_data_store(tmpdir)
+    data_store = DataStore(dir=str(tmpdir))
+    # Make the first run unreadable
+    with open(data_store.filename(1, filetype='events'), 'w') as fh:
+        fh.write('not a FITS file')
+
+    exclusion = make_empty_image(nxpix=400, nypix=200, binsz=0.02,
+                                 xref=84, yref=22, coordsys='CEL', fill=1)
+    on_region = dict(x=84.1, y=22.5, r=0.2)
+    ebounds = Quantity(np.logspace(-1, 2, 7), 'TeV')
+    maker = ReflectedBgMaker(data_store, exclusion, on_region, ebounds)
+
+    monkeypatch.setattr(multiprocessing, 'Pool', _RecordingPool)
+    monkeypatch.setattr(_RecordingPool, 'calls', [])
+    with pytest.raises(IOError):
+        maker.run(parallel=True, processes=2)
+    # The remaining runs are not processed after the error
+    assert _RecordingPool.calls == ['terminate', 'join']
@@ -1,8 +1,14 @@
 # Licensed under a 3-clause BSD style license - see LICENSE.rst
 from __future__ import (absolute_import, division, print_function,
                         unicode_literals)
-from astropy.coordinates import SkyCoord, Longitude, Latitude
-from ...catalog import coordinate_iau_format, ra_iau_format, dec_iau_format
+import gc
+import weakref
+import numpy as np
+from numpy.testing import assert_equal
+from astropy.coordinates import SkyCoord, Longitude, Latitude, Angle
+from astropy.table import Table
+from ...catalog import (coordinate_iau_format, ra_iau_format, dec_iau_format,
+                        select_sky_box, select_sky_circle)
 
 
 def test_make_source_designation():
@@ -83,3 +89,81 @@ def test_dec_iau_format():
     assert dec_iau_format(dec, digits=6) == '-4226.33'
     assert dec_iau_format(dec, digits=7) == '-422633.7'
     assert dec_iau_format(dec, digits=8) == '-422633.79'
+
+
+def _make_sky_table(n_sources=1000):
+    random_state = np.random.RandomState(seed=0)
+    skycoord = SkyCoord(random_state.uniform(0, 360, n_sources),
+                        np.degrees(np.arcsin(random_state.uniform(-1, 1, n_sources))),
+                        unit='deg', frame='icrs')
+    table = Table()
+    table['RA'] = skycoord.ra.deg
+    table['DEC'] = skycoord.dec.deg
+    table['RA'].unit = 'deg'
+    table['DEC'].unit = 'deg'
+    return table, skycoord
+
+
+def test_select_sky_box():
+    table, skycoord = _make_sky_table()
+    lon_lim = Angle([-100, 50], 'deg')
+    lat_lim = Angle([-25, 25], 'deg')
+
+    # Columns in the selection frame
+    mask = select_sky_box(table, lon_lim, lat_lim, frame='icrs', output='mask')
+    lon, lat = skycoord.ra.wrap_at('180d').deg, skycoord.dec.deg
+    desired = (-100 <= lon) & (lon < 50) & (-25 <= lat) & (lat < 25)
+    assert_equal(mask, desired)
+
+    # Transformation to a different frame
+    mask = select_sky_box(table, lon_lim, lat_lim, frame='galactic', output='mask')
+    galactic = skycoord.galactic
+    lon, lat = galactic.l.wrap_at('180d').deg, galactic.b.deg
+    desired = (-100 <= lon) & (lon < 50) & (-25 <= lat) & (lat < 25)
+    assert_equal(mask, desired)
+
+    # Galactic columns are used directly if present
+    table['GLON'] = galactic.l.deg
+    table['GLAT'] = galactic.b.deg
+    mask = select_sky_box(table, lon_lim, lat_lim, frame='galactic', output='mask')
+    assert_equal(mask, desired)
+
+    selected = select_sky_box(table, lon_lim, lat_lim, frame='galactic')
+    assert len(selected) == desired.sum()
+    indices = select_sky_box(table, lon_lim, lat_lim, frame='galactic',
+                             inverted=True, output='indices')
+    assert_equal(indices, np.flatnonzero(~desired))
+
+
+def test_select_sky_circle():
+    table, skycoord = _make_sky_table()
+    radius = Angle(30, 'deg')
+
+    for frame in ['icrs', 'galactic']:
+        center = SkyCoord(350, -10, unit='deg', frame=frame)
+        mask = select_sky_circle(table, center.data.lon, center.data.lat, radius,
+                                 frame=frame, output='mask')
+        desired = skycoord.separation(center) < radius
+        assert_equal(mask, desired)
+
+        selected = select_sky_circle(table, center.data.lon, center.data.lat, radius,
+                                     frame=frame, inverted=True)
+        assert len(selected) == (~desired).sum()
+
+
+def test_select_sky_box_transform_cache():
+    from ..utils import _transform_cache
+    table, skycoord = _make_sky_table()
+    lon_lim, lat_lim = Angle([-100, 50], 'deg'), Angle([-25, 25], 'deg')
+    mask = select_sky_box(table, lon_lim, lat_lim, frame='galactic', output='mask')
+    key = (id(table), 'RA', 'galactic')
+    assert key in _transform_cache
+    assert_equal(select_sky_box(table, lon_lim, lat_lim, frame='galactic',
+                                output='mask'), mask)
+
+    # The cache doesn't keep the table alive and forgets it
+    table_ref = weakref.ref(table)
+    del table
+    gc.collect()
+    assert table_ref() is None
+    assert key not in _transform_cache
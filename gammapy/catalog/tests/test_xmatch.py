@@ -2,16 +2,28 @@
 from __future__ import (absolute_import, division, print_function,
                         unicode_literals)
 import numpy as np
+from numpy.testing import assert_allclose, assert_equal
+from astropy.tests.helper import pytest
 from astropy.coordinates import Angle
+from astropy.table import Table
 from ...astro.population import make_catalog_random_positions_sphere
 from ...catalog import (
     catalog_xmatch_circle,
     catalog_xmatch_combine,
     table_xmatch_circle_criterion,
+    table_xmatch_column_criterion,
     table_xmatch,
+    skycoord_from_table,
 )
 
+try:
+    import scipy
+    HAS_SCIPY = True
+except ImportError:
+    HAS_SCIPY = False
 
+
+@pytest.mark.skipif('not HAS_SCIPY')
 def test_catalog_xmatch_circle():
     random_state = np.random.RandomState(seed=0)
 
@@ -26,11 +38,98 @@ def test_catalog_xmatch_circle():
     assert len(result) == 23
 
 
+@pytest.mark.skipif('not HAS_SCIPY')
+def test_catalog_xmatch_circle_radii():
+    """Compare with brute force separations, for per-source radii on both sides"""
+    random_state = np.random.RandomState(seed=0)
+    catalog = make_catalog_random_positions_sphere(size=50, center='Milky Way',
+                                                   random_state=random_state)
+    catalog['Source_Name'] = ['a_{:04d}'.format(_) for _ in range(len(catalog))]
+    catalog['Association_Radius'] = Angle(random_state.uniform(0, 20, len(catalog)), 'deg')
+    other_catalog = make_catalog_random_positions_sphere(size=80, center='Milky Way',
+                                                         random_state=random_state)
+    other_catalog['Source_Name'] = ['b_{:04d}'.format(_) for _ in range(len(other_catalog))]
+    other_catalog['Radius'] = random_state.uniform(0, 5, len(other_catalog))
+    other_catalog.meta['name'] = 'other'
+
+    result = catalog_xmatch_circle(catalog, other_catalog, other_radius='Radius')
+
+    skycoord = skycoord_from_table(catalog)
+    other_skycoord = skycoord_from_table(other_catalog)
+    idx, other_idx, separation = [], [], []
+    for source_index in range(len(catalog)):
+        sep = skycoord[source_index].separation(other_skycoord).degree
+        max_sep = catalog['Association_Radius'][source_index] + other_catalog['Radius']
+        for other_index in np.nonzero(sep < max_sep)[0]:
+            idx.append(source_index)
+            other_idx.append(other_index)
+            separation.append(sep[other_index])
+
+    assert len(result) > 0
+    assert_equal(result['Source_Index'], idx)
+    assert_equal(result['Association_Index'], other_idx)
+    assert_allclose(result['Separation'], separation)
+    assert result['Association_Catalog'][0] == 'other'
+    assert result['Association_Name'][0] == other_catalog['Source_Name'][other_idx[0]]
+
+    result = catalog_xmatch_circle(catalog, other_catalog, radius=Angle(0, 'deg'))
+    assert len(result) == 0
+
+
 def test_catalog_xmatch_combine():
     # TODO: implement tests
     assert True
 
 
+def _make_table_xmatch_tables():
+    random_state = np.random.RandomState(seed=0)
+    tables = []
+    for size in [30, 40]:
+        table = Table()
+        table['RAJ2000'] = random_state.uniform(0, 10, size)
+        table['DEJ2000'] = random_state.uniform(-5, 5, size)
+        table['Flux'] = random_state.uniform(1, 10, size)
+        tables.append(table)
+    return tables
+
+
 def test_table_xmatch():
-    # TODO: implement tests
-    assert True
+    table1, table2 = _make_table_xmatch_tables()
+
+    def xmatch_flux(row1, row2):
+        return abs(row1['Flux'] - row2['Flux']) < 0.5
+
+    matches = table_xmatch(table1, table2, xmatch_flux)
+    criterion = table_xmatch_column_criterion('Flux', max_difference=0.5)
+    matches_vectorized = table_xmatch(table1, table2, criterion, block_size=100)
+
+    flux_diff = np.abs(table1['Flux'][:, np.newaxis] - table2['Flux'])
+    idx1, idx2 = np.nonzero(flux_diff < 0.5)
+    assert_equal(matches['idx1'], idx1)
+    assert_equal(matches['idx2'], idx2)
+    assert_equal(matches_vectorized['idx1'], idx1)
+    assert_equal(matches_vectorized['idx2'], idx2)
+
+    table = table_xmatch(table1, table2, criterion, return_indices=False)
+    assert len(table) == len(idx1)
+    assert_allclose(table['Flux_1'], table1['Flux'][idx1])
+    assert_allclose(table['Flux_2'], table2['Flux'][idx2])
+
+
+@pytest.mark.skipif('not HAS_SCIPY')
+def test_table_xmatch_sky():
+    table1, table2 = _make_table_xmatch_tables()
+    max_separation = Angle(1, 'deg')
+    criteria = [table_xmatch_circle_criterion(max_separation),
+                table_xmatch_column_criterion('Flux', max_ratio=2)]
+    matches_all = table_xmatch(table1, table2, criteria)
+    matches = table_xmatch(table1, table2, criteria, max_separation=max_separation)
+    assert len(matches) > 0
+    assert_equal(matches['idx1'], matches_all['idx1'])
+    assert_equal(matches['idx2'], matches_all['idx2'])
+
+    separation = skycoord_from_table(table1[matches['idx1']]).separation(
+        skycoord_from_table(table2[matches['idx2']]))
+    assert (separation < max_separation).all()
+    ratio = table1['Flux'][matches['idx1']] / table2['Flux'][matches['idx2']]
+    assert ((ratio <= 2) & (ratio >= 0.5)).all()
@@ -2,6 +2,8 @@
 """Catalog utility functions / classes."""
 from __future__ import (absolute_import, division, print_function,
                         unicode_literals)
+import weakref
+from collections import OrderedDict
 import numpy as np
 from astropy.coordinates import Angle, SkyCoord
 
@@ -236,6 +238,30 @@ def _dec_iau_format_scalar(dec, digits):
     return dec_str
 
 
+# Column names and frames of sky positions, in order of preference
+_SKY_COLUMNS = [('RAJ2000', 'DEJ2000', 'icrs'),
+                ('RA', 'DEC', 'icrs'),
+                ('GLON', 'GLAT', 'galactic')]
+
+# Transformed coordinates for `_table_lon_lat`, see `_cached_transform`
+_transform_cache = OrderedDict()
+_TRANSFORM_CACHE_SIZE = 8
+
+
+def _table_sky_columns(table, frame=None):
+    """Names and frame of the sky position columns of a table.
+
+    If ``frame`` is given, columns in that frame are preferred.
+    """
+    available = [_ for _ in _SKY_COLUMNS if set(_[:2]).issubset(table.colnames)]
+    if not available:
+        raise KeyError('No column GLON / GLAT or RA / DEC or RAJ2000 / DEJ2000 found.')
+    for columns in available:
+        if columns[2] == frame:
+            return columns
+    return available[0]
+
+
 def skycoord_from_table(table):
     """Make `~astropy.coordinates.SkyCoord` from lon, lat columns in `~astropy.table.Table`.
 
@@ -245,15 +271,7 @@ def skycoord_from_table(table):
     TODO: I'm not sure if it's a good idea to use this because it's not always clear
     which positions are taken.
     """
-
-    if set(['RAJ2000', 'DEJ2000']).issubset(table.colnames):
-        lon, lat, frame = 'RAJ2000', 'DEJ2000', 'icrs'
-    elif set(['RA', 'DEC']).issubset(table.colnames):
-        lon, lat, frame = 'RA', 'DEC', 'icrs'
-    elif set(['GLON', 'GLAT']).issubset(table.colnames):
-        lon, lat, frame = 'GLON', 'GLAT', 'galactic'
-    else:
-        raise KeyError('No column GLON / GLAT or RA / DEC or RAJ2000 / DEJ2000 found.')
+    lon, lat, frame = _table_sky_columns(table)
 
     unit = table[lon].unit if table[lon].unit else 'deg'
 
@@ -262,14 +280,95 @@ def skycoord_from_table(table):
     return skycoord
 
 
-def select_sky_box(table, lon_lim, lat_lim, frame='icrs', inverted=False):
+def _column_degree(column):
+    """Column values in degree (`~numpy.ndarray`)."""
+    unit = column.unit if column.unit else 'deg'
+    return Angle(np.asarray(column), unit).degree
+
+
+def _cached_transform(table, columns, frame):
+    """Table positions transformed to ``frame``, cached per table.
+
+    The cache entry is re-used as long as the table is alive and the
+    position columns are the same objects with the same length.
+    Changes to column values in place are not detected.
+    The cache only holds weak references to the table and its columns,
+    entries are removed when the table is deleted.
+    """
+    lon_name, lat_name, table_frame = columns
+    key = (id(table), lon_name, frame)
+    lon_column, lat_column = table[lon_name], table[lat_name]
+
+    entry = _transform_cache.get(key)
+    if entry is not None:
+        table_ref, lon_ref, lat_ref, lon, lat = entry
+        if (table_ref() is table and len(lon) == len(table) and
+                lon_ref() is lon_column and lat_ref() is lat_column):
+            return lon, lat
+
+    skycoord = SkyCoord(_column_degree(lon_column), _column_degree(lat_column),
+                        unit='deg', frame=table_frame)
+    skycoord = skycoord.transform_to(frame)
+    lon = skycoord.spherical.lon.degree
+    lat = skycoord.spherical.lat.degree
+
+    def remove_entry(table_ref):
+        entry = _transform_cache.get(key)
+        if entry is not None and entry[0] is table_ref:
+            del _transform_cache[key]
+
+    _transform_cache.pop(key, None)
+    _transform_cache[key] = (weakref.ref(table, remove_entry), weakref.ref(lon_column),
+                             weakref.ref(lat_column), lon, lat)
+    while len(_transform_cache) > _TRANSFORM_CACHE_SIZE:
+        _transform_cache.popitem(last=False)
+    return lon, lat
+
+
+def _table_lon_lat(table, frame):
+    """Sky positions in ``frame`` in degree.
+
+    If the table has position columns in ``frame``, they are used directly,
+    otherwise the transformed positions are computed (and cached).
+
+    Returns
+    -------
+    lon, lat : `~numpy.ndarray`
+        Longitude in the range ``[0, 360)`` and latitude in degree.
+    """
+    columns = _table_sky_columns(table, frame)
+    if columns[2] == frame:
+        lon = _column_degree(table[columns[0]]) % 360
+        lat = _column_degree(table[columns[1]])
+        return lon, lat
+    return _cached_transform(table, columns, frame)
+
+
+def _select(table, mask, inverted, output):
+    """Apply or return selection mask."""
+    if inverted:
+        mask = np.invert(mask)
+
+    if output == 'table':
+        return table[mask]
+    elif output == 'mask':
+        return mask
+    elif output == 'indices':
+        return np.flatnonzero(mask)
+    else:
+        raise ValueError('Invalid output: {0}'.format(output))
+
+
+def select_sky_box(table, lon_lim, lat_lim, frame='icrs', inverted=False,
+                   output='table'):
     """Select sky positions in a box.
 
     This function can be applied e.g. to event lists of source catalogs
     or observation tables.
 
-    Note: if useful we can add a function that returns the mask
-    or indices instead of applying the selection directly
+    If the table has position columns in the requested ``frame``
+    (e.g. GLON / GLAT for ``frame='galactic'``) they are used directly,
+    otherwise positions are transformed once and cached for the table.
 
     Parameters
     ----------
@@ -283,11 +382,14 @@ def select_sky_box(table, lon_lim, lat_lim, frame='icrs', inverted=False):
         'icrs', 'fk5' or 'galactic'.
     inverted : bool, optional
         Invert selection: keep all entries outside the selected region.
+    output : {'table', 'mask', 'indices'}
+        Return the selected rows (copy of the table),
+        the selection mask or the selected row indices.
 
     Returns
     -------
     table : `~astropy.table.Table`
-        Copy of input table with box cut applied.
+        Copy of input table with box cut applied (or mask / indices).
 
     Examples
     --------
@@ -296,33 +398,33 @@ def select_sky_box(table, lon_lim, lat_lim, frame='icrs', inverted=False):
     ...                                     lat_lim=Angle([-50, 0], 'degree'),
     ...                                     frame='icrs')
     """
-    skycoord = skycoord_from_table(table)
-    skycoord = skycoord.transform_to(frame)
-    lon = skycoord.data.lon
-    lat = skycoord.data.lat
-    # SkyCoord automatically wraps lon angles at 360 deg, so in case
-    # the lon range is wrapped at 180 deg, lon angles must be wrapped
+    lon, lat = _table_lon_lat(table, frame)
+    lon_lim = Angle(lon_lim).degree
+    lat_lim = Angle(lat_lim).degree
+    # Longitudes are in the range [0, 360), in case the lon range
+    # is wrapped at 180 deg, lon angles must be wrapped
     # also at 180 deg for the comparison to work
-    if any(l < Angle(0., 'degree') for l in lon_lim):
-        lon = lon.wrap_at(Angle(180, 'degree'))
+    if any(l < 0 for l in lon_lim):
+        lon = np.where(lon >= 180, lon - 360, lon)
 
     lon_mask = (lon_lim[0] <= lon) & (lon < lon_lim[1])
     lat_mask = (lat_lim[0] <= lat) & (lat < lat_lim[1])
     mask = lon_mask & lat_mask
-    if inverted:
-        mask = np.invert(mask)
 
-    return table[mask]
+    return _select(table, mask, inverted, output)
 
 
-def select_sky_circle(table, lon_cen, lat_cen, radius, frame='icrs', inverted=False):
+def select_sky_circle(table, lon_cen, lat_cen, radius, frame='icrs', inverted=False,
+                      output='table'):
     """Select sky positions in a circle.
 
     This function can be applied e.g. to event lists of source catalogs
     or observation tables.
 
-    Note: if useful we can add a function that returns the mask
-    or indices instead of applying the selection directly
+    If the table has position columns in the requested ``frame``
+    (e.g. GLON / GLAT for ``frame='galactic'``) they are used directly,
+    otherwise positions are transformed once and cached for the table.
+    Separations are computed with the haversine formula.
 
     Parameters
     ----------
@@ -338,11 +440,14 @@ def select_sky_circle(table, lon_cen, lat_cen, radius, frame='icrs', inverted=Fa
         'icrs', 'fk5' or 'galactic'.
     inverted : bool, optional
         Invert selection: keep all entries outside the selected region.
+    output : {'table', 'mask', 'indices'}
+        Return the selected rows (copy of the table),
+        the selection mask or the selected row indices.
 
     Returns
     -------
     table : `~astropy.table.Table`
-        Copy of input table with circle cut applied.
+        Copy of input table with circle cut applied (or mask / indices).
 
     Examples
     --------
@@ -352,18 +457,19 @@ def select_sky_circle(table, lon_cen, lat_cen, radius, frame='icrs', inverted=Fa
     ...                                        radius=Angle(5, 'degree'),
     ...                                        frame='galactic')
     """
-    skycoord = skycoord_from_table(table)
-    skycoord = skycoord.transform_to(frame)
-    # no need to wrap lon angleshere, since the SkyCoord separation
-    # method takes care of it
-    center = SkyCoord(lon_cen, lat_cen, frame=frame)
-    ang_distance = skycoord.separation(center)
+    lon, lat = _table_lon_lat(table, frame)
+    lon, lat = np.radians(lon), np.radians(lat)
+    lon_cen = Angle(lon_cen).radian
+    lat_cen = Angle(lat_cen).radian
 
-    mask = ang_distance < radius
-    if inverted:
-        mask = np.invert(mask)
+    # Haversine formula, no need to wrap lon angles here
+    hav = (np.sin(0.5 * (lat - lat_cen)) ** 2 +
+           np.cos(lat) * np.cos(lat_cen) * np.sin(0.5 * (lon - lon_cen)) ** 2)
+    ang_distance = 2 * np.arcsin(np.sqrt(np.clip(hav, 0, 1)))
+
+    mask = ang_distance < Angle(radius).radian
 
-    return table[mask]
+    return _select(table, mask, inverted, output)
 
 
 def get_source_by_name(source, catalog, id_column='Source_Name'):
@@ -3,7 +3,6 @@ from __future__ import (absolute_import, division, print_function,
                         unicode_literals)
 import logging
 log = logging.getLogger(__name__)
-from collections import OrderedDict
 import numpy as np
 from astropy.extern import six
 from astropy.coordinates import Angle
@@ -16,16 +15,72 @@ from .utils import skycoord_from_table
 __all__ = ['catalog_xmatch_circle',
            'catalog_xmatch_combine',
            'table_xmatch_circle_criterion',
+           'table_xmatch_column_criterion',
            'table_xmatch',
            ]
 
 
+def _angle_column(table, name):
+    """Table column as `~astropy.coordinates.Angle` (in deg if without unit)."""
+    column = table[name]
+    unit = column.unit if column.unit else 'deg'
+    return Angle(np.asarray(column), unit)
+
+
+def _unit_vectors(skycoord):
+    """Cartesian unit vectors, array of shape ``(n, 3)``."""
+    lon = skycoord.spherical.lon.radian
+    lat = skycoord.spherical.lat.radian
+    return np.column_stack([np.cos(lat) * np.cos(lon),
+                            np.cos(lat) * np.sin(lon),
+                            np.sin(lat)])
+
+
+def _angular_separation(xyz1, xyz2):
+    """Angle between unit vectors in radian (numerically stable for all angles)."""
+    cross = np.cross(xyz1, xyz2)
+    return np.arctan2(np.sqrt((cross ** 2).sum(axis=-1)), (xyz1 * xyz2).sum(axis=-1))
+
+
+def _xmatch_pairs(xyz, other_xyz, max_separation):
+    """Index pairs with a separation of at most ``max_separation``.
+
+    Uses a k-d tree on the unit vectors of ``other_xyz``.
+
+    Parameters
+    ----------
+    xyz, other_xyz : `~numpy.ndarray`
+        Unit vectors, shape ``(n, 3)`` and ``(m, 3)``
+    max_separation : float
+        Maximum separation (radian)
+
+    Returns
+    -------
+    idx, other_idx : `~numpy.ndarray`
+        Candidate index pairs, sorted by ``idx``, then ``other_idx``
+    """
+    from scipy.spatial import cKDTree
+    if len(xyz) == 0 or len(other_xyz) == 0:
+        return np.zeros(0, dtype=int), np.zeros(0, dtype=int)
+
+    # Chord length for the maximum separation, slightly enlarged for round-off
+    chord = 2 * np.sin(0.5 * min(max_separation, np.pi)) * (1 + 1e-10) + 1e-15
+    tree = cKDTree(other_xyz)
+    neighbours = tree.query_ball_point(xyz, chord)
+    counts = np.array([len(_) for _ in neighbours], dtype=int)
+    idx = np.repeat(np.arange(len(xyz)), counts)
+    other_idx = np.fromiter((_ for __ in neighbours for _ in __),
+                            dtype=int, count=counts.sum())
+    order = np.lexsort((other_idx, idx))
+    return idx[order], other_idx[order]
+
+
 def catalog_xmatch_circle(catalog, other_catalog,
                           radius='Association_Radius',
                           other_radius=Angle(0, 'deg')):
     """Find associations within a circle around each source.
 
-    This is convenience function built on `~astropy.coordinates.SkyCoord.search_around_sky`,
+    This is convenience function similar to `~astropy.coordinates.SkyCoord.search_around_sky`,
     extending it in two ways:
 
     1. Each source can have a different association radius.
@@ -33,6 +88,10 @@ def catalog_xmatch_circle(catalog, other_catalog,
 
     Sources are associated if the sum of their radii is smaller than their separation on the sky.
 
+    A k-d tree (`scipy.spatial.cKDTree`) on the unit vectors of the other
+    catalog is queried once with the maximum combined radius, then the
+    per-source radii are applied to the candidate pairs.
+
     Parameters
     ----------
     catalog : `~astropy.table.Table`
@@ -48,42 +107,34 @@ def catalog_xmatch_circle(catalog, other_catalog,
     associations : `~astropy.table.Table`
         The list of associations.
     """
-    if isinstance(radius, six.text_type):
-        radius = Angle(catalog[radius])
+    if isinstance(radius, six.string_types):
+        radius = _angle_column(catalog, radius)
+
+    if isinstance(other_radius, six.string_types):
+        other_radius = _angle_column(other_catalog, other_radius)
 
-    if isinstance(other_radius, six.text_type):
-        other_radius = Angle(other_catalog[other_radius])
+    radius = Angle(radius).radian * np.ones(len(catalog))
+    other_radius = Angle(other_radius).radian * np.ones(len(other_catalog))
 
     skycoord = skycoord_from_table(catalog)
-    other_skycoord = skycoord_from_table(other_catalog)
+    other_skycoord = skycoord_from_table(other_catalog).transform_to(skycoord.frame)
+    xyz = _unit_vectors(skycoord)
+    other_xyz = _unit_vectors(other_skycoord)
 
     association_catalog_name = other_catalog.meta.get('name', 'N/A')
 
-    # Compute associations as list of dict and store in `Table` at the end
-    associations = []
-    for source_index in range(len(catalog)):
-        # TODO: check if this is slower or faster than calling `SkyCoord.search_around_sky` here!?
-
-        separation = skycoord[source_index].separation(other_skycoord)
-        max_separation = radius[source_index] + other_radius
-        other_indices = np.nonzero(separation < max_separation)[0]
-
-        for other_index in other_indices:
-            association = OrderedDict(
-                Source_Index=source_index,
-                Source_Name=catalog['Source_Name'][source_index],
-                Association_Index=other_index,
-                Association_Name=other_catalog['Source_Name'][other_index],
-                Association_Catalog=association_catalog_name,
-                # There's an issue with scalar `Quantity` objects to init the `Table`
-                # https://github.com/astropy/astropy/issues/3378
-                # For now I'll just store the values without unit
-                Separation=separation[other_index].degree,
-            )
-            associations.append(association)
+    max_separation = 0
+    if len(radius) and len(other_radius):
+        max_separation = radius.max() + other_radius.max()
+    idx, other_idx = _xmatch_pairs(xyz, other_xyz, max_separation)
+
+    # Apply the per-pair association radius
+    separation = _angular_separation(xyz[idx], other_xyz[other_idx])
+    mask = separation < radius[idx] + other_radius[other_idx]
+    idx, other_idx, separation = idx[mask], other_idx[mask], separation[mask]
 
     # Need to define columns if there's not a single association
-    if len(associations) == 0:
+    if len(idx) == 0:
         log.debug('No associations found.')
         table = Table()
         table.add_column(Column([], name='Source_Index', dtype=int))
@@ -93,8 +144,15 @@ def catalog_xmatch_circle(catalog, other_catalog,
         table.add_column(Column([], name='Association_Catalog', dtype=str))
         table.add_column(Column([], name='Separation', dtype=float))
     else:
-        log.debug('Found {} associations.'.format(len(associations)))
-        table = Table(associations, names=associations[0].keys())
+        log.debug('Found {} associations.'.format(len(idx)))
+        table = Table()
+        table['Source_Index'] = idx
+        table['Source_Name'] = np.asarray(catalog['Source_Name'])[idx]
+        table['Association_Index'] = other_idx
+        table['Association_Name'] = np.asarray(other_catalog['Source_Name'])[other_idx]
+        table['Association_Catalog'] = [association_catalog_name] * len(idx)
+        # For now the separation is stored in deg without unit
+        table['Separation'] = np.degrees(separation)
 
     return table
 
@@ -102,7 +160,8 @@ def catalog_xmatch_circle(catalog, other_catalog,
 def table_xmatch_circle_criterion(max_separation):
     """An example cross-match criterion for `table_xmatch` that reproduces `catalog_xmatch_circle`.
 
-    TODO: finish implementing this and test it.
+    The criterion is vectorized, i.e. it is evaluated for many row pairs
+    at once (see `table_xmatch`).
 
     Parameters
     ----------
@@ -114,57 +173,185 @@ def table_xmatch_circle_criterion(max_separation):
     xmatch : function
         Cross-match function to be passed to `table_xmatch`.
     """
-    def xmatch(row1, row2):
-        skycoord1 = SkyCoord(row1['RAJ2000'], row1['DEJ2000'], unit='deg')
-        skycoord2 = SkyCoord(row2['RAJ2000'], row2['DEJ2000'], unit='deg')
-        separation = skycoord1.separation(skycoord2)
-        if separation < max_separation:
-            return True
-        else:
-            return False
+    max_separation = Angle(max_separation).radian
+
+    def xmatch(rows1, rows2):
+        skycoord1 = SkyCoord(rows1['RAJ2000'], rows1['DEJ2000'], unit='deg')
+        skycoord2 = SkyCoord(rows2['RAJ2000'], rows2['DEJ2000'], unit='deg')
+        separation = _angular_separation(_unit_vectors(skycoord1),
+                                         _unit_vectors(skycoord2))
+        return separation < max_separation
 
+    xmatch.vectorized = True
     return xmatch
 
 
-def table_xmatch(table1, table2, xmatch_criterion, return_indices=True):
+def table_xmatch_column_criterion(name1, name2=None, max_difference=None,
+                                  max_ratio=None):
+    """Cross-match criterion for `table_xmatch` comparing column values.
+
+    Rows match if the values differ by at most ``max_difference`` and / or
+    their ratio is at most ``max_ratio`` (in either direction).
+    The criterion is vectorized (see `table_xmatch`).
+
+    Parameters
+    ----------
+    name1, name2 : str
+        Column names in the two tables (``name2`` defaults to ``name1``).
+    max_difference : float, optional
+        Maximum absolute difference
+    max_ratio : float, optional
+        Maximum ratio
+
+    Returns
+    -------
+    xmatch : function
+        Cross-match function to be passed to `table_xmatch`.
+
+    Examples
+    --------
+    Match sources within 0.1 deg and with fluxes within a factor of two::
+
+        from gammapy.catalog import (table_xmatch, table_xmatch_circle_criterion,
+                                     table_xmatch_column_criterion)
+        criteria = [table_xmatch_circle_criterion(Angle(0.1, 'deg')),
+                    table_xmatch_column_criterion('Flux', max_ratio=2)]
+        matches = table_xmatch(table1, table2, criteria, max_separation=Angle(0.1, 'deg'))
+    """
+    name2 = name1 if name2 is None else name2
+
+    def xmatch(rows1, rows2):
+        values1 = np.asarray(rows1[name1], dtype=float)
+        values2 = np.asarray(rows2[name2], dtype=float)
+        mask = np.ones(values1.shape, dtype=bool)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            if max_difference is not None:
+                mask &= np.abs(values1 - values2) <= max_difference
+            if max_ratio is not None:
+                ratio = values1 / values2
+                mask &= (ratio <= max_ratio) & (ratio >= 1. / max_ratio)
+        return mask
+
+    xmatch.vectorized = True
+    return xmatch
+
+
+class _IndexedRows(object):
+    """Column access for selected table rows.
+
+    Columns are only indexed when accessed, so criteria that use
+    few columns of wide tables are cheap.
+    """
+
+    def __init__(self, table, index):
+        self.table = table
+        self.index = index
+        self._columns = dict()
+
+    def __getitem__(self, name):
+        if name not in self._columns:
+            self._columns[name] = self.table[name][self.index]
+        return self._columns[name]
+
+    def __len__(self):
+        return len(self.index)
+
+    @property
+    def colnames(self):
+        return self.table.colnames
+
+
+def _table_xmatch_pairs(table1, table2, max_separation, block_size):
+    """Candidate index pairs, in blocks of about ``block_size`` pairs."""
+    if max_separation is not None:
+        skycoord1 = skycoord_from_table(table1)
+        skycoord2 = skycoord_from_table(table2).transform_to(skycoord1.frame)
+        idx1, idx2 = _xmatch_pairs(_unit_vectors(skycoord1),
+                                   _unit_vectors(skycoord2),
+                                   Angle(max_separation).radian)
+        for lo in range(0, len(idx1), block_size):
+            yield idx1[lo:lo + block_size], idx2[lo:lo + block_size]
+    else:
+        n1, n2 = len(table1), len(table2)
+        n_rows = max(1, block_size // max(n2, 1))
+        for lo in range(0, n1, n_rows):
+            hi = min(lo + n_rows, n1)
+            idx1 = np.repeat(np.arange(lo, hi), n2)
+            idx2 = np.tile(np.arange(n2), hi - lo)
+            yield idx1, idx2
+
+
+def table_xmatch(table1, table2, xmatch_criterion, return_indices=True,
+                 max_separation=None, block_size=2 ** 20):
     """Cross-match rows from two tables with a cross-match criterion callback.
 
-    Note: This is a very flexible and simple way to find matching
-    rows from two tables, but it can be very slow, e.g. if you
+    Criteria can be vectorized: if a callable has an attribute
+    ``vectorized = True``, it is called as ``xmatch_criterion(rows1, rows2)``
+    with column-wise access to many candidate row pairs at once
+    (``rows1['GLON']`` is an array with one entry per pair) and must return
+    a boolean array. This is fast also for tables with 10^4 - 10^5 rows.
+    Otherwise it is called with two `~astropy.table.Row` objects and must return
+    `True` / `False`. This is very flexible, but slow, e.g. if you
     create `~astropy.coordinates.SkyCoord` objects or index into them
     in the callback cross-match criterion function:
     https://github.com/astropy/astropy/issues/3323#issuecomment-71657245
 
+    Candidate pairs are all row pairs (processed in blocks of ``block_size``
+    pairs), or, if ``max_separation`` is given, the pairs within that
+    separation on the sky, found with a k-d tree.
+
     Parameters
     ----------
     table1, table2 : `~astropy.table.Table`
         Input tables
-    xmatch_criterion : callable
-        Callable that takes two `~astropy.table.Row` objects as input
-        and returns `True` / `False` when they match / don't match.
+    xmatch_criterion : callable or list of callable
+        Cross-match criterion. For a list, rows match if all criteria match;
+        criteria are evaluated in order, each on the pairs that passed the
+        previous ones.
     return_indices : bool
         If `True` this function returns a Table with match indices
         `idx1` and `idx2`, if `False` it stacks the matches in a table using
         `~astropy.table.hstack`.
+    max_separation : `~astropy.coordinates.Angle`, optional
+        Only consider row pairs within this separation on the sky
+        (positions from `skycoord_from_table`).
+    block_size : int
+        Number of candidate pairs evaluated at once
 
     Returns
     -------
     matches : `~astropy.table.Table`
         Match table (one match per row)
     """
-    matches = Table(names=['idx1', 'idx2'], dtype=[int, int])
-    for row1 in table1:
-        for row2 in table2:
-            if xmatch_criterion(row1, row2):
-                matches.add_row([row1.index, row2.index])
-
+    if callable(xmatch_criterion):
+        criteria = [xmatch_criterion]
+    else:
+        criteria = list(xmatch_criterion)
+
+    matches1, matches2 = [np.zeros(0, dtype=int)], [np.zeros(0, dtype=int)]
+    for idx1, idx2 in _table_xmatch_pairs(table1, table2, max_separation, block_size):
+        for criterion in criteria:
+            if len(idx1) == 0:
+                break
+            if getattr(criterion, 'vectorized', False):
+                mask = criterion(_IndexedRows(table1, idx1), _IndexedRows(table2, idx2))
+                mask = np.asarray(mask, dtype=bool)
+            else:
+                mask = np.array([bool(criterion(table1[i1], table2[i2]))
+                                 for i1, i2 in zip(idx1, idx2)], dtype=bool)
+            idx1, idx2 = idx1[mask], idx2[mask]
+        matches1.append(idx1)
+        matches2.append(idx2)
+
+    idx1, idx2 = np.concatenate(matches1), np.concatenate(matches2)
+    matches = Table([idx1, idx2], names=['idx1', 'idx2'])
 
     if return_indices == True:
         return matches
     else:
-        raise NotImplementedError
-        # TODO: need to sub-set table1 and table1 using the matches
-        table = table_hstack([matches, table1, table2])
+        # Columns with the same name get suffixes ``_1`` and ``_2``
+        rows = table_hstack([table1[idx1], table2[idx2]], table_names=['1', '2'])
+        table = table_hstack([matches, rows])
         return table
 
 
@@ -20,8 +20,8 @@ from ..spectrum import (EnergyBounds,
                         LogEnergyAxis,
                         powerlaw
                         )
-from ..image import coordinates, cube_to_image, solid_angle
 from ..utils.fits import table_to_fits_table
+from ..utils.wcs import geometry_cache
 
 
 __all__ = [
@@ -219,21 +219,18 @@ class SpectralCube(object):
         Returns two separate objects for the arrays of longitude
         and latitude pixel coordinates.
         """
-        n_lon = self.data.shape[2]
-        n_lat = self.data.shape[1]
-        i_lat, i_lon = np.indices((n_lat, n_lon))
-        lon, lat, _ = self.pix2world(i_lon, i_lat, 0)
+        shape = self.data.shape[1:]
+        lon, lat = geometry_cache.coordinates(self.wcs.sub([1, 2]), shape)
 
-        return lon, lat
+        return Quantity(lon, 'deg'), Quantity(lat, 'deg')
 
     @property
     def solid_angle_image(self):
         """Solid angle image in steradian (`~astropy.units.Quantity`)"""
-        cube_hdu = fits.ImageHDU(self.data, self.wcs.to_header())
-        image_hdu = cube_to_image(cube_hdu)
-        image_hdu.header['WCSAXES'] = 2
+        shape = self.data.shape[1:]
+        area = geometry_cache.solid_angle(self.wcs.sub([1, 2]), shape)
 
-        return solid_angle(image_hdu).to('sr')
+        return Quantity(area, 'sr')
 
     def flux(self, lon, lat, energy):
         """Differential flux.
@@ -5,3 +5,4 @@ from .load import *
 from .make import *
 from .catalogs import *
 from .fermi import *
+from .simulate import *
@@ -9,14 +9,13 @@ import numpy as np
 from astropy.units import Quantity
 from astropy.time import Time, TimeDelta
 from astropy.coordinates import SkyCoord, AltAz, FK5, Angle
-from astropy.table import Table
+from astropy.io import fits
 from ..irf import EnergyDependentMultiGaussPSF
 from ..obs import ObservationTable, observatory_locations, DataStore
 from ..utils.random import sample_sphere, get_random_state
 from ..time import time_ref_from_dict, time_relative_to_ref
 from ..background import Cube
 from ..data import EventList
-from ..utils.fits import table_to_fits_table
 
 __all__ = ['make_test_psf',
            'make_test_observation_table',
@@ -393,7 +392,8 @@ def make_test_bg_cube_model(detx_range=Angle([-10., 10.], 'degree'),
 def make_test_dataset(fits_path, overwrite=False,
                       observatory_name='HESS', n_obs=10,
                       datestart=None, dateend=None,
-                      random_state='random-seed'):
+                      random_state='random-seed',
+                      update=False, parallel=False, processes=None):
     """
     Make a test dataset and save it to disk.
 
@@ -411,6 +411,13 @@ def make_test_dataset(fits_path, overwrite=False,
     This method is useful for instance to produce samples in order
     to test the machinery for reconstructing background (cube) models.
 
+    Each observation is simulated with its own random number generator,
+    seeded with a seed drawn from ``random_state`` after the observation
+    table. The seed is stored in the ``SEED`` header keyword of the event
+    list. Hence the dataset doesn't depend on ``parallel`` or ``processes``,
+    and with ``update=True`` only missing or outdated files are
+    simulated again.
+
     See also :ref:`datasets_make_datasets_for_testing`.
 
     Parameters
@@ -431,6 +438,20 @@ def make_test_dataset(fits_path, overwrite=False,
     random_state : {int, 'random-seed', 'global-rng', `~numpy.random.RandomState`}, optional
         Defines random number generator initialisation.
         Passed to `~gammapy.utils.random.get_random_state`.
+        Use a fixed seed for ``update=True``.
+    update : bool, optional
+        Keep an existing dataset in fits_path and only simulate
+        observations where files are missing or were simulated with
+        a different seed.
+    parallel : bool, optional
+        Simulate observations in parallel with a `multiprocessing.Pool`?
+    processes : int, optional
+        Number of processes for ``parallel=True``, default: number of CPUs.
+
+    Returns
+    -------
+    obs_ids : list
+        IDs of the observations that were simulated.
     """
     random_state = get_random_state(random_state)
 
@@ -443,7 +464,7 @@ def make_test_dataset(fits_path, overwrite=False,
             # delete and create again
             shutil.rmtree(outdir) # recursively
             os.mkdir(outdir)
-        else:
+        elif not update:
             # do not overwrite, hence exit
             s_error = "Cannot continue: directory \'{}\' exists.".format(outdir)
             raise RuntimeError(s_error)
@@ -454,10 +475,12 @@ def make_test_dataset(fits_path, overwrite=False,
                                                     datestart=datestart, dateend=dateend,
                                                     use_abs_time=False,
                                                     random_state=random_state)
+    # one seed per observation
+    seeds = random_state.randint(0, 2 ** 31 - 1, size=len(observation_table))
 
     # save observation list to disk
     outfile = outdir + '/runinfo.fits'
-    observation_table.write(outfile)
+    observation_table.write(outfile, overwrite=True)
 
     # create data store for the organization of the files
     # using H.E.S.S.-like dir/file naming scheme
@@ -470,19 +493,146 @@ def make_test_dataset(fits_path, overwrite=False,
 
     data_store = DataStore(dir=fits_path, scheme=scheme)
 
-    # loop over observations
-    for obs_id in observation_table['OBS_ID']:
-        event_list, aeff_hdu = make_test_eventlist(observation_table=observation_table,
-                                                   obs_id=obs_id,
-                                                   random_state=random_state)
+    alt = Angle(observation_table['ALT']).degree
+    livetime = Quantity(observation_table['TIME_LIVE']).to('second').value
+
+    tasks = []
+    for obs_id, alt_, livetime_, seed in zip(observation_table['OBS_ID'],
+                                             alt, livetime, seeds):
+        events_file = data_store.filename(obs_id, filetype='events')
+        aeff_file = data_store.filename(obs_id, filetype='effective area')
+        if update and _test_run_is_current(events_file, aeff_file, seed):
+            continue
+
+        # create the run dirs here, not in parallel in the workers
+        for filename in [events_file, aeff_file]:
+            dirname = os.path.dirname(filename)
+            if not os.path.isdir(dirname):
+                os.makedirs(dirname) # recursively
+        tasks.append((int(obs_id), alt_, livetime_, int(seed),
+                      events_file, aeff_file))
+
+    if parallel and len(tasks) > 1:
+        from multiprocessing import Pool, cpu_count
+        pool = Pool(processes=processes or cpu_count())
+        try:
+            pool.map(_make_test_run_star, tasks)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        for task in tasks:
+            _make_test_run(*task)
+
+    return [task[0] for task in tasks]
+
+
+def _test_run_is_current(events_file, aeff_file, seed):
+    """Were the files of a test run simulated with this seed?"""
+    if not (os.path.isfile(events_file) and os.path.isfile(aeff_file)):
+        return False
+    try:
+        header = fits.getheader(events_file, extname='EVENTS')
+    except (IOError, KeyError):
+        return False
+    return header.get('SEED') == seed
+
+
+def _make_test_run(obs_id, alt, livetime, seed, events_file, aeff_file):
+    """Simulate one observation of the test dataset and write the files.
+
+    The event list is written directly from the arrays, without
+    building an `~gammapy.data.EventList`.
+    """
+    random_state = np.random.RandomState(seed)
+    detx, dety, energy = _make_test_events(alt, livetime,
+                                           random_state=random_state)
+
+    columns = [fits.Column(name='DETX', format='D', unit='deg', array=detx),
+               fits.Column(name='DETY', format='D', unit='deg', array=dety),
+               fits.Column(name='ENERGY', format='D', unit='TeV', array=energy)]
+    hdu = fits.BinTableHDU.from_columns(columns, name='EVENTS')
+    hdu.header['OBS_ID'] = obs_id
+    hdu.header['LIVETIME'] = livetime
+    hdu.header['EUNIT'] = 'TeV'
+    hdu.header['SEED'] = seed
+
+    for filename, hdu_ in [(events_file, hdu), (aeff_file, _make_test_aeff_hdu())]:
+        if os.path.exists(filename):
+            os.remove(filename)
+        fits.HDUList([fits.PrimaryHDU(), hdu_]).writeto(filename)
+
+
+def _make_test_run_star(args):
+    return _make_test_run(*args)
+
+
+def _make_test_events(alt, livetime, sigma=5., spectral_index=2.7,
+                      random_state='random-seed'):
+    """Simulate test events, see `make_test_eventlist`.
+
+    Parameters
+    ----------
+    alt : float
+        Altitude (deg)
+    livetime : float
+        Livetime (s)
+    sigma : float
+        Width of the gaussian model at the maximum energy (deg)
+    spectral_index : float
+        Power-law index
+
+    Returns
+    -------
+    detx, dety, energy : `~numpy.ndarray`
+        Event coordinates (deg) and energies (TeV)
+    """
+    random_state = get_random_state(random_state)
+
+    # number of events to simulate
+    # it is linearly dependent on the livetime, taking as reference
+    # a trigger rate of 300 Hz
+    # it is linearly dependent on the zenith angle (90 deg - altitude)
+    # it is n_events_max at alt = 90 deg and n_events_max/2 at alt = 0 deg
+    n_events_max = 300. * livetime
+    n_events = int(n_events_max / 2 * (1 + alt / 90.))
+
+    # simulate energy
+    # the index of `~numpy.random.RandomState.power` has to be
+    # positive defined, so it is necessary to translate the (0, 1)
+    # interval of the random variable to (emax, e_min) in order to
+    # have a decreasing power-law
+    index = spectral_index + 1
+    e_min, e_max = 0.1, 100.
+    energy = (e_min - e_max) * random_state.power(a=index, size=n_events) + e_max
+
+    # define E dependent sigma (reference energy 1 TeV)
+    # it is defined via a PL, in order to be log-linear
+    # it is equal to the parameter sigma at E max
+    # and sigma/2. at E min
+    sigma_min = sigma / 2.
+    s_index = np.log(sigma / sigma_min) / np.log(e_max / e_min)
+    sigma = sigma_min * (energy / e_min) ** s_index
+
+    # simulate detx, dety
+    detx = random_state.normal(loc=0, scale=sigma, size=n_events)
+    dety = random_state.normal(loc=0, scale=sigma, size=n_events)
 
-        # save event list and effective area table to disk
-        outfile = data_store.filename(obs_id, filetype='events')
-        outfile_split = outfile.rsplit("/", 1)
-        os.makedirs(outfile_split[0]) # recursively
-        event_list.write(outfile)
-        outfile = data_store.filename(obs_id, filetype='effective area')
-        aeff_hdu.writeto(outfile)
+    return detx, dety, energy
+
+
+def _make_test_aeff_hdu():
+    """Effective area table for the test dataset."""
+    # fill threshold, for now, a default 100 GeV will be set
+    # independently of observation parameters
+    energy_threshold = Quantity(0.1, 'TeV')
+
+    # the unit is stored in the comment
+    aeff_hdu = fits.BinTableHDU(name='EFFECTIVE AREA')
+    aeff_hdu.header['LO_THRES'] = (energy_threshold.value,
+                                   '[' + str(energy_threshold.unit) + ']')
+
+    return aeff_hdu
 
 
 def make_test_eventlist(observation_table,
@@ -538,8 +688,6 @@ def make_test_eventlist(observation_table,
     aeff_hdu : `~astropy.io.fits.BinTableHDU`
         Effective area table.
     """
-    random_state = get_random_state(random_state)
-
     # find obs row in obs table
     obs_ids = observation_table['OBS_ID'].data
     obs_index = np.where(obs_ids == obs_id)
@@ -549,69 +697,19 @@ def make_test_eventlist(observation_table,
     alt = Angle(observation_table['ALT'])[row]
     livetime = Quantity(observation_table['TIME_LIVE'])[row]
 
-    # number of events to simulate
-    # it is linearly dependent on the livetime, taking as reference
-    # a trigger rate of 300 Hz
-    # it is linearly dependent on the zenith angle (90 deg - altitude)
-    # it is n_events_max at alt = 90 deg and n_events_max/2 at alt = 0 deg
-    n_events_max = Quantity(300., 'Hz')*livetime
-    alt_min = Angle(0., 'degree')
-    alt_max = Angle(90., 'degree')
-    slope = (n_events_max - n_events_max/2)/(alt_max - alt_min)
-    free_term = n_events_max/2 - slope*alt_min
-    n_events = alt*slope + free_term
-
-    # simulate energy
-    # the index of `~numpy.random.RandomState.power` has to be
-    # positive defined, so it is necessary to translate the (0, 1)
-    # interval of the random variable to (emax, e_min) in order to
-    # have a decreasing power-law
-    index = spectral_index + 1
-    e_min = Quantity(0.1, 'TeV')
-    e_max = Quantity(100., 'TeV')
-    energy = Quantity((e_min.value - e_max.value) *
-                      random_state.power(a=index, size=n_events) + e_max.value, 'TeV')
-
-    E_0 = Quantity(1., 'TeV') # reference energy for the model
-
-    # define E dependent sigma
-    # it is defined via a PL, in order to be log-linear
-    # it is equal to the parameter sigma at E max
-    # and sigma/2. at E min
-    sigma_min = sigma/2. # at E min
-    sigma_max = sigma # at E max
-    s_index = np.log(sigma_max/sigma_min)
-    s_index /= np.log(e_max/e_min)
-    s_norm = sigma_min*((e_min/E_0)**-s_index)
-    sigma = s_norm*((energy/E_0)**s_index)
-
-    # simulate detx, dety
-    detx = Angle(random_state.normal(loc=0, scale=sigma.deg, size=n_events),
-                 'degree')
-    dety = Angle(random_state.normal(loc=0, scale=sigma.deg, size=n_events),
-                 'degree')
+    detx, dety, energy = _make_test_events(alt.degree, livetime.to('second').value,
+                                           sigma=sigma.degree,
+                                           spectral_index=spectral_index,
+                                           random_state=random_state)
 
     # fill events in an event list
     event_list = EventList()
-    event_list['DETX'] = detx
-    event_list['DETY'] = dety
-    event_list['ENERGY'] = energy
+    event_list['DETX'] = Angle(detx, 'degree')
+    event_list['DETY'] = Angle(dety, 'degree')
+    event_list['ENERGY'] = Quantity(energy, 'TeV')
 
     # store important info in header
     event_list.meta['LIVETIME'] = livetime.to('second').value
-    event_list.meta['EUNIT'] = str(energy.unit)
-
-    # effective area table
-    aeff_table = Table()
-
-    # fill threshold, for now, a default 100 GeV will be set
-    # independently of observation parameters
-    energy_threshold = Quantity(0.1, 'TeV')
-    aeff_table.meta['LO_THRES'] = energy_threshold.value
-    aeff_table.meta['name'] = 'EFFECTIVE AREA'
-
-    # convert to BinTableHDU and add necessary comment for the units
-    aeff_hdu = table_to_fits_table(aeff_table)
-    aeff_hdu.header.comments['LO_THRES'] = '[' + str(energy_threshold.unit) + ']'
+    event_list.meta['EUNIT'] = 'TeV'
 
-    return event_list, aeff_hdu
+    return event_list, _make_test_aeff_hdu()
@@ -0,0 +1,679 @@
+# Licensed under a 3-clause BSD style license - see LICENSE.rst
+"""Simulate event lists from source and background models and IRFs."""
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+import os
+import numpy as np
+from astropy.units import Quantity
+from astropy.coordinates import SkyCoord, Angle
+from astropy.time import Time
+from astropy.io import fits
+from astropy.wcs import WCS
+from ..utils.random import get_random_state
+from ..utils.distributions import GeneralRandomArray
+from ..utils.fits import table_to_fits_table
+from ..data import EventList, GoodTimeIntervals
+
+__all__ = ['EventSimulator']
+
+FLUX_UNIT = 'cm^-2 s^-1 TeV^-1'
+
+
+def _power_law_integral(e_lo, e_hi, f_lo, f_hi):
+    """Integral and index of the power law through the bin edge values.
+
+    Bins where the function is not positive at both edges are
+    integrated with the trapezoidal rule and get index 0.
+    """
+    positive = (f_lo > 0) & (f_hi > 0)
+    ratio = e_hi / e_lo
+    with np.errstate(divide='ignore', invalid='ignore'):
+        index = np.where(positive, -np.log(f_hi / f_lo) / np.log(ratio), 0)
+        g1 = 1 - index
+        flat = np.abs(g1) < 1e-6
+        g1_safe = np.where(flat, 1, g1)
+        integral = np.where(flat, f_lo * e_lo * np.log(ratio),
+                            f_lo * e_lo / g1_safe * (ratio ** g1_safe - 1))
+    integral = np.where(positive, integral, 0.5 * (f_lo + f_hi) * (e_hi - e_lo))
+    return integral, index
+
+
+def _sample_power_law(e_lo, e_hi, index, u):
+    """Inverse cdf of a power law in the bin ``[e_lo, e_hi]``."""
+    ratio = e_hi / e_lo
+    g1 = 1 - index
+    flat = np.abs(g1) < 1e-6
+    g1_safe = np.where(flat, 1, g1)
+    return np.where(flat, e_lo * ratio ** u,
+                    e_lo * (1 + u * (ratio ** g1_safe - 1)) ** (1 / g1_safe))
+
+
+def _separation(lon1, lat1, lon2, lat2):
+    """Angular separation (haversine formula, radian)."""
+    hav = (np.sin(0.5 * (lat2 - lat1)) ** 2 +
+           np.cos(lat1) * np.cos(lat2) * np.sin(0.5 * (lon2 - lon1)) ** 2)
+    return 2 * np.arcsin(np.sqrt(np.clip(hav, 0, 1)))
+
+
+def _offset_by(lon, lat, position_angle, separation):
+    """Move positions by ``separation`` towards ``position_angle`` (radian)."""
+    sin_lat, cos_lat = np.sin(lat), np.cos(lat)
+    sin_sep, cos_sep = np.sin(separation), np.cos(separation)
+    lat2 = np.arcsin(sin_lat * cos_sep + cos_lat * sin_sep * np.cos(position_angle))
+    lon2 = lon + np.arctan2(np.sin(position_angle) * sin_sep * cos_lat,
+                            cos_sep - sin_lat * np.sin(lat2))
+    return lon2 % (2 * np.pi), lat2
+
+
+def _sky_to_fov(lon, lat, lon0, lat0):
+    """Gnomonic projection around ``(lon0, lat0)`` (radian)."""
+    dlon = lon - lon0
+    cos_c = np.sin(lat0) * np.sin(lat) + np.cos(lat0) * np.cos(lat) * np.cos(dlon)
+    x = np.cos(lat) * np.sin(dlon) / cos_c
+    y = (np.cos(lat0) * np.sin(lat) - np.sin(lat0) * np.cos(lat) * np.cos(dlon)) / cos_c
+    return x, y
+
+
+def _fov_to_sky(x, y, lon0, lat0):
+    """Inverse of `_sky_to_fov` (radian)."""
+    rho = np.hypot(x, y)
+    c = np.arctan(rho)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        lat = np.arcsin(np.cos(c) * np.sin(lat0) +
+                        np.where(rho > 0, y * np.sin(c) * np.cos(lat0) / rho, 0))
+    lon = lon0 + np.arctan2(x * np.sin(c),
+                            rho * np.cos(lat0) * np.cos(c) - y * np.sin(lat0) * np.sin(c))
+    return lon % (2 * np.pi), lat
+
+
+def _nearest_index(nodes, values):
+    """Index of the nearest node (nodes sorted in increasing order)."""
+    nodes = np.asarray(nodes)
+    return np.searchsorted(0.5 * (nodes[1:] + nodes[:-1]), values)
+
+
+def _differential_flux(spectral_model, energy):
+    """Evaluate spectral model (in cm^-2 s^-1 TeV^-1) at energies in TeV."""
+    flux = spectral_model(Quantity(energy, 'TeV'))
+    if isinstance(flux, Quantity):
+        flux = flux.to(FLUX_UNIT).value
+    return np.asarray(flux, dtype=float)
+
+
+def _pixel_to_icrs(wcs, x, y):
+    """Pixel coordinates to ICRS RA / DEC (radian)."""
+    lon, lat = wcs.wcs_pix2world(x, y, 0)
+    if wcs.wcs.ctype[0].startswith('GLON'):
+        icrs = SkyCoord(lon, lat, unit='deg', frame='galactic').icrs
+        lon, lat = icrs.ra.deg, icrs.dec.deg
+    return np.radians(lon), np.radians(lat)
+
+
+class _SourceComponent(object):
+    """Sampler for the true photon directions and energies of one source.
+
+    Photons are proposed from the source model times the maximum
+    effective area per energy bin and then accepted with probability
+    ``aeff(offset, energy) / aeff_max(energy)`` (thinning), which
+    gives the correct Poisson process including the offset dependence.
+    """
+    mc_id = 1
+
+    def rate(self):
+        """Proposal rate (counts / second)."""
+        return self.rates.sum()
+
+    def _aeff_max(self, simulator, offsets):
+        """Maximum effective area per energy bin for the offset range."""
+        idx = simulator._offset_index(np.array([offsets.min(), offsets.max()]))
+        return simulator._aeff_grid[idx[0]:idx[1] + 1].max(axis=0)
+
+
+class _PointSource(_SourceComponent):
+    """Point source with a spectral model."""
+
+    def __init__(self, simulator, position, spectral_model):
+        icrs = position.icrs
+        self.lon, self.lat = icrs.ra.radian, icrs.dec.radian
+        e_lo, e_hi = simulator._energy_lo, simulator._energy_hi
+        flux = _differential_flux(spectral_model, simulator._energy_edges)
+        integral, self.index = _power_law_integral(e_lo, e_hi, flux[:-1], flux[1:])
+
+        offset = _separation(self.lon, self.lat, simulator._lon_pnt, simulator._lat_pnt)
+        self.aeff_max = self._aeff_max(simulator, np.atleast_1d(offset))
+        self.rates = integral * self.aeff_max
+        self.energy_sampler = GeneralRandomArray(self.rates, method='alias')
+
+    def sample(self, n, random_state):
+        energy_bin = self.energy_sampler.draw(n, return_flat_index=True,
+                                              random_state=random_state)
+        lon = np.repeat(self.lon, n)
+        lat = np.repeat(self.lat, n)
+        return lon, lat, energy_bin, self.index[energy_bin]
+
+
+class _MapSource(_SourceComponent):
+    """Image (separable spectrum) or cube source."""
+
+    def __init__(self, simulator, wcs, data, spectral_model=None, energy=None):
+        self.wcs = wcs
+        self.shape = data.shape[-2:]
+        y, x = np.indices(self.shape)
+        lon, lat = _pixel_to_icrs(wcs, x.ravel(), y.ravel())
+        offset = _separation(lon, lat, simulator._lon_pnt, simulator._lat_pnt)
+        # Include the offsets within the pixels
+        pixel_size = np.radians(np.abs(wcs.wcs.cdelt).max())
+        offset = np.array([offset.min() - pixel_size, offset.max() + pixel_size])
+        self.aeff_max = self._aeff_max(simulator, offset.clip(0))
+
+        e_lo, e_hi = simulator._energy_lo, simulator._energy_hi
+        if data.ndim == 2:
+            # Image: sample energy bins and pixels independently
+            self.cube = False
+            weights = np.where(np.isfinite(data), data, 0).clip(0)
+            flux = _differential_flux(spectral_model, simulator._energy_edges)
+            integral, self.index = _power_law_integral(e_lo, e_hi, flux[:-1], flux[1:])
+            self.rates = integral * self.aeff_max
+            self.energy_sampler = GeneralRandomArray(self.rates, method='alias')
+            self.pixel_weights = (weights / weights.sum()).ravel()
+            self.pixel_sampler = GeneralRandomArray(self.pixel_weights, method='alias')
+        else:
+            # Cube: interpolate (log-log) to the bin edges, sample jointly
+            self.cube = True
+            log_energy = np.log(energy)
+            log_data = np.log(np.where(data > 0, data, 1e-300))
+            edges = np.log(simulator._energy_edges)
+            idx = np.clip(np.searchsorted(log_energy, edges) - 1, 0, len(energy) - 2)
+            w = (edges - log_energy[idx]) / (log_energy[idx + 1] - log_energy[idx])
+            w = w[:, np.newaxis, np.newaxis]
+            flux = np.exp(log_data[idx] * (1 - w) + log_data[idx + 1] * w)
+            flux[~np.isfinite(flux)] = 0
+            flux[flux < 1e-290] = 0
+            solid_angle = _solid_angle(wcs, self.shape)
+            e_lo_, e_hi_ = e_lo[:, None, None], e_hi[:, None, None]
+            integral, index = _power_law_integral(e_lo_, e_hi_, flux[:-1], flux[1:])
+            self.index = index.reshape(len(e_lo), -1)
+            self.rates = integral * solid_angle * self.aeff_max[:, None, None]
+            self.sampler = GeneralRandomArray(self.rates, method='alias')
+
+    def sample(self, n, random_state):
+        n_pix = self.shape[0] * self.shape[1]
+        if self.cube:
+            flat = self.sampler.draw(n, return_flat_index=True, random_state=random_state)
+            energy_bin, pixel = np.divmod(flat, n_pix)
+            index = self.index[energy_bin, pixel]
+        else:
+            energy_bin = self.energy_sampler.draw(n, return_flat_index=True,
+                                                  random_state=random_state)
+            pixel = self.pixel_sampler.draw(n, return_flat_index=True,
+                                            random_state=random_state)
+            index = self.index[energy_bin]
+        y, x = np.unravel_index(pixel, self.shape)
+        x = x + random_state.uniform(-0.5, 0.5, n)
+        y = y + random_state.uniform(-0.5, 0.5, n)
+        lon, lat = _pixel_to_icrs(self.wcs, x, y)
+        return lon, lat, energy_bin, index
+
+
+def _solid_angle(wcs, shape):
+    """Pixel solid angles (sr), from the pixel corners."""
+    y, x = np.indices((shape[0] + 1, shape[1] + 1)) - 0.5
+    lon, lat = wcs.wcs_pix2world(x, y, 0)
+    lon, lat = np.radians(lon), np.radians(lat)
+    # Approximate pixels as spherical rectangles
+    dlat = np.sin(lat[1:, :-1]) - np.sin(lat[:-1, :-1])
+    dlon = np.angle(np.exp(1j * (lon[:-1, 1:] - lon[:-1, :-1])))
+    return np.abs(dlat * dlon)
+
+
+class EventSimulator(object):
+    """Simulate event lists for one observation.
+
+    Source photons are drawn from spectral and spatial models
+    (point sources, images and cubes), folded with the effective area,
+    point spread function and energy dispersion. Background events
+    are drawn from a background cube model. All sampling is vectorised
+    (alias tables for the discrete distributions, inverse cdf of
+    power laws within energy bins).
+
+    The observation is simulated in time slices with at most about
+    ``chunk_size`` events each, so the memory use is bounded and the
+    events are ordered in time. Use `iter_chunks` to process the
+    events chunk by chunk, `write` to stream them into an event list
+    FITS file (EVENTS and GTI extension) or `run` to get them in memory.
+
+    Parameters
+    ----------
+    pointing : `~astropy.coordinates.SkyCoord`
+        Pointing position
+    livetime : `~astropy.units.Quantity`
+        Observation live time (no dead time is simulated)
+    aeff : `~gammapy.irf.EffectiveAreaTable2D`
+        Effective area (true energy)
+    energy_bounds : `~astropy.units.Quantity`, optional
+        True energy binning used for the sampling. Within the bins
+        the spectra are interpolated with power laws and the effective
+        area is constant. Default: 0.05 to 100 TeV with 20 bins per decade.
+    edisp : `~gammapy.irf.EnergyDispersion`, optional
+        Energy dispersion (energies in TeV). Events in true energy bins
+        without dispersion information are not reconstructed.
+    psf : `~gammapy.irf.EnergyDependentMultiGaussPSF`, optional
+        Point spread function. The PSF parameters of the nearest energy
+        and offset node are used.
+    bg_cube : `~gammapy.background.Cube`, optional
+        Background model cube (scheme ``'bg_cube'``) in ``1 / (s TeV sr)``
+        vs. field of view coordinates and reconstructed energy.
+    offset_step : `~astropy.coordinates.Angle`
+        Offset binning for the effective area lookup
+    obs_id : int
+        Observation ID
+    time_start : `~astropy.units.Quantity`
+        Start time (seconds after the time reference)
+    time_ref : `~astropy.time.Time`
+        Time reference (MJDREFI, MJDREFF)
+    chunk_size : int
+        Mean number of events per time slice
+    random_state : {int, 'random-seed', 'global-rng', `~numpy.random.RandomState`}
+        Defines random number generator initialisation.
+        Passed to `~gammapy.utils.random.get_random_state`.
+
+    Examples
+    --------
+    Simulate a point source on top of the background::
+
+        from astropy.units import Quantity
+        from astropy.coordinates import SkyCoord
+        from gammapy.datasets import EventSimulator
+
+        def crab_spectrum(energy):
+            return Quantity(3.5e-11, 'cm^-2 s^-1 TeV^-1') * energy.to('TeV').value ** -2.6
+
+        simulator = EventSimulator(pointing, Quantity(30, 'hour'), aeff,
+                                   psf=psf, bg_cube=bg_cube, random_state=0)
+        simulator.add_point_source(SkyCoord(83.63, 22.01, unit='deg'), crab_spectrum)
+        simulator.write('events.fits')
+
+    Notes
+    -----
+    Source events get ``MC_ID`` 1, 2, ... in the order the sources were
+    added, background events ``MC_ID`` 0. ``DETX`` and ``DETY`` are
+    tangent plane coordinates (deg) around the pointing position, with
+    ``DETX`` increasing towards east and ``DETY`` towards north.
+    """
+
+    def __init__(self, pointing, livetime, aeff, energy_bounds=None,
+                 edisp=None, psf=None, bg_cube=None,
+                 offset_step=Angle(0.02, 'deg'), obs_id=1,
+                 time_start=Quantity(0, 's'),
+                 time_ref=Time('2010-01-01T00:00:00', format='isot', scale='utc'),
+                 chunk_size=1000000, random_state='random-seed'):
+        self.pointing = pointing
+        self.livetime = livetime
+        self.aeff = aeff
+        self.edisp = edisp
+        self.psf = psf
+        self.bg_cube = bg_cube
+        self.obs_id = obs_id
+        self.time_start = time_start
+        self.time_ref = time_ref
+        self.chunk_size = chunk_size
+        self.random_state = get_random_state(random_state)
+        self.sources = []
+
+        if energy_bounds is None:
+            energy_bounds = Quantity(np.logspace(np.log10(0.05), 2, 67), 'TeV')
+        self._energy_edges = energy_bounds.to('TeV').value
+        self._energy_lo = self._energy_edges[:-1]
+        self._energy_hi = self._energy_edges[1:]
+
+        icrs = pointing.icrs
+        self._lon_pnt, self._lat_pnt = icrs.ra.radian, icrs.dec.radian
+
+        # Effective area lookup table (offset, true energy) in cm^2
+        self._offset_step = offset_step.to('radian').value
+        offset_max = aeff.offset_hi.to('radian').value.max() + 2 * self._offset_step
+        offsets = np.arange(0, offset_max, self._offset_step)
+        energy = np.sqrt(self._energy_lo * self._energy_hi)
+        # The table is only defined between the offset nodes
+        offset_nodes = aeff.offset.to('deg').value
+        offset_eval = np.degrees(offsets).clip(offset_nodes.min(), offset_nodes.max())
+        aeff_grid = aeff.evaluate(Angle(offset_eval, 'deg'), Quantity(energy, 'TeV'))
+        aeff_grid = aeff_grid.to('cm^2').value
+        aeff_grid[~np.isfinite(aeff_grid)] = 0
+        # Beyond the table the effective area is zero
+        aeff_grid[offsets > aeff.offset_hi.to('radian').value.max()] = 0
+        self._aeff_grid = aeff_grid.clip(0)
+
+        self._background = None
+        if bg_cube is not None:
+            self._prepare_background()
+
+    def _offset_index(self, offset):
+        """Index in the effective area lookup table for offsets (radian)."""
+        idx = np.round(offset / self._offset_step).astype(int)
+        return np.clip(idx, 0, len(self._aeff_grid) - 1)
+
+    def add_point_source(self, position, spectral_model):
+        """Add a point source.
+
+        Parameters
+        ----------
+        position : `~astropy.coordinates.SkyCoord`
+            Source position
+        spectral_model : callable
+            Differential flux ``spectral_model(energy)``, returning a
+            `~astropy.units.Quantity` (or values in ``cm^-2 s^-1 TeV^-1``)
+            for energies given as `~astropy.units.Quantity`.
+        """
+        source = _PointSource(self, position, spectral_model)
+        self._add_source(source)
+
+    def add_image_source(self, image, spectral_model):
+        """Add an extended source with energy-independent morphology.
+
+        Parameters
+        ----------
+        image : `~astropy.io.fits.ImageHDU`
+            Surface brightness image (normalisation is irrelevant)
+        spectral_model : callable
+            Total differential flux of the source, see `add_point_source`.
+        """
+        source = _MapSource(self, WCS(image.header), np.asarray(image.data, dtype=float),
+                            spectral_model=spectral_model)
+        self._add_source(source)
+
+    def add_cube_source(self, cube):
+        """Add a source (or diffuse emission) given as a spectral cube.
+
+        Parameters
+        ----------
+        cube : `~gammapy.data.SpectralCube`
+            Differential surface brightness (e.g. ``cm^-2 s^-1 TeV^-1 sr^-1``).
+            It is interpolated in energy with power laws between the planes.
+        """
+        data = cube.data
+        if isinstance(data, Quantity):
+            data = data.to(FLUX_UNIT + ' sr^-1').value
+        wcs = cube.wcs.celestial if cube.wcs.naxis == 3 else cube.wcs
+        source = _MapSource(self, wcs, np.asarray(data, dtype=float),
+                            energy=cube.energy.to('TeV').value)
+        self._add_source(source)
+
+    def _add_source(self, source):
+        source.mc_id = len(self.sources) + 1
+        self.sources.append(source)
+
+    def _prepare_background(self):
+        cube = self.bg_cube
+        energy = cube.energy_edges.to('TeV').value
+        detx = cube.coordx_edges.to('radian').value
+        dety = cube.coordy_edges.to('radian').value
+        rate = cube.data.to('s^-1 TeV^-1 sr^-1').value
+        rate = rate * np.diff(energy)[:, None, None]
+        rate = rate * np.diff(dety)[None, :, None] * np.diff(detx)[None, None, :]
+        rate = np.where(np.isfinite(rate), rate, 0).clip(0)
+        self._background = dict(rate=rate.sum(), energy=energy, detx=detx, dety=dety,
+                                sampler=GeneralRandomArray(rate, method='alias'))
+
+    def expected_counts(self):
+        """Expected number of events per component.
+
+        Returns
+        -------
+        counts : dict
+            Expected number of events for each source (by ``MC_ID``)
+            before energy dispersion, and for the background (``MC_ID`` 0).
+        """
+        livetime = self.livetime.to('s').value
+        counts = dict()
+        for source in self.sources:
+            if isinstance(source, _PointSource):
+                offset = _separation(source.lon, source.lat, self._lon_pnt, self._lat_pnt)
+                aeff = self._aeff_grid[self._offset_index(offset)]
+                with np.errstate(divide='ignore', invalid='ignore'):
+                    ratio = np.where(source.aeff_max > 0, aeff / source.aeff_max, 0)
+                counts[source.mc_id] = livetime * (source.rates * ratio).sum()
+            else:
+                y, x = np.indices(source.shape)
+                lon, lat = _pixel_to_icrs(source.wcs, x.ravel(), y.ravel())
+                idx = self._offset_index(_separation(lon, lat, self._lon_pnt, self._lat_pnt))
+                with np.errstate(divide='ignore', invalid='ignore'):
+                    ratio = np.where(source.aeff_max > 0,
+                                     self._aeff_grid / source.aeff_max, 0)
+                if source.cube:
+                    rates = source.rates.reshape(len(ratio[0]), -1)
+                    total = (rates * ratio[idx].T).sum()
+                else:
+                    pixel_weights = np.bincount(idx, weights=source.pixel_weights,
+                                                minlength=len(ratio))
+                    total = (pixel_weights.dot(ratio) * source.rates).sum()
+                counts[source.mc_id] = livetime * total
+        if self._background is not None:
+            counts[0] = livetime * self._background['rate']
+        return counts
+
+    def _simulate_source(self, source, n, random_state):
+        """Simulate ``n`` proposed photons of a source, return accepted events."""
+        lon, lat, energy_bin, index = source.sample(n, random_state)
+        u = random_state.uniform(size=n)
+        energy = _sample_power_law(self._energy_lo[energy_bin],
+                                   self._energy_hi[energy_bin], index, u)
+
+        # Thinning with the offset-dependent effective area
+        offset = _separation(lon, lat, self._lon_pnt, self._lat_pnt)
+        aeff = self._aeff_grid[self._offset_index(offset), energy_bin]
+        aeff_max = source.aeff_max[energy_bin]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            accept = random_state.uniform(size=n) * aeff_max < aeff
+        lon, lat, energy, offset = lon[accept], lat[accept], energy[accept], offset[accept]
+
+        if self.psf is not None:
+            lon, lat = self._apply_psf(lon, lat, energy, offset, random_state)
+
+        if self.edisp is not None:
+            energy, valid = self._apply_edisp(energy, random_state)
+            lon, lat, energy = lon[valid], lat[valid], energy[valid]
+
+        return lon, lat, energy
+
+    def _apply_psf(self, lon, lat, energy, offset, random_state):
+        """Displace positions according to the PSF."""
+        psf = self.psf
+        n = len(lon)
+        energy_hi = psf.energy_hi.to('TeV').value
+        i = np.searchsorted(energy_hi, energy).clip(0, len(energy_hi) - 1)
+        j = _nearest_index(psf.theta.to('radian').value, offset)
+        sigmas = np.array([np.asarray(_)[j, i] for _ in psf.sigmas], dtype=float)
+        amplitudes = np.array([np.ones(n)] +
+                              [np.asarray(_)[j, i] for _ in psf.norms[1:]], dtype=float)
+        # The integral of a 2D Gaussian with amplitude A is 2 pi A sigma ^ 2
+        weights = np.cumsum(amplitudes * sigmas ** 2, axis=0)
+        u = random_state.uniform(size=n) * weights[-1]
+        component = (u[np.newaxis] > weights).sum(axis=0).clip(0, len(sigmas) - 1)
+        sigma = np.radians(sigmas[component, np.arange(n)])
+
+        separation = sigma * np.sqrt(-2 * np.log1p(-random_state.uniform(size=n)))
+        position_angle = random_state.uniform(0, 2 * np.pi, n)
+        return _offset_by(lon, lat, position_angle, separation)
+
+    def _apply_edisp(self, energy, random_state):
+        """Draw reconstructed energies, returns energies and valid mask."""
+        e_true = np.asarray(self.edisp.energy_bounds('true'), dtype=float)
+        e_reco = np.asarray(self.edisp.energy_bounds('reco'), dtype=float)
+        matrix = np.asarray(self.edisp.pdf_matrix, dtype=float).clip(0)
+        n_true, n_reco = matrix.shape
+
+        norm = matrix.sum(axis=1)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            cdf = np.cumsum(matrix, axis=1) / norm[:, np.newaxis]
+        cdf[norm == 0] = 1
+        # Stack the rows, so that row i covers the range [i, i + 1]
+        cdf_flat = (cdf + np.arange(n_true)[:, np.newaxis]).ravel()
+
+        true_bin = np.searchsorted(e_true, energy, side='right') - 1
+        valid = (true_bin >= 0) & (true_bin < n_true)
+        true_bin = true_bin.clip(0, n_true - 1)
+        valid &= norm[true_bin] > 0
+
+        u = random_state.uniform(size=len(energy))
+        reco_bin = np.searchsorted(cdf_flat, true_bin + u, side='right')
+        reco_bin = (reco_bin - true_bin * n_reco).clip(0, n_reco - 1)
+
+        # Log-uniform within the reco energy bin
+        u = random_state.uniform(size=len(energy))
+        energy = e_reco[reco_bin] * (e_reco[reco_bin + 1] / e_reco[reco_bin]) ** u
+        return energy, valid
+
+    def _simulate_background(self, n, random_state):
+        bg = self._background
+        flat = bg['sampler'].draw(n, return_flat_index=True, random_state=random_state)
+        energy_bin, y, x = np.unravel_index(flat, bg['sampler'].shape)
+
+        energy, detx, dety = bg['energy'], bg['detx'], bg['dety']
+        u = random_state.uniform(size=(3, n))
+        detx = detx[x] + u[0] * (detx[x + 1] - detx[x])
+        dety = dety[y] + u[1] * (dety[y + 1] - dety[y])
+        energy = energy[energy_bin] * (energy[energy_bin + 1] / energy[energy_bin]) ** u[2]
+
+        lon, lat = _fov_to_sky(detx, dety, self._lon_pnt, self._lat_pnt)
+        return lon, lat, energy
+
+    @property
+    def meta(self):
+        """Event list header keywords (dict)."""
+        livetime = self.livetime.to('s').value
+        time_start = self.time_start.to('s').value
+        mjd_fra, mjd_int = np.modf(self.time_ref.mjd)
+        return dict(HDUCLAS1='EVENTS', OBS_ID=self.obs_id,
+                    RA_PNT=np.degrees(self._lon_pnt), DEC_PNT=np.degrees(self._lat_pnt),
+                    TSTART=time_start, TSTOP=time_start + livetime,
+                    ONTIME=livetime, LIVETIME=livetime, DEADC=1.,
+                    MJDREFI=int(mjd_int), MJDREFF=mjd_fra,
+                    TIMESYS=self.time_ref.scale.upper(), EUNIT='TeV')
+
+    def good_time_intervals(self):
+        """Good time intervals (`~gammapy.data.GoodTimeIntervals`)."""
+        meta = self.meta
+        gti = GoodTimeIntervals()
+        gti['START'] = Quantity([meta['TSTART']], 's')
+        gti['STOP'] = Quantity([meta['TSTOP']], 's')
+        for key in ['MJDREFI', 'MJDREFF', 'TIMESYS']:
+            gti.meta[key] = meta[key]
+        return gti
+
+    def iter_chunks(self):
+        """Simulate the events in time slices.
+
+        Yields
+        ------
+        events : `~gammapy.data.EventList`
+            Events of one time slice, ordered in time
+        """
+        random_state = self.random_state
+        livetime = self.livetime.to('s').value
+        time_start = self.time_start.to('s').value
+
+        components = [(source, livetime * source.rate()) for source in self.sources]
+        if self._background is not None:
+            components.append((None, livetime * self._background['rate']))
+        n_total = sum(n for _, n in components)
+        n_slices = max(1, int(np.ceil(n_total / self.chunk_size)))
+
+        event_id = 0
+        for time_slice in range(n_slices):
+            columns = []
+            for source, n_expected in components:
+                n = random_state.poisson(n_expected / n_slices)
+                if source is None:
+                    lon, lat, energy = self._simulate_background(n, random_state)
+                    mc_id = 0
+                else:
+                    lon, lat, energy = self._simulate_source(source, n, random_state)
+                    mc_id = source.mc_id
+                columns.append((lon, lat, energy, np.repeat(mc_id, len(lon))))
+            lon, lat, energy, mc_id = [np.concatenate(_) for _ in zip(*columns)]
+
+            n = len(lon)
+            t_lo = time_start + livetime * time_slice / n_slices
+            t_hi = time_start + livetime * (time_slice + 1) / n_slices
+            time = random_state.uniform(t_lo, t_hi, n)
+            order = np.argsort(time)
+            detx, dety = _sky_to_fov(lon, lat, self._lon_pnt, self._lat_pnt)
+
+            events = EventList(meta=self.meta)
+            events['EVENT_ID'] = np.arange(event_id, event_id + n, dtype=np.int64) + 1
+            events['TIME'] = Quantity(time[order], 's')
+            events['RA'] = Quantity(np.degrees(lon[order]), 'deg')
+            events['DEC'] = Quantity(np.degrees(lat[order]), 'deg')
+            events['DETX'] = Quantity(np.degrees(detx[order]), 'deg')
+            events['DETY'] = Quantity(np.degrees(dety[order]), 'deg')
+            events['ENERGY'] = Quantity(energy[order], 'TeV')
+            events['MC_ID'] = mc_id[order].astype(np.int32)
+            event_id += n
+            yield events
+
+    def run(self):
+        """Simulate all events in memory.
+
+        Returns
+        -------
+        events : `~gammapy.data.EventList`
+            Event list
+        gti : `~gammapy.data.GoodTimeIntervals`
+            Good time intervals
+        """
+        from astropy.table import vstack
+        events = vstack(list(self.iter_chunks()), metadata_conflicts='silent')
+        return EventList(events, meta=self.meta), self.good_time_intervals()
+
+    def write(self, filename, overwrite=False):
+        """Simulate the events and write them to a FITS file chunk by chunk.
+
+        The file has an ``EVENTS`` and a ``GTI`` extension.
+        Only one chunk of events is in memory at any time.
+
+        Parameters
+        ----------
+        filename : str
+            Output file name
+        overwrite : bool
+            Overwrite existing file?
+
+        Returns
+        -------
+        n_events : int
+            Number of events written
+        """
+        if os.path.exists(filename) and not overwrite:
+            raise IOError('File exists: {0}'.format(filename))
+
+        with open(filename, 'wb') as fh:
+            fits.PrimaryHDU().writeto(fh)
+            header_start = fh.tell()
+            header, dtype, n_events = None, None, 0
+            for events in self.iter_chunks():
+                if header is None:
+                    hdu = table_to_fits_table(events[:0])
+                    hdu.name = 'EVENTS'
+                    # Column units are only added to the header on write
+                    header = fits.BinTableHDU(hdu.data, hdu.header).header
+                    dtype = hdu.data.dtype.newbyteorder('>')
+                    fh.write(header.tostring().encode('ascii'))
+                data = np.empty(len(events), dtype=dtype)
+                for name in events.colnames:
+                    data[name] = events[name]
+                fh.write(data.tobytes())
+                n_events += len(events)
+
+            # Pad the data to the FITS block size and fix the number of rows
+            fh.write(b'\0' * (-fh.tell() % 2880))
+            header['NAXIS2'] = n_events
+            fh.seek(header_start)
+            fh.write(header.tostring().encode('ascii'))
+
+        gti = self.good_time_intervals()
+        hdu = table_to_fits_table(gti)
+        hdu.name = 'GTI'
+        fits.append(filename, hdu.data, hdu.header)
+        return n_events
+
@@ -3,6 +3,8 @@ from __future__ import (absolute_import, division, print_function,
                         unicode_literals)
 import os
 import numpy as np
+from numpy.testing import assert_allclose
+from astropy.io import fits
 from astropy.coordinates import Angle
 from astropy.units import Quantity
 from astropy.tests.helper import assert_quantity_allclose
@@ -114,3 +116,32 @@ def test_make_test_dataset(tmpdir):
                                                       filetypes=['effective area'])
     assert len(event_list_files) == n_obs
     assert len(aeff_table_files) == n_obs
+
+
+def test_make_test_dataset_parallel_update(tmpdir):
+    fits_path = str(tmpdir.join('test_dataset'))
+    obs_ids = make_test_dataset(fits_path=fits_path, n_obs=3, random_state=0)
+    assert len(obs_ids) == 3
+
+    # the dataset doesn't depend on the number of processes
+    fits_path_parallel = str(tmpdir.join('test_dataset_parallel'))
+    make_test_dataset(fits_path=fits_path_parallel, n_obs=3, random_state=0,
+                      parallel=True, processes=2)
+
+    data_store = DataStore(dir=fits_path, scheme='HESS')
+    data_store_parallel = DataStore(dir=fits_path_parallel, scheme='HESS')
+    filenames = [data_store.filename(obs_id) for obs_id in obs_ids]
+    for obs_id, filename in zip(obs_ids, filenames):
+        events = fits.getdata(filename, extname='EVENTS')
+        events_parallel = fits.getdata(data_store_parallel.filename(obs_id),
+                                       extname='EVENTS')
+        assert_allclose(events['ENERGY'], events_parallel['ENERGY'])
+        assert_allclose(events['DETX'], events_parallel['DETX'])
+
+    # only missing files are simulated again
+    data = fits.getdata(filenames[1], extname='EVENTS')
+    os.remove(filenames[1])
+    updated = make_test_dataset(fits_path=fits_path, n_obs=3, random_state=0,
+                                update=True)
+    assert updated == [obs_ids[1]]
+    assert_allclose(fits.getdata(filenames[1], extname='EVENTS')['DETY'], data['DETY'])
@@ -0,0 +1,135 @@
+# Licensed under a 3-clause BSD style license - see LICENSE.rst
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+import numpy as np
+from numpy.testing import assert_allclose, assert_equal
+from astropy.tests.helper import pytest
+from astropy.io import fits
+from astropy.units import Quantity
+from astropy.coordinates import SkyCoord, Angle
+from ...irf import EffectiveAreaTable2D, EnergyDispersion
+from ...datasets import EventSimulator, make_test_psf, make_test_bg_cube_model
+from ..simulate import _power_law_integral, _sample_power_law
+
+try:
+    import scipy
+    HAS_SCIPY = True
+except ImportError:
+    HAS_SCIPY = False
+
+
+def power_law(energy):
+    return Quantity(1e-9, 'cm^-2 s^-1 TeV^-1') * energy.to('TeV').value ** -2
+
+
+def make_aeff(area=Quantity(1e5, 'm^2'), offset_max=Angle(3, 'deg')):
+    """Effective area, constant up to ``offset_max``."""
+    energy = Quantity(np.logspace(-2, 3, 51), 'TeV')
+    offset = Angle(np.linspace(0, offset_max.deg, 11), 'deg')
+    data = np.ones((len(offset) - 1, len(energy) - 1)) * area
+    return EffectiveAreaTable2D(energy[:-1], energy[1:], offset[:-1], offset[1:],
+                                data, data)
+
+
+def test_power_law_sampling():
+    e_lo, e_hi = np.array([1.]), np.array([10.])
+    f_lo, f_hi = np.array([1.]), np.array([0.01])
+    integral, index = _power_law_integral(e_lo, e_hi, f_lo, f_hi)
+    assert_allclose(index, 2)
+    assert_allclose(integral, 0.9)
+
+    u = np.linspace(0, 1, 11)
+    energy = _sample_power_law(e_lo, e_hi, index, u)
+    # The cdf of the samples is u
+    assert_allclose((1 - 1 / energy) / 0.9, u)
+
+
+@pytest.mark.skipif('not HAS_SCIPY')
+def test_event_simulator_point_source(tmpdir):
+    pointing = SkyCoord(83.63, 22.01, unit='deg')
+    position = SkyCoord(83.63, 22.51, unit='deg')
+    livetime = Quantity(10, 'hour')
+    energy_bounds = Quantity(np.logspace(0, 1, 11), 'TeV')
+
+    simulator = EventSimulator(pointing, livetime, make_aeff(), energy_bounds,
+                               psf=make_test_psf(), chunk_size=1000, random_state=0)
+    simulator.add_point_source(position, power_law)
+
+    # 1e-9 cm^-2 s^-1 TeV^-1 * 0.9 TeV * 1e9 cm^2 * 36000 s
+    expected = simulator.expected_counts()[1]
+    assert_allclose(expected, 32400)
+
+    events, gti = simulator.run()
+    assert np.abs(len(events) - expected) < 5 * np.sqrt(expected)
+    assert_equal(events['MC_ID'], 1)
+    assert np.all(np.diff(events['TIME']) >= 0)
+    assert_allclose(gti['STOP'] - gti['START'], 36000)
+
+    energy = events['ENERGY'].quantity.to('TeV').value
+    assert energy.min() >= 1
+    assert energy.max() <= 10
+    # Median of E^-2 spectrum between 1 and 10 TeV
+    assert_allclose(np.median(energy), 1 / 0.55, rtol=1e-2)
+
+    ra, dec = events['RA'].quantity.value, events['DEC'].quantity.value
+    assert_allclose(np.median(ra), 83.63, atol=1e-3)
+    assert_allclose(np.median(dec), 22.51, atol=1e-3)
+    assert_allclose(np.median(events['DETY'].quantity.value), 0.5, atol=2e-3)
+
+
+@pytest.mark.skipif('not HAS_SCIPY')
+def test_event_simulator_image_source():
+    pointing = SkyCoord(0, 0, unit='deg', frame='galactic')
+    header = fits.Header()
+    header.update(NAXIS=2, NAXIS1=40, NAXIS2=40, CTYPE1='GLON-CAR', CTYPE2='GLAT-CAR',
+                  CRPIX1=20.5, CRPIX2=20.5, CRVAL1=0, CRVAL2=0, CDELT1=-0.1, CDELT2=0.1)
+    image = fits.ImageHDU(np.ones((40, 40)), header)
+    energy_bounds = Quantity(np.logspace(0, 1, 11), 'TeV')
+
+    # Only the inner part of the image is inside the field of view
+    aeff = make_aeff(offset_max=Angle(1, 'deg'))
+    simulator = EventSimulator(pointing, Quantity(1, 'hour'), aeff, energy_bounds,
+                               random_state=0)
+    simulator.add_image_source(image, power_law)
+    # Fraction of the image within 1 deg is pi / 16
+    expected = simulator.expected_counts()[1]
+    assert_allclose(expected, 3240 * np.pi / 16, rtol=0.05)
+
+    events, _ = simulator.run()
+    assert np.abs(len(events) - expected) < 5 * np.sqrt(expected)
+    offset = np.hypot(events['DETX'].quantity.value, events['DETY'].quantity.value)
+    assert offset.max() < 1.01
+
+
+@pytest.mark.skipif('not HAS_SCIPY')
+def test_event_simulator_background_edisp_write(tmpdir):
+    pointing = SkyCoord(83.63, 22.01, unit='deg')
+    energy_bounds = Quantity(np.logspace(-1, 2, 31), 'TeV')
+    bg_cube = make_test_bg_cube_model(apply_mask=False)
+    # Energy dispersion shifts all events one bin up
+    pdf_matrix = np.eye(30, k=1)
+    pdf_matrix[-1, -1] = 1
+    edisp = EnergyDispersion(pdf_matrix, energy_bounds.value)
+
+    simulator = EventSimulator(pointing, Quantity(0.5, 'hour'), make_aeff(),
+                               energy_bounds, edisp=edisp, bg_cube=bg_cube,
+                               chunk_size=10000, random_state=0)
+    simulator.add_point_source(pointing, power_law)
+    counts = simulator.expected_counts()
+
+    filename = str(tmpdir.join('events.fits'))
+    n_events = simulator.write(filename)
+
+    hdu_list = fits.open(filename)
+    events = hdu_list['EVENTS'].data
+    assert len(events) == n_events
+    assert hdu_list['EVENTS'].header['TUNIT7'] == 'TeV'
+    assert np.all(np.diff(events['TIME']) >= 0)
+    assert_equal(events['EVENT_ID'], np.arange(n_events) + 1)
+    assert_allclose(hdu_list['GTI'].data['STOP'], 1800)
+
+    is_source = events['MC_ID'] == 1
+    assert np.abs(is_source.sum() - counts[1]) < 5 * np.sqrt(counts[1])
+    assert events['ENERGY'][is_source].min() > energy_bounds[1].value
+    n_background = (~is_source).sum()
+    assert np.abs(n_background - counts[0]) < 5 * np.sqrt(counts[0])
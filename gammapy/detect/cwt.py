@@ -5,6 +5,7 @@ log = logging.getLogger(__name__)
 import numpy as np
 from astropy.io import fits
 from astropy.wcs import WCS
+from ..utils.fft import fast_fft_length
 
 __all__ = ['CWT']
 
@@ -89,6 +90,9 @@ class CWT(object):
         self.header = None
         self.wcs = None
 
+        # Kernel Fourier transforms, cached per image shape
+        self._kernel_ffts = dict()
+
     def set_data(self, image, background):
         """Set input images."""
         # TODO: check that image and background are consistent
@@ -99,6 +103,8 @@ class CWT(object):
         self.model = np.zeros((self.nx, self.ny))
         self.approx = np.zeros((self.nx, self.ny))
 
+        self.approx_bkg = None
+
         self.transform = np.zeros((self.nscale, self.nx, self.ny))
         self.error = np.zeros((self.nscale, self.nx, self.ny))
         self.support = np.zeros((self.nscale, self.nx, self.ny))
@@ -113,19 +119,70 @@ class CWT(object):
         self.header = hdulist[0].header
         self.wcs = WCS(self.header)
 
+    def _get_kernel_ffts(self, shape):
+        """Stacked Fourier transforms of all kernels for a given image shape.
+
+        All kernels are zero-padded to a common shape that is large enough
+        to avoid wrap-around, and shifted such that the result for every
+        kernel is centered like `scipy.signal.fftconvolve` with ``mode='same'``
+        when cropped with the same slices.
+
+        Returns
+        -------
+        ffts : dict
+            Keys: ``fft_shape``, ``crop`` (slices), ``kern`` and ``kern2``
+            (stacked transforms of the scale kernels and their squares)
+            and ``approx`` (transform of the approximation kernel).
+        """
+        if shape in self._kernel_ffts:
+            return self._kernel_ffts[shape]
+
+        kernels = [self.kernbase[key] for key in range(self.nscale)]
+        all_kernels = kernels + [self.kern_approx]
+        k_max = np.max([_.shape for _ in all_kernels], axis=0)
+        fft_shape = tuple(fast_fft_length(n + k - 1) for n, k in zip(shape, k_max))
+        # 'same' mode crops the full convolution at (k - 1) // 2
+        start = (k_max - 1) // 2
+
+        def transform(kernel):
+            padded = np.zeros(fft_shape)
+            offset = start - (np.array(kernel.shape) - 1) // 2
+            padded[offset[0]:offset[0] + kernel.shape[0],
+                   offset[1]:offset[1] + kernel.shape[1]] = kernel
+            return np.fft.rfftn(padded, axes=(0, 1))
+
+        ffts = dict(fft_shape=fft_shape)
+        ffts['crop'] = (Ellipsis, slice(start[0], start[0] + shape[0]),
+                        slice(start[1], start[1] + shape[1]))
+        ffts['kern'] = np.array([transform(_) for _ in kernels])
+        ffts['kern2'] = np.array([transform(_ ** 2) for _ in kernels])
+        ffts['approx'] = transform(self.kern_approx)
+        self._kernel_ffts[shape] = ffts
+        return ffts
+
     def do_transform(self):
-        """Do the transform itself."""
-        # TODO: after unit tests are added switch to astropy fftconvolve here.
-        from scipy.signal import fftconvolve
+        """Do the transform itself.
+
+        Each input image is Fourier transformed once and multiplied with the
+        cached transforms of all scale kernels at once.
+        """
+        ffts = self._get_kernel_ffts(self.image.shape)
+        fft_shape, crop = ffts['fft_shape'], ffts['crop']
+
+        def forward(image):
+            return np.fft.rfftn(image, fft_shape, axes=(0, 1))
+
+        def inverse(image_fft):
+            return np.fft.irfftn(image_fft, fft_shape, axes=(-2, -1))[crop]
+
         total_background = self.model + self.background + self.approx
         excess = self.image - total_background
-        for key, kern in self.kernbase.items():
-            self.transform[key] = fftconvolve(excess, kern, mode='same')
-            self.error[key] = np.sqrt(fftconvolve(total_background, kern ** 2, mode='same'))
+        self.transform = inverse(forward(excess) * ffts['kern'])
+        self.error = np.sqrt(inverse(forward(total_background) * ffts['kern2']))
 
-        self.approx = fftconvolve(self.image - self.model - self.bkg,
-                                  self.kern_approx, mode='same')
-        self.approx_bkg = fftconvolve(self.bkg, self.kern_approx, mode='same')
+        self.approx = inverse(forward(self.image - self.model - self.background) * ffts['approx'])
+        if getattr(self, 'approx_bkg', None) is None:
+            self.approx_bkg = inverse(forward(self.background) * ffts['approx'])
 
     def compute_support_peak(self, nsigma=2.0, nsigmap=4.0, remove_isolated=True):
         """Compute the multiresolution support with hard sigma clipping.
@@ -133,21 +190,22 @@ class CWT(object):
         Imposing a minimum significance on a connex region of significant pixels
         (i.e. source detection)
         """
-        from scipy.ndimage import label
+        from scipy.ndimage import label, maximum
         # TODO: check that transform has been performed
         sig = self.transform / self.error
         for key in self.scales.keys():
             tmp = sig[key] > nsigma
             # produce a list of connex structures in the support
             l, n = label(tmp)
-            for id in range(1, n):
-                index = np.where(l == id)
+            if n > 0:
+                labels = np.arange(1, n + 1)
+                # Remove significant pixels island from support
+                # if max does not reach maximal significance
+                keep = np.asarray(maximum(sig[key], l, labels)) >= nsigmap
                 if remove_isolated:
-                    if index[0].size == 1:
-                        tmp[index] *= 0.0  # Remove isolated pixels from support
-                signif = sig[key][index]
-                if signif.max() < nsigmap:  # Remove significant pixels island from support
-                    tmp[index] *= 0.0  # if max does not reach maximal significance
+                    # Remove isolated pixels from support
+                    keep &= np.bincount(l.ravel(), minlength=n + 1)[1:] > 1
+                tmp = np.concatenate([[False], keep])[l]
 
             self.support[key] += tmp
             self.support[key] = self.support[key] > 0.
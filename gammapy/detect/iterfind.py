@@ -26,8 +26,6 @@ TODO: tons of things, e.g.
   - e.g. list of peaks should be replaced with some abstract class that
     allows different characteristics / methods to be implemented.
 * Introduce parameters that allow us to vary the procedure
-* Check if Python garbage collection for iter_maps sets in OK
-  or if explicit garbage collection is needed.
 * Use photutils aperture photometry for estimate_flux?
 * Introduce FLUX_SCALE = 1e-10 parameter to avoid roundoff error problems?
 """
@@ -38,13 +36,14 @@ log = logging.getLogger(__name__)
 import numpy as np
 from astropy.io import fits
 from .. import stats
-from ..image import disk_correlate
+from ..image import binary_disk
+from ..utils.fft import FFTConvolver
 
 __all__ = ['IterativeSourceDetector',
            ]
 
 
-class FitFailedError(object):
+class FitFailedError(Exception):
     """Fit failed error.
     """
     pass
@@ -62,19 +61,197 @@ def gauss2d(x, y, xpos, ypos, sigma, flux):
     return flux * image / image.sum()
 
 
+def source_window(shape, xpos, ypos, sigma, n_sigma=5):
+    """Image cutout containing a Gauss source up to ``n_sigma * sigma``.
+
+    Parameters
+    ----------
+    shape : tuple
+        Image shape
+    xpos, ypos : float
+        Source position (FITS pixel coordinates, i.e. starting at 1)
+    sigma : float
+        Source width (pixels)
+    n_sigma : float
+        Cutout half-size in units of ``sigma``.
+
+    Returns
+    -------
+    window : tuple of slices
+        Slices of the image cutout (may be empty).
+    """
+    half = n_sigma * sigma + 1
+    window = []
+    for pos, n in [(ypos, shape[0]), (xpos, shape[1])]:
+        # Pixel index is FITS pixel coordinate - 1
+        lo = int(np.clip(np.floor(pos - half) - 1, 0, n))
+        hi = int(np.clip(np.ceil(pos + half), 0, n))
+        window.append(slice(lo, max(lo, hi)))
+    return tuple(window)
+
+
+def gauss2d_cash(xpos, ypos, sigma, flux, x, y, background, exposure, stat):
+    """Cash statistic and gradient for a Gauss source on top of a background.
+
+    The model is ``background + exposure * gauss2d(x, y, xpos, ypos, sigma, flux)``.
+
+    Parameters
+    ----------
+    xpos, ypos, sigma, flux : float
+        Source parameters, see `gauss2d`.
+    x, y : `~numpy.ndarray`
+        Pixel coordinates
+    background, exposure : `~numpy.ndarray`
+        Background and exposure
+    stat : `~gammapy.stats.Cash`
+        Cash statistic for the counts in the same pixels (flattened).
+
+    Returns
+    -------
+    cash : float
+        Fit statistic
+    gradient : `~numpy.ndarray`
+        Derivatives with respect to ``(xpos, ypos, sigma, flux)``
+    """
+    dx, dy = x - xpos, y - ypos
+    sigma2 = sigma * sigma
+    theta2 = dx * dx + dy * dy
+    g = np.exp(-0.5 * theta2 / sigma2)
+    norm = g.sum()
+    profile = g / norm
+    model = (background + (flux * exposure) * profile).ravel()
+
+    # Derivatives of the normalised profile g / sum(g)
+    weight = stat.gradient(model).reshape(g.shape) * exposure
+    dg = [g * dx / sigma2, g * dy / sigma2, g * theta2 / (sigma2 * sigma)]
+    gradient = np.empty(4)
+    for idx, dg_i in enumerate(dg):
+        dprofile = (dg_i - profile * dg_i.sum()) / norm
+        gradient[idx] = flux * np.sum(weight * dprofile)
+    gradient[3] = np.sum(weight * profile)
+    return stat(model), gradient
+
+
+def fit_gauss_source(source, counts, background, exposure, x, y, max_ncall=300):
+    """Fit a Gauss source with Minuit, using the guess as start values.
+
+    The Cash statistic is only evaluated in a cutout around the source
+    (see `source_window`) and analytic gradients are passed to Minuit.
+    If the fitted source is wider than the cutout, the fit is repeated
+    in a larger cutout.
+
+    The images can be cutouts of the full maps, ``x`` and ``y`` give the
+    FITS pixel coordinates of the cutout pixels.
+
+    Parameters
+    ----------
+    source : dict
+        Start values for ``xpos``, ``ypos``, ``sigma`` and ``flux``
+    counts, background, exposure : `~numpy.ndarray`
+        Counts, background and exposure images
+    x, y : `~numpy.ndarray`
+        Pixel coordinate images
+    max_ncall : int
+        Maximum number of function calls for ``migrad``
+
+    Returns
+    -------
+    source : dict
+        Best-fit source parameters
+
+    Raises
+    ------
+    FitFailedError
+        If the fit doesn't converge.
+    """
+    from iminuit import Minuit
+
+    # FITS pixel coordinates of the cutout origin
+    x0, y0 = x[0, 0] - 1, y[0, 0] - 1
+    sigma_window = source['sigma']
+
+    for _ in range(3):
+        window = source_window(counts.shape, source['xpos'] - x0,
+                               source['ypos'] - y0, sigma_window)
+        cutout = dict(x=x[window], y=y[window], background=background[window],
+                      exposure=exposure[window], stat=stats.Cash(counts[window].ravel()))
+
+        def fit_stat(xpos, ypos, sigma, flux):
+            """Define CASH fit statistic for Gauss model"""
+            return gauss2d_cash(xpos, ypos, sigma, flux, **cutout)[0]
+
+        def fit_gradient(xpos, ypos, sigma, flux):
+            """Gradient of ``fit_stat``"""
+            return gauss2d_cash(xpos, ypos, sigma, flux, **cutout)[1]
+
+        pars = source.copy()
+        pars['error_xpos'] = 0.01
+        pars['error_ypos'] = 0.01
+        pars['error_flux'] = 0.1 * source['flux']
+        pars['error_sigma'] = 0.1 * source['sigma']
+        SIGMA_LIMITS = (0.01, 1e6)
+        pars['limit_sigma'] = SIGMA_LIMITS
+        minuit = Minuit(fit_stat, grad_fcn=fit_gradient, pedantic=False,
+                        print_level=1, **pars)
+        minuit.migrad(ncall=max_ncall)
+
+        # Repeat the fit if the source doesn't fit into the cutout
+        result = minuit.values
+        needed = source_window(counts.shape, result['xpos'] - x0,
+                               result['ypos'] - y0, result['sigma'])
+        if all(n.start >= w.start and n.stop <= w.stop
+               for n, w in zip(needed, window)):
+            break
+        sigma_window = 2 * max(sigma_window, result['sigma'])
+
+    if not minuit.migrad_ok():
+        # If fit doesn't converge we simply abort
+        minuit.print_fmin()
+        raise FitFailedError
+
+    return dict(minuit.values)
+
+
+def _fit_gauss_source_task(task, max_ncall):
+    """Fit one source for `IterativeSourceDetector` batch mode.
+
+    Returns ``None`` if the fit fails.
+    """
+    try:
+        return fit_gauss_source(max_ncall=max_ncall, **task)
+    except FitFailedError:
+        log.warning('Fit failed for source: {0}'.format(task['source']))
+        return None
+
+
 class IterativeSourceDetector(object):
     """An iterative source detection algorithm.
 
     TODO: document
 
+    In batch mode all well-separated local maxima above the significance
+    threshold are taken as candidates in each iteration, fitted independently
+    in cutouts around them and only then added to the background model.
+    This needs much fewer iterations on crowded fields.
+
     Parameters
     ----------
     debug_output_folder : str
         Use empty string for no debug output.
+    batch : bool
+        Detect several sources per iteration?
+    min_separation : float, optional
+        Minimum separation (pixels) of candidates in batch mode.
+        Default is the largest scale.
+    parallel : bool
+        Fit the candidates of one iteration in parallel (batch mode only).
+    processes : int, optional
+        Number of processes for ``parallel=True``, default: number of CPUs.
     """
 
     def __init__(self, maps, scales, max_sources=10, significance_threshold=5,
-                 max_ncall=300, debug_output_folder='', overwrite=False):
+                 max_ncall=300, debug_output_folder='', overwrite=False,
+                 batch=False, min_separation=None, parallel=False, processes=None):
         self.maps = maps
         # Note: FITS convention is to start counting pixels at 1
         y, x = np.indices(maps['counts'].shape, dtype=np.int32) + 1
@@ -82,7 +259,7 @@ class IterativeSourceDetector(object):
 
         # Temp maps that change in each iteration
         self.iter_maps = dict()
-        self.find_peaks = []
+        self.peaks = []
 
         self.scales = np.asanyarray(scales)
         self.max_sources = max_sources
@@ -90,10 +267,23 @@ class IterativeSourceDetector(object):
         self.max_ncall = max_ncall
         self.debug_output_folder = debug_output_folder
         self.overwrite = overwrite
+        self.batch = batch
+        if min_separation is None:
+            min_separation = self.scales.max()
+        self.min_separation = min_separation
+        self.parallel = parallel
+        self.processes = processes
 
         self.sources_guess = []
         self.sources = []
 
+        # Disk correlation of counts and background per scale. Counts don't
+        # change, the background only changes around newly added sources.
+        self._convolver = FFTConvolver(maps['counts'].shape,
+                                       [binary_disk(_) for _ in self.scales],
+                                       mode='constant')
+        self._n_sources_included = 0
+
         # At the moment we only
         # self.peaks = np.zeros_like(self.scales)
 
@@ -126,38 +316,98 @@ class IterativeSourceDetector(object):
                         log.info('Writing {0}'.format(filename))
                         fits.writeto(filename, self.iter_maps[name][scale], clobber=self.overwrite)
 
-            self.find_peaks()
+            if self.batch:
+                self.find_peak_candidates()
+            else:
+                self.find_peaks()
             # TODO: debug output to JSON here and for later steps
 
             if self.stop_iteration():
                 break
 
-            self.guess_source_parameters()
+            if self.batch:
+                n_max = self.max_sources - len(self.sources)
+                if n_max <= 0:
+                    break
+                for peak in self.peaks[:n_max]:
+                    self.guess_source_parameters(peak)
+            else:
+                self.guess_source_parameters()
             if self.debug_output_folder:
                 filename = '{0}/{1}'.format(debug_folder, 'sources_guess.reg')
                 self.save_regions(filename, selection='guess')
 
-            try:
-                self.fit_source_parameters()
-            except FitFailedError:
-                log.warning('Fit failed. Full stop.')
+            if self.batch:
+                n_guess = min(len(self.peaks), n_max)
+                start = len(self.sources_guess) - n_guess
+                n_fitted = self.fit_sources_batch(self.sources_guess[start:])
+                if n_fitted == 0:
+                    log.warning('All fits failed. Full stop.')
+                    break
+            else:
+                try:
+                    self.fit_source_parameters()
+                except FitFailedError:
+                    log.warning('Fit failed. Full stop.')
+                    break
+
+            if len(self.sources) >= self.max_sources:
                 break
 
     def compute_iter_maps(self):
-        """Compute maps for this iteration."""
-        log.debug('Computing maps for this iteration.')
-        self.iter_maps = dict()
-
-        background = self.maps['background']
-        background += self.model_excess(self.sources)
-        self.iter_maps['background'] = background
+        """Compute maps for this iteration.
 
-        self.iter_maps['significance'] = dict()
-        for scale in self.scales:
-            counts = disk_correlate(self.maps['counts'], scale)
-            background = disk_correlate(self.iter_maps['background'], scale)
-            significance = stats.significance(counts, background)
-            self.iter_maps['significance'][scale] = significance
+        In the first call the correlated counts and background images are
+        computed for all scales. Later calls only add the sources detected
+        since then to the background, and update correlated background
+        and significance within the region changed by those sources.
+        """
+        log.debug('Computing maps for this iteration.')
+        counts = self.maps['counts']
+        shape = counts.shape
+
+        if not self.iter_maps:
+            background = np.array(self.maps['background'], dtype=np.float64)
+            integer_counts = np.all(np.mod(counts, 1) == 0)
+            counts_fft = self._convolver.transform(counts)
+            background_fft = self._convolver.transform(background)
+            self.iter_maps['background'] = background
+            self.iter_maps['counts_corr'] = dict()
+            self.iter_maps['background_corr'] = dict()
+            self.iter_maps['significance'] = dict()
+            for idx, scale in enumerate(self.scales):
+                counts_corr = self._convolver.convolve(counts, idx, counts_fft)
+                if integer_counts:
+                    # Disk sums of integers are integers, remove FFT round-off
+                    np.around(counts_corr, out=counts_corr)
+                background_corr = self._convolver.convolve(background, idx, background_fft)
+                self.iter_maps['counts_corr'][scale] = counts_corr
+                self.iter_maps['background_corr'][scale] = background_corr
+                significance = stats.significance(counts_corr, background_corr)
+                self.iter_maps['significance'][scale] = significance
+            self._n_sources_included = 0
+
+        for source in self.sources[self._n_sources_included:]:
+            window, excess = self._source_excess(source)
+            if excess.size == 0:
+                continue
+            self.iter_maps['background'][window] += excess
+            delta = np.zeros(shape)
+            delta[window] = excess
+
+            for idx, scale in enumerate(self.scales):
+                background_corr = self.iter_maps['background_corr'][scale]
+                self._convolver.update(delta, background_corr, index=idx)
+
+                # Pixels within the disk radius of the source window changed
+                radius = int(np.ceil(scale)) + 1
+                box = tuple(slice(max(_.start - radius, 0), min(_.stop + radius, n))
+                            for _, n in zip(window, shape))
+                counts_corr = self.iter_maps['counts_corr'][scale]
+                significance = stats.significance(counts_corr[box], background_corr[box])
+                self.iter_maps['significance'][scale][box] = significance
+
+        self._n_sources_included = len(self.sources)
 
     def model_excess(self, sources):
         """Compute model excess image."""
@@ -169,6 +419,25 @@ class IterativeSourceDetector(object):
         excess = flux * self.maps['exposure']
         return excess
 
+    def _source_excess(self, source):
+        """Model excess of one source in a cutout around it.
+
+        Returns
+        -------
+        window : tuple of slices
+            Cutout, see `source_window`.
+        excess : `~numpy.ndarray`
+            Model excess in the cutout
+        """
+        window = source_window(self.maps['counts'].shape, source['xpos'],
+                               source['ypos'], source['sigma'])
+        x, y = self.maps['x'][window], self.maps['y'][window]
+        if x.size == 0:
+            return window, np.zeros(x.shape)
+        flux = gauss2d(x, y, source['xpos'], source['ypos'],
+                       source['sigma'], source['flux'])
+        return window, flux * self.maps['exposure'][window]
+
     def find_peaks(self):
         """Find peaks in residual significance image."""
         log.debug('Finding peaks.')
@@ -190,8 +459,46 @@ class IterativeSourceDetector(object):
             log.debug('Peak on scale {scale:5.2f} is at ({xpos:5d}, {ypos:5d}) with value {val:7.2f}'
                       ''.format(**peak))
 
+    def find_peak_candidates(self):
+        """Find all well-separated peaks above threshold on all scales.
+
+        Local maxima are found with a maximum filter with a disk footprint
+        of radius ``min_separation``. Candidates from all scales are then
+        sorted by significance and candidates closer than ``min_separation``
+        to a more significant one are dropped.
+        """
+        from scipy.ndimage import maximum_filter
+        log.debug('Finding peak candidates.')
+        footprint = binary_disk(self.min_separation)
+
+        candidates = []
+        for scale in self.scales:
+            image = self.iter_maps['significance'][scale]
+            mask = np.invert(np.isfinite(image))
+            image[mask] = -1e10
+
+            local_max = (maximum_filter(image, footprint=footprint, mode='constant',
+                                        cval=-np.inf) == image)
+            local_max &= image >= self.significance_threshold
+            y, x = np.nonzero(local_max)
+            for xpos, ypos, val in zip(x, y, image[y, x]):
+                candidates.append(dict(xpos=xpos, ypos=ypos, val=val, scale=scale))
+
+        candidates.sort(key=lambda _: -_['val'])
+        self.peaks = []
+        min_separation2 = self.min_separation ** 2
+        for peak in candidates:
+            if all((peak['xpos'] - _['xpos']) ** 2 + (peak['ypos'] - _['ypos']) ** 2
+                   >= min_separation2 for _ in self.peaks):
+                self.peaks.append(peak)
+                log.debug('Peak on scale {scale:5.2f} is at ({xpos:5d}, {ypos:5d}) with value {val:7.2f}'
+                          ''.format(**peak))
+
     def stop_iteration(self):
         """Criteria to stop the iteration process."""
+        if not self.peaks:
+            log.debug('No peaks found. Stopping iteration.')
+            return True
         max_significance = max([_['val'] for _ in self.peaks])
         if max_significance < self.significance_threshold:
             log.debug('Max peak significance of {0:7.2f} is smaller than detection threshold {1:7.2f}'
@@ -201,19 +508,17 @@ class IterativeSourceDetector(object):
         else:
             return False
 
-    def guess_source_parameters(self):
+    def guess_source_parameters(self, peak=None):
         """Guess source start parameters for the fit.
 
         At the moment take the position and scale of the maximum residual peak
-        and compute the excess within a circle around that position.
+        (or the given peak) and compute the excess within a circle around that position.
         """
         log.debug('Guessing Gauss source parameters:')
 
-        # Find the scale with the most significant peak
-        peak = self.peaks[0]
-        for _ in range(1, len(self.scales)):
-            if self.peaks[_]['val'] > peak['val']:
-                peak = self.peaks[_]
+        if peak is None:
+            # Find the scale with the most significant peak
+            peak = max(self.peaks, key=lambda _: _['val'])
 
         source = dict()
         source['xpos'], source['ypos'] = peak['xpos'], peak['ypos']
@@ -231,46 +536,67 @@ class IterativeSourceDetector(object):
 
         For this prototype we simply roll our own using iminuit,
         this should probably be changed to astropy or Sherpa.
+        See `fit_gauss_source`.
         """
         log.debug('Fitting source parameters')
-        from iminuit import Minuit
-
-        def fit_stat(xpos, ypos, sigma, flux):
-            """Define CASH fit statistic for Gauss model"""
-            data = self.maps['counts']
-            # Note: No need to re-compute excess model for all previous source,
-            # that is already contained in the background in iter_maps.
-            background = self.iter_maps['background']
-            sources = [dict(xpos=xpos, ypos=ypos, sigma=sigma, flux=flux)]
-            model = background + self.model_excess(sources)
-            cash = stats.cash(data, model).sum()
-            return cash
-
         source = self.sources_guess[-1]
         log.debug('Source parameters before fit: {0}'.format(source))
-        pars = source.copy()
-        pars['error_xpos'] = 0.01
-        pars['error_ypos'] = 0.01
-        pars['error_flux'] = 0.1 * source['flux']
-        pars['error_sigma'] = 0.1 * source['sigma']
-        SIGMA_LIMITS = (0.01, 1e6)
-        pars['limit_sigma'] = SIGMA_LIMITS
-        # import IPython; IPython.embed(); 1 / 0
-        minuit = Minuit(fit_stat, pedantic=False, print_level=1, **pars)
-        # minuit.print_initial_param()
-        minuit.migrad(ncall=self.max_ncall)
-
-        source = minuit.values
+        # Note: No need to re-compute excess model for all previous source,
+        # that is already contained in the background in iter_maps.
+        source = fit_gauss_source(source, self.maps['counts'], self.iter_maps['background'],
+                                  self.maps['exposure'], self.maps['x'], self.maps['y'],
+                                  max_ncall=self.max_ncall)
         log.debug('Source parameters  after fit: {0}'.format(source))
+        self.sources.append(source)
+
+    def fit_sources_batch(self, sources_guess):
+        """Fit several well-separated sources independently.
+
+        Each source is fitted in a cutout of the maps around it, on top of
+        the current background. Sources with failed fits are dropped.
 
-        if not minuit.migrad_ok():
-            # If fit doesn't converge we simply abort
-            # TODO: should we use exceptions here or return False as signal?
-            minuit.print_fmin()
-            raise FitFailedError
+        Parameters
+        ----------
+        sources_guess : list of dict
+            Start parameters
+
+        Returns
+        -------
+        n_fitted : int
+            Number of successfully fitted sources
+        """
+        from functools import partial
+        log.debug('Fitting {0} sources'.format(len(sources_guess)))
+
+        tasks = []
+        for source in sources_guess:
+            # Leave room for the fit to enlarge the fit cutout
+            window = source_window(self.maps['counts'].shape, source['xpos'],
+                                   source['ypos'], source['sigma'], n_sigma=20)
+            task = dict(source=source,
+                        counts=self.maps['counts'][window],
+                        background=self.iter_maps['background'][window],
+                        exposure=self.maps['exposure'][window],
+                        x=self.maps['x'][window], y=self.maps['y'][window])
+            tasks.append(task)
+
+        fit = partial(_fit_gauss_source_task, max_ncall=self.max_ncall)
+        if self.parallel:
+            from multiprocessing import Pool
+            pool = Pool(processes=self.processes)
+            try:
+                results = pool.map(fit, tasks)
+            finally:
+                pool.close()
+                pool.join()
         else:
-            # Store best-fit source parameters
-            self.sources.append(source)
+            results = [fit(_) for _ in tasks]
+
+        sources = [_ for _ in results if _ is not None]
+        for source in sources:
+            log.debug('Source parameters  after fit: {0}'.format(source))
+        self.sources.extend(sources)
+        return len(sources)
 
     def estimate_flux(self, source, method='sum_and_divide'):
         """Estimate flux in a circular region around the source.
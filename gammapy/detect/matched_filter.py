@@ -2,7 +2,6 @@
 """Matched filter source detection methods"""
 from __future__ import print_function, division
 import numpy as np
-from ..image import process_image_pixels
 from ..stats import probability_to_significance_normal
 
 __all__ = ['probability_center',
@@ -60,30 +59,92 @@ def significance_center(images, kernel):
     return probability_to_significance_normal(probability)
 
 
-def probability_image(images, kernel):
+def _matched_filter_probability(U, B_prime, w2_B):
+    """Matched-filter p-value from the (unnormalised) kernel-weighted sums.
+
+    The kernel normalisation cancels in both arguments of ``Q``,
+    so sums with un-normalised or edge-cropped kernels can be used.
+    The sums are clipped at zero, because FFT round-off makes them
+    slightly negative in empty regions, where ``Q`` would return NaN.
+    """
+    from scipy.special import gammaincc as Q
+    U = np.clip(U, 0, None)
+    B_prime = np.clip(B_prime, 0, None)
+    w2_B = np.clip(w2_B, 0, None)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        w_equiv = w2_B / B_prime
+        return Q(B_prime / w_equiv, U / w_equiv)
+
+
+def probability_image(images, kernel, method='auto'):
     """Compute matched-filter p-value image.
 
+    This gives the same result as evaluating `probability_center` at every
+    pixel, with the kernel cut at the image edges and re-normalised.
+    The three kernel-weighted sums are computed as correlations of the full
+    images, for several kernels the transformed counts and background
+    images are re-used (see `~gammapy.utils.fft.FFTConvolver`).
+
     Parameters
     ----------
     images : dict of arrays
         Keys: 'counts', 'background'
-
-    kernel : array_like
+    kernel : array_like or list of array_like
+        Kernel (shape must be odd-valued), or list of kernels,
+        e.g. for several source sizes.
+    method : {'auto', 'fft', 'direct'}
+        Convolution method, see `~gammapy.utils.fft.FFTConvolver`.
 
     Returns
     -------
-    probability : array
+    probability : array or list of arrays
+        Probability image, or list of images if a list of kernels is given.
     """
-    out = np.zeros_like(images['counts'], dtype='float64')
-    process_image_pixels(images, kernel, out, probability_center)
-    return out
-
-
-def significance_image(images, kernel):
+    from ..utils.fft import FFTConvolver
+
+    counts = np.asanyarray(images['counts'], dtype='float64')
+    background = np.asanyarray(images['background'], dtype='float64')
+
+    if isinstance(kernel, (list, tuple)):
+        kernels = [np.asanyarray(_, dtype='float64') for _ in kernel]
+    else:
+        kernels = [np.asanyarray(kernel, dtype='float64')]
+
+    for _ in kernels:
+        if (_.shape[0] % 2 == 0) or (_.shape[1] % 2 == 0):
+            raise ValueError('Kernel shape must have odd dimensions')
+
+    # Correlation is convolution with the flipped kernel. Zero padding
+    # is equivalent to cropping the kernel at the image edges.
+    flipped = []
+    for w in kernels:
+        flipped += [w[::-1, ::-1], (w * w)[::-1, ::-1]]
+    convolver = FFTConvolver(counts.shape, flipped, mode='constant', method=method)
+
+    if all(convolver.direct):
+        counts_fft, background_fft = None, None
+    else:
+        counts_fft = convolver.transform(counts)
+        background_fft = convolver.transform(background)
+
+    probabilities = []
+    for idx in range(len(kernels)):
+        U = convolver.convolve(counts, index=2 * idx, image_fft=counts_fft)
+        B_prime = convolver.convolve(background, index=2 * idx, image_fft=background_fft)
+        w2_B = convolver.convolve(background, index=2 * idx + 1, image_fft=background_fft)
+        probabilities.append(_matched_filter_probability(U, B_prime, w2_B))
+
+    if isinstance(kernel, (list, tuple)):
+        return probabilities
+    return probabilities[0]
+
+
+def significance_image(images, kernel, method='auto'):
     """Compute matched-filter significance image.
 
     See `probability_image` docstring.
     """
-    probability = probability_image(images, kernel)
-    significance = probability_to_significance_normal(probability)
-    return significance
+    probability = probability_image(images, kernel, method=method)
+    if isinstance(probability, list):
+        return [probability_to_significance_normal(_) for _ in probability]
+    return probability_to_significance_normal(probability)
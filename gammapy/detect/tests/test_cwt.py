@@ -1,5 +1,7 @@
 # Licensed under a 3-clause BSD style license - see LICENSE.rst
 from __future__ import print_function, division
+import numpy as np
+from numpy.testing import assert_allclose, assert_equal
 from astropy.tests.helper import pytest
 from ...detect import CWT
 
@@ -10,9 +12,62 @@ except ImportError:
     HAS_SCIPY = False
 
 
+def make_test_data(shape=(50, 60)):
+    random_state = np.random.RandomState(seed=0)
+    background = np.ones(shape)
+    y, x = np.indices(shape)
+    source = 30 * np.exp(-0.5 * ((x - 20) ** 2 + (y - 25) ** 2) / 2 ** 2)
+    image = random_state.poisson(background + source).astype(float)
+    return image, background
+
+
 @pytest.mark.skipif('not HAS_SCIPY')
 def test_CWT():
     cwt = CWT(nscales=6, min_scale=6.0, scale_step=1.3)
 
     # TODO: run on test data
     assert 42 == 42
+
+
+@pytest.mark.skipif('not HAS_SCIPY')
+def test_CWT_do_transform():
+    from scipy.signal import fftconvolve
+    image, background = make_test_data()
+    cwt = CWT(nscales=3, min_scale=1.5, scale_step=1.3)
+    cwt.set_data(image, background)
+    cwt.model += 0.1
+    cwt.do_transform()
+
+    excess = image - cwt.model - background
+    for key, kern in cwt.kernbase.items():
+        desired = fftconvolve(excess, kern, mode='same')
+        assert_allclose(cwt.transform[key], desired, atol=1e-10)
+        desired = np.sqrt(fftconvolve(cwt.model + background, kern ** 2, mode='same'))
+        assert_allclose(cwt.error[key], desired, atol=1e-10)
+    desired = fftconvolve(excess, cwt.kern_approx, mode='same')
+    assert_allclose(cwt.approx, desired, atol=1e-10)
+
+
+@pytest.mark.skipif('not HAS_SCIPY')
+def test_CWT_compute_support_peak():
+    from scipy.ndimage import label
+    image, background = make_test_data()
+    cwt = CWT(nscales=3, min_scale=1.5, scale_step=1.3)
+    cwt.set_data(image, background)
+    cwt.do_transform()
+    cwt.compute_support_peak(nsigma=2, nsigmap=4)
+
+    # Compare with a simple loop over islands
+    sig = cwt.transform / cwt.error
+    for key in range(3):
+        tmp = sig[key] > 2
+        l, n = label(tmp)
+        for id in range(1, n + 1):
+            index = np.where(l == id)
+            if index[0].size == 1 or sig[key][index].max() < 4:
+                tmp[index] = False
+        assert_equal(cwt.support[key], tmp)
+    assert cwt.support.sum() > 0
+
+    cwt.iterative_filter_peak(nsigma=3, nsigmap=4, niter=2)
+    assert cwt.filter.max() > 0
@@ -1,7 +1,11 @@
 # Licensed under a 3-clause BSD style license - see LICENSE.rst
 from __future__ import print_function, division
+import numpy as np
+from numpy.testing import assert_allclose
 from astropy.tests.helper import pytest
 from ...detect import iterfind
+from ...image import disk_correlate
+from ...stats import Cash, significance
 
 try:
     import scipy
@@ -9,7 +13,146 @@ try:
 except ImportError:
     HAS_SCIPY = False
 
+try:
+    import iminuit
+    HAS_IMINUIT = True
+except ImportError:
+    HAS_IMINUIT = False
+
+
+def make_test_maps(shape=(40, 50), seed=0):
+    random_state = np.random.RandomState(seed=seed)
+    maps = dict()
+    maps['background'] = np.ones(shape)
+    maps['exposure'] = 1e3 * np.ones(shape)
+    maps['counts'] = random_state.poisson(maps['background']).astype(float)
+    return maps
+
+
+def test_gauss2d_cash_gradient():
+    maps = make_test_maps()
+    y, x = np.indices(maps['counts'].shape) + 1
+    kwargs = dict(x=x, y=y, background=maps['background'],
+                  exposure=maps['exposure'], stat=Cash(maps['counts'].ravel()))
+    pars = np.array([20.3, 15.6, 2.5, 0.1])
+
+    _, gradient = iterfind.gauss2d_cash(*pars, **kwargs)
+    for idx in range(4):
+        eps = np.zeros(4)
+        eps[idx] = 1e-6 * pars[idx]
+        hi = iterfind.gauss2d_cash(*(pars + eps), **kwargs)[0]
+        lo = iterfind.gauss2d_cash(*(pars - eps), **kwargs)[0]
+        assert_allclose(gradient[idx], (hi - lo) / (2 * eps[idx]), rtol=1e-4)
+
 
 @pytest.mark.skipif('not HAS_SCIPY')
-def test_IterativeSourceDetector():
-    pass
+def test_IterativeSourceDetector_compute_iter_maps():
+    maps = make_test_maps()
+    detector = iterfind.IterativeSourceDetector(maps, scales=[1, 3])
+    detector.compute_iter_maps()
+
+    # Add sources, the maps are updated incrementally
+    detector.sources.append(dict(xpos=10.5, ypos=12.2, sigma=1.5, flux=0.02))
+    detector.compute_iter_maps()
+    detector.sources.append(dict(xpos=48, ypos=3, sigma=2, flux=0.05))
+    detector.compute_iter_maps()
+
+    background = maps['background'] + detector.model_excess(detector.sources)
+    assert_allclose(detector.iter_maps['background'], background, rtol=1e-4)
+    for scale in detector.scales:
+        counts_corr = disk_correlate(maps['counts'], scale)
+        background_corr = disk_correlate(detector.iter_maps['background'], scale)
+        assert_allclose(detector.iter_maps['background_corr'][scale], background_corr)
+        actual = detector.iter_maps['significance'][scale]
+        assert_allclose(actual, significance(counts_corr, background_corr), atol=1e-6)
+
+
+@pytest.mark.skipif('not HAS_SCIPY')
+def test_IterativeSourceDetector_find_peak_candidates():
+    maps = make_test_maps(shape=(60, 80))
+    sources = [dict(xpos=15, ypos=20, sigma=1.5, flux=0.2),
+               dict(xpos=60, ypos=40, sigma=2, flux=0.3),
+               dict(xpos=63, ypos=43, sigma=1, flux=0.05),
+               dict(xpos=30, ypos=50, sigma=1, flux=0.1)]
+    excess = iterfind.IterativeSourceDetector(maps, scales=[1]).model_excess(sources)
+    random_state = np.random.RandomState(seed=1)
+    maps['counts'] = random_state.poisson(maps['background'] + excess).astype(float)
+
+    detector = iterfind.IterativeSourceDetector(maps, scales=[1, 2], batch=True,
+                                                min_separation=6)
+    detector.compute_iter_maps()
+    detector.find_peak_candidates()
+
+    # The faint source next to the bright one is not separated
+    assert len(detector.peaks) == 3
+    values = [_['val'] for _ in detector.peaks]
+    assert values == sorted(values, reverse=True)
+    positions = set((_['xpos'], _['ypos']) for _ in detector.peaks)
+    # Note: peak positions are pixel indices, source positions FITS pixels
+    for xpos, ypos in [(14, 19), (59, 39), (29, 49)]:
+        assert min(abs(xpos - x) + abs(ypos - y) for x, y in positions) <= 2
+
+
+def make_source_maps(sources, shape=(60, 80), seed=1):
+    """Test maps with Gaussian sources on a flat background."""
+    maps = make_test_maps(shape=shape)
+    excess = iterfind.IterativeSourceDetector(maps, scales=[1]).model_excess(sources)
+    random_state = np.random.RandomState(seed=seed)
+    maps['counts'] = random_state.poisson(maps['background'] + excess).astype(float)
+    return maps
+
+
+def assert_sources_found(found, sources, atol=1):
+    assert len(found) == len(sources)
+    for source in sources:
+        distance = [np.hypot(_['xpos'] - source['xpos'], _['ypos'] - source['ypos'])
+                    for _ in found]
+        assert min(distance) < atol
+
+
+@pytest.mark.skipif('not HAS_SCIPY or not HAS_IMINUIT')
+def test_fit_gauss_source_enlarge_cutout():
+    source = dict(xpos=40, ypos=30, sigma=4, flux=1)
+    maps = make_source_maps([source])
+    y, x = np.indices(maps['counts'].shape) + 1
+
+    # The start value of sigma is much too small for the fit cutout
+    guess = dict(xpos=40.5, ypos=29.5, sigma=0.5, flux=0.5)
+    result = iterfind.fit_gauss_source(guess, maps['counts'], maps['background'],
+                                       maps['exposure'], x, y)
+    assert_allclose(result['sigma'], 4, rtol=0.1)
+    assert_allclose(result['flux'], 1, rtol=0.1)
+    assert_sources_found([result], [source])
+
+
+@pytest.mark.skipif('not HAS_SCIPY or not HAS_IMINUIT')
+@pytest.mark.parametrize(('batch', 'parallel'), [(False, False), (True, False), (True, True)])
+def test_IterativeSourceDetector_run(batch, parallel):
+    sources = [dict(xpos=15, ypos=20, sigma=1.5, flux=0.2),
+               dict(xpos=60, ypos=40, sigma=2, flux=0.3),
+               dict(xpos=30, ypos=50, sigma=1, flux=0.1)]
+    maps = make_source_maps(sources)
+
+    detector = iterfind.IterativeSourceDetector(maps, scales=[1, 2], max_sources=5,
+                                                batch=batch, parallel=parallel,
+                                                processes=2)
+    detector.run()
+    assert_sources_found(detector.sources, sources)
+    if batch:
+        # All sources are well separated and found in the first iteration
+        assert len(detector.sources_guess) == 3
+
+
+@pytest.mark.skipif('not HAS_SCIPY or not HAS_IMINUIT')
+def test_IterativeSourceDetector_run_batch_max_sources():
+    sources = [dict(xpos=15, ypos=20, sigma=1.5, flux=0.2),
+               dict(xpos=60, ypos=40, sigma=2, flux=0.3),
+               dict(xpos=30, ypos=50, sigma=1, flux=0.1)]
+    maps = make_source_maps(sources)
+
+    # The first iteration already reaches max_sources
+    detector = iterfind.IterativeSourceDetector(maps, scales=[1, 2], max_sources=2,
+                                                batch=True)
+    detector.run()
+    assert len(detector.sources_guess) == 2
+    assert len(detector.sources) == 2
@@ -61,3 +61,45 @@ def test_image():
     significance = matched_filter.significance_image(images, kernel)
     # TODO: try to get a verified result
     assert_allclose(significance.max(), 7.2493488182450569)
+
+
+@pytest.mark.skipif('not HAS_SCIPY')
+@pytest.mark.parametrize('method', ['direct', 'fft'])
+def test_image_vs_center(method):
+    random_state = np.random.RandomState(seed=0)
+    background = random_state.uniform(1, 2, size=(12, 15))
+    counts = random_state.poisson(background).astype(float)
+    images = dict(counts=counts, background=background)
+    kernels = [Gaussian2DKernel(1, x_size=5, y_size=5).array,
+               Gaussian2DKernel(2, x_size=7, y_size=9).array]
+
+    probabilities = matched_filter.probability_image(images, kernels, method=method)
+    significances = matched_filter.significance_image(images, kernels, method=method)
+
+    for kernel, probability, significance in zip(kernels, probabilities, significances):
+        h0, h1 = kernel.shape[0] // 2, kernel.shape[1] // 2
+        for i0, i1 in [(0, 0), (5, 7), (11, 14), (3, 13)]:
+            # Cut kernel and images at the image edges
+            y0, y1 = max(i0 - h0, 0), min(i0 + h0 + 1, counts.shape[0])
+            x0, x1 = max(i1 - h1, 0), min(i1 + h1 + 1, counts.shape[1])
+            parts = dict(counts=counts[y0:y1, x0:x1], background=background[y0:y1, x0:x1])
+            kernel_part = kernel[y0 - i0 + h0: y1 - i0 + h0, x0 - i1 + h1: x1 - i1 + h1]
+            desired = matched_filter.probability_center(parts, kernel_part)
+            assert_allclose(probability[i0, i1], desired, rtol=1e-6)
+            desired = matched_filter.significance_center(parts, kernel_part)
+            assert_allclose(significance[i0, i1], desired, rtol=1e-6)
+
+
+@pytest.mark.skipif('not HAS_SCIPY')
+def test_image_sparse_counts():
+    # FFT round-off in empty regions must not give NaN
+    random_state = np.random.RandomState(seed=0)
+    background = 0.01 * np.ones((200, 200))
+    counts = random_state.poisson(background).astype(float)
+    images = dict(counts=counts, background=background)
+    kernel = Gaussian2DKernel(3).array
+
+    probability = matched_filter.probability_image(images, kernel, method='fft')
+    desired = matched_filter.probability_image(images, kernel, method='direct')
+    assert np.all(np.isfinite(probability))
+    assert_allclose(probability, desired, atol=1e-10)
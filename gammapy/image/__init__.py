@@ -5,3 +5,4 @@ from .measure import *
 from .profile import *
 from .plotting import *
 from .catalog import *
+from .tiling import *
@@ -1,38 +1,122 @@
 # Licensed under a 3-clause BSD style license - see LICENSE.rst
 """ Make an image from a source catalog, or simulated catalog, e.g 1FHL 2FGL etc
 """
+from __future__ import print_function, division
+from collections import OrderedDict
 import numpy as np
 from astropy.coordinates import Angle
 from astropy.wcs import WCS
 from astropy.units import Quantity
 from astropy.table import Table
 from . import coordinates
+from .utils import _paste_array
 
 __all__ = ['catalog_image', 'catalog_table']
 
+# Morphology types (``morph_type`` column) rendered as extended sources
+EXTENDED_MORPH_TYPES = ['gauss2d', 'shell2d', 'sphere2d']
 
-def _extended_image(catalog, reference_cube):
-    """Reprojects and adds extended source images to a larger survey image.
+# Shell width as a fraction of the outer radius for shell2d sources
+SHELL_WIDTH_FRACTION = 0.1
+
+# PSF kernels, cached per PSF, energy band and pixel size.
+# Least recently used kernels are removed if there are more than
+# ``PSF_KERNEL_CACHE_SIZE``, the cache keeps the PSFs of its kernels alive.
+PSF_KERNEL_CACHE_SIZE = 32
+_psf_kernel_cache = OrderedDict()
+
+
+def _source_positions(source_table, wcs, shape):
+    """Pixel positions of catalog sources, for all sources in one WCS call.
+
+    Returns
+    -------
+    x, y : `~numpy.ndarray`
+        Pixel coordinates
+    inside : `~numpy.ndarray`
+        Mask of sources within the image footprint
     """
-    # This import is here instead of at the top to avoid an ImportError
-    # due to circular dependencies
-    from ..datasets import fetch_fermi_extended_sources
-    from ..data import SpectralCube
+    footprint = wcs.calc_footprint()
+    glon_max, glon_min = footprint[0][0], footprint[2][0] - 360
+    glat_min, glat_max = footprint[0][1], footprint[1][1]
+
+    lon = np.asarray(source_table['GLON'], dtype=float)
+    lon = np.where(lon >= 180, lon - 360, lon)
+    lat = np.asarray(source_table['GLAT'], dtype=float)
+    inside = (glon_min < lon) & (lon < glon_max) & (glat_min < lat) & (lat < glat_max)
+
+    origin = 0  # convention for gammapy
+    x, y = wcs.wcs_world2pix(lon, lat, origin)
+    ny, nx = shape
+    inside &= (x >= -0.5) & (x < nx - 0.5) & (y >= -0.5) & (y < ny - 0.5)
+    return x, y, inside
+
+
+def _extended_source_cutout(morph_type, extension, x, y, oversample=4):
+    """Source image cutout for an extended source (pixel units).
+
+    Parameters
+    ----------
+    morph_type : {'gauss2d', 'shell2d', 'sphere2d'}
+        Morphology type
+    extension : float
+        Gaussian sigma or outer radius in pixels
+    x, y : float
+        Source position in pixels
+    oversample : int
+        Number of sub-pixels per pixel and axis
+
+    Returns
+    -------
+    cutout : `~numpy.ndarray`
+        Source image normalised to sum one
+    x_lo, y_lo : int
+        Position of the cutout lower left pixel in the image
+    """
+    from ..morphology import Shell2D, Sphere2D
+    if morph_type == 'gauss2d':
+        size = 5 * extension
+    else:
+        size = extension + 1
+    size = int(np.ceil(size))
+    x_lo = int(np.round(x)) - size
+    y_lo = int(np.round(y)) - size
+    n_pix = 2 * size + 1
+    # Evaluate on a sub-pixel grid, so that thin shells are sampled well
+    offsets = (np.arange(oversample) + 0.5) / oversample - 0.5
+    yy = (y_lo + np.arange(n_pix)[:, np.newaxis] + offsets).reshape(-1, 1)
+    xx = (x_lo + np.arange(n_pix)[:, np.newaxis] + offsets).reshape(1, -1)
+
+    if morph_type == 'gauss2d':
+        rr = (xx - x) ** 2 + (yy - y) ** 2
+        cutout = np.exp(-0.5 * rr / extension ** 2)
+    elif morph_type == 'shell2d':
+        width = SHELL_WIDTH_FRACTION * extension
+        cutout = Shell2D.evaluate(xx, yy, 1, x, y, extension - width, width)
+    elif morph_type == 'sphere2d':
+        cutout = Sphere2D.evaluate(xx, yy, 1, x, y, extension)
+    else:
+        raise ValueError('Invalid morph_type: {0}'.format(morph_type))
 
-    # Note that the first extended source fits file is unreadable...
-    hdu_list = fetch_fermi_extended_sources(catalog)[1:]
-    for source in hdu_list:
-        source_wcs = WCS(source.header)
-        source_spec_cube = SpectralCube(data=Quantity(np.array([source.data]), ''),
-                                        wcs=source_wcs, energy=energy)
-        new_source_cube = source_spec_cube.reproject_to(reference_cube)
-        # TODO: Fix this hack
-        reference_cube.data = reference_cube.data + np.nan_to_num(new_source_cube.data * 1e-30)
-    return reference_cube.data[0]
+    cutout = cutout.reshape(n_pix, oversample, n_pix, oversample).sum(axis=(1, 3))
+    total = cutout.sum()
+    if total > 0:
+        cutout /= total
+    return cutout, x_lo, y_lo
 
 
-def _source_image(catalog, reference_cube, sim_table=None, total_flux=True):
+def _source_image(catalog, reference_cube, sim_table=None, total_flux=True,
+                  source_type='point'):
     """Adds point sources to a larger survey image.
+
+    All source positions are transformed in one WCS call and point source
+    fluxes are added with `numpy.add.at`. For ``source_type='extended'``
+    or ``'all'``, sources with a morphology type in `EXTENDED_MORPH_TYPES`
+    and an extension of at least half a pixel are rendered as small cutouts.
+    The extension is chosen per source: the Gaussian sigma of ``gauss2d``
+    sources is taken from the ``sigma`` column if present (otherwise from
+    ``angular_extension``), the outer radius of ``shell2d`` and ``sphere2d``
+    sources from ``angular_extension``.
     """
     new_image = np.zeros_like(reference_cube.data, dtype=np.float64)
     if sim_table is None:
@@ -40,35 +124,90 @@ def _source_image(catalog, reference_cube, sim_table=None, total_flux=True):
     else:
         source_table = sim_table
     energies = source_table.meta['Energy Bins']
-    wcs_reference = reference_cube.wcs
-    footprint = wcs_reference.calc_footprint()
-    glon_max, glon_min = footprint[0][0], footprint[2][0] - 360
-    glat_min, glat_max = footprint[0][1], footprint[1][1]
-    for source in np.arange(len(source_table['flux'])):
-        lon = source_table['GLON'][source]
-        if lon >= 180:
-            lon = lon - 360
-        if (glon_min < lon) & (lon < glon_max):
-            lat = source_table['GLAT'][source]
-            if (glat_min < lat) & (lat < glat_max):
-                flux = source_table['flux'][source]
-                wcs = reference_cube.wcs
-                origin = 0  # convention for gammapy
-                x, y = wcs.wcs_world2pix(lon, lat, origin)
-                xi, yi = x.astype(int), y.astype(int)
-                new_image[yi, xi] = new_image[yi, xi] + flux
+    wcs = reference_cube.wcs
+    x, y, inside = _source_positions(source_table, wcs, new_image.shape)
+    flux = np.asarray(source_table['flux'], dtype=float)
+
+    extended = np.zeros(len(source_table), dtype=bool)
+    if source_type in ['extended', 'all'] and 'morph_type' in source_table.colnames:
+        morph_type = np.asarray(source_table['morph_type']).astype(str)
+        if 'angular_extension' in source_table.colnames:
+            extension = np.asarray(source_table['angular_extension'], dtype=float)
+        else:
+            extension = np.zeros(len(source_table))
+        if 'sigma' in source_table.colnames:
+            sigma = np.asarray(source_table['sigma'], dtype=float)
+            extension = np.where(morph_type == 'gauss2d', sigma, extension)
+        extension = extension / abs(wcs.wcs.cdelt[1])
+        is_extended = [morph_type == _ for _ in EXTENDED_MORPH_TYPES]
+        extended = np.any(is_extended, axis=0) & (extension >= 0.5)
+        for idx in np.flatnonzero(inside & extended):
+            cutout, x_lo, y_lo = _extended_source_cutout(morph_type[idx], extension[idx],
+                                                         x[idx], y[idx])
+            _paste_array(new_image, flux[idx] * cutout, x_lo, y_lo)
+
+    if source_type in ['point', 'all']:
+        point = inside & ~extended
+    else:
+        point = np.zeros_like(inside)
+    xi, yi = x[point].astype(int), y[point].astype(int)
+    np.add.at(new_image, (yi, xi), flux[point])
+
     if total_flux:
-        factor = source_table['flux'].sum() / new_image.sum()
+        factor = flux.sum() / new_image.sum()
     else:
         factor = 1
 
     return new_image * factor, energies
 
 
+def _psf_kernel(psf, energy_band, resolution, offset_max=Angle(5, 'deg')):
+    """PSF kernel image for an energy band, cached.
+
+    Parameters
+    ----------
+    psf : `~gammapy.irf.EnergyDependentTablePSF`
+        PSF
+    energy_band : `~astropy.units.Quantity`
+        Energy band
+    resolution : float
+        Pixel size in degree
+    offset_max : `~astropy.coordinates.Angle`
+        Kernel radius
+
+    Returns
+    -------
+    kernel : `~numpy.ndarray`
+        Normalised kernel
+    """
+    key = (id(psf), tuple(energy_band.to('GeV').value), resolution,
+           offset_max.degree)
+    if key in _psf_kernel_cache and _psf_kernel_cache[key][0] is psf:
+        value = _psf_kernel_cache.pop(key)
+        _psf_kernel_cache[key] = value
+        return value[1]
+
+    table_psf = psf.table_psf_in_energy_band(energy_band)
+    kernel = table_psf.kernel(pixel_size=Angle(resolution, 'deg'),
+                              offset_max=offset_max, normalize=True)
+    kernel = np.asarray(kernel, dtype=float)
+    # Keep a reference to the PSF, so that its id isn't re-used
+    _psf_kernel_cache.pop(key, None)
+    _psf_kernel_cache[key] = (psf, kernel)
+    while len(_psf_kernel_cache) > PSF_KERNEL_CACHE_SIZE:
+        _psf_kernel_cache.popitem(last=False)
+    return kernel
+
+
 def catalog_image(reference, psf, catalog='1FHL', source_type='point',
-                  total_flux=False, sim_table=None):
+                  total_flux=False, sim_table=None, energy_bands=None,
+                  spectral_index=2):
     """Creates an image from a simulated catalog, or from 1FHL or 2FGL sources.
 
+    The source image is rendered once (see `_source_image`) and convolved
+    with the PSF for each energy band by FFT. PSF kernels are cached, so
+    rendering many images for the same PSF and binning is fast.
+
     Parameters
     ----------
     reference : `~fits.ImageHDU`
@@ -80,68 +219,73 @@ def catalog_image(reference, psf, catalog='1FHL', source_type='point',
         If 'simulation' is used, sim_table must also be provided.
     source_type : {'point', 'extended', 'all'}
         Specify whether point or extended sources should be included, or both.
-        TODO: Currently only 'point' is implemented.
+        Extended sources are only supported for simulated catalogs, they
+        are defined by the ``morph_type`` column (see `EXTENDED_MORPH_TYPES`).
     total_flux : bool
         Specify whether to conserve total flux.
     sim_table : `~astropy.table.Table`
         Table of simulated point sources. Only required if catalog = 'simulation'
+    energy_bands : `~astropy.units.Quantity`, optional
+        Energy band edges. If given, one image per band is computed, with
+        the flux split according to a power law with ``spectral_index``
+        over the catalog energy range. By default one image for the whole
+        catalog energy range is computed.
+    spectral_index : float
+        Spectral index used to split the flux into energy bands.
 
     Returns
     -------
     out_cube : `~gammapy.data.SpectralCube`
-        2D Spectral cube containing the image.
-
-    Notes
-    -----
-    This is currently only implemented for a single energy band.
+        2D Spectral cube containing the image
+        (3D with one image per band if ``energy_bands`` is given).
     """
-    from scipy.ndimage import convolve
     # This import is here instead of at the top to avoid an ImportError
     # due to circular dependencies
     from ..data import SpectralCube
+    from ..utils.fft import FFTConvolver
 
-    lons, lats = coordinates(reference)
     wcs = WCS(reference.header)
     # Uses dummy energy for now to construct spectral cube
     # TODO : Fix this hack
     reference_cube = SpectralCube(data=Quantity(np.array(reference.data), ''),
                                   wcs=wcs, energy=Quantity([0, 1], 'GeV'))
 
-    if source_type == 'extended':
-        raise NotImplementedError
-        # TODO: Currently fluxes are not correct for extended sources.
-        new_image = _extended_image(catalog, reference_cube)
-
-    elif source_type == 'point':
-        new_image, energy = _source_image(catalog, reference_cube,
-                                          sim_table, total_flux)
+    if source_type not in ['point', 'extended', 'all']:
+        raise ValueError('Invalid source_type: {0}'.format(source_type))
+    if source_type != 'point' and sim_table is None:
+        raise ValueError("source_type '{0}' requires a sim_table, extended sources "
+                         "are only supported for simulated catalogs".format(source_type))
 
-    elif source_type == 'all':
-        raise NotImplementedError
-        # TODO: Currently Extended Sources do not work
-        extended = _extended_image(catalog, reference_cube)
-        point_source = _source_image(catalog, reference_cube, total_flux=True)[0]
-        new_image = extended + point_source
+    new_image, energy = _source_image(catalog, reference_cube, sim_table,
+                                      total_flux, source_type)
 
+    e_min, e_max = np.min(energy), np.max(energy)
+    if energy_bands is None:
+        bands = [Quantity([e_min.value, e_max.value], energy.unit)]
+        fractions = [1]
     else:
-        raise ValueError
-
-    total_point_image = SpectralCube(data=new_image, wcs=wcs, energy=energy)
-    convolved_cube = new_image.copy()
-
-    psf = psf.table_psf_in_energy_band(Quantity([np.min(energy).value,
-                                       np.max(energy).value], energy.unit))
+        energy_bands = energy_bands.to(energy.unit)
+        bands = [energy_bands[idx:idx + 2] for idx in range(len(energy_bands) - 1)]
+        g = 1 - spectral_index
+        if g == 0:
+            integral = lambda e1, e2: np.log((e2 / e1).value)
+        else:
+            integral = lambda e1, e2: (e2.value ** g - e1.value ** g) / g
+        norm = integral(e_min, e_max)
+        fractions = [integral(band[0], band[1]) / norm for band in bands]
 
     resolution = abs(reference.header['CDELT1'])
-
-    kernel_array = psf.kernel(pixel_size=Angle(resolution, 'deg'),
-                              offset_max=Angle(5, 'deg'), normalize=True)
-
-    convolved_cube = convolve(new_image, kernel_array, mode='constant')
-
-    out_cube = SpectralCube(data=Quantity(convolved_cube, ''),
-                            wcs=total_point_image.wcs,
-                            energy=energy)
+    kernels = [_psf_kernel(psf, band, resolution) for band in bands]
+    convolver = FFTConvolver(new_image.shape, kernels, mode='constant')
+    images = convolver.convolve_all(new_image)
+    images *= np.array(fractions)[:, np.newaxis, np.newaxis]
+
+    if energy_bands is None:
+        out_cube = SpectralCube(data=Quantity(images[0], ''), wcs=wcs,
+                                energy=energy)
+    else:
+        out_cube = SpectralCube(data=Quantity(images, ''), wcs=wcs,
+                                energy=energy_bands)
 
     return out_cube
 
@@ -184,38 +184,115 @@ def measure_labeled_regions(data, labels, tag='IMAGE',
 
     Sources are defined by a label image.
 
+    All properties are computed from one pass over the image:
+    the labeled pixels are selected and sorted by label once, then sums
+    are computed with `numpy.bincount` and maxima, peak positions and
+    bounding boxes with `numpy.ufunc.reduceat` on the sorted pixels.
+    This is fast also for large images with many labels.
+
     Parameters
     ----------
-    TODO
+    data : array_like or dict of array_like
+        Data image, or dict of data images with the same shape
+        (e.g. counts, background, exposure, significance).
+    labels : array_like
+        Label image (int). Label 0 is background and not measured,
+        regions ``1`` to ``labels.max()`` are measured.
+    tag : str
+        Column name prefix for the values measured in ``data``.
+        If ``data`` is a dict, the dict keys are used as column name
+        prefixes and positions are measured in the image ``data[tag]``.
+    measure_positions : bool
+        Measure centroid, second moments, peak position, bounding box and area?
+    measure_values : bool
+        Measure maximum, sum and mean of the data images?
+    fits_offset : bool
+        Use FITS convention for pixel positions, i.e. start counting at 1?
+    bbox_offset : bool
+        Use SExtractor convention for the bounding box, i.e. maximum is inside?
 
     Returns
     -------
-    TODO
+    table : `~astropy.table.Table`
+        Table with one row per label. Columns ``X2_IMAGE``, ``Y2_IMAGE`` and
+        ``XY_IMAGE`` are the intensity-weighted second central moments.
+        Labels without pixels have zero area, NaN positions and values
+        and an invalid bounding box.
     """
-    import scipy.ndimage as nd
     from astropy.table import Table, Column
-    # Measure all segments
-    nsegments = labels.max()
-    index = np.arange(1, nsegments + 1)  # Measure all sources
-    # Measure stuff
-    sum = nd.sum(data, labels, index)
-    max = nd.maximum(data, labels, index)
-    mean = nd.mean(data, labels, index)
-    x, y = _split_xys(nd.center_of_mass(data, labels, index))
-    xpeak, ypeak = _split_xys(nd.maximum_position(data, labels, index))
-    xmin, xmax, ymin, ymax = _split_slices(nd.find_objects(labels))
-    area = _measure_area(labels)
-    # Use FITS convention, i.e. start counting at 1
-    FITS_OFFSET = 1 if fits_offset else 0
-    # Use SExtractor convention, i.e. slice max is inside
-    BBOX_OFFSET = -1 if bbox_offset else 0
-    # Create a table
+    if isinstance(data, dict):
+        images = data
+        if tag not in images:
+            raise ValueError('Position image not found: {0}'.format(tag))
+    else:
+        images = {tag: data}
+
+    labels = np.asanyarray(labels)
+    n_labels = int(labels.max()) if labels.size else 0
+    index = np.arange(1, n_labels + 1)
+    pix, label, starts = _labeled_pixels(labels)
+    present = label[starts]
+    # Position of each label in the output arrays
+    rows = present - 1
+    area = np.bincount(label, minlength=n_labels + 1)[1:]
+
+    def sums(weights):
+        return np.bincount(label, weights=weights, minlength=n_labels + 1)[1:]
+
+    def maxima(values):
+        result = np.nan * np.ones(n_labels)
+        if len(starts):
+            result[rows] = np.maximum.reduceat(values, starts)
+        return result
+
+    values = dict()
+    for name, image in images.items():
+        values[name] = np.asanyarray(image, dtype=np.float64).reshape(-1)[pix]
+
     table = Table()
     table.add_column(Column(data=index, name='NUMBER'))
 
     if measure_positions:
-        table.add_column(Column(data=x + FITS_OFFSET, name='X_IMAGE'))
-        table.add_column(Column(data=y + FITS_OFFSET, name='Y_IMAGE'))
+        # Use FITS convention, i.e. start counting at 1
+        FITS_OFFSET = 1 if fits_offset else 0
+        # Use SExtractor convention, i.e. slice max is inside
+        BBOX_OFFSET = -1 if bbox_offset else 0
+        y, x = np.divmod(pix, labels.shape[-1])
+
+        # Intensity-weighted centroid and second central moments
+        w = values[tag]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            w_sum = sums(w)
+            xc = sums(w * x) / w_sum
+            yc = sums(w * y) / w_sum
+            dx = x - xc[label - 1]
+            dy = y - yc[label - 1]
+            x2 = sums(w * dx * dx) / w_sum
+            y2 = sums(w * dy * dy) / w_sum
+            xy = sums(w * dx * dy) / w_sum
+
+        # Peak position: first pixel (in image order) with the maximum value
+        w_max = maxima(w)
+        peak = np.zeros(n_labels, dtype=pix.dtype)
+        is_max = (w == w_max[label - 1]) | np.isnan(w_max[label - 1])
+        if len(starts):
+            peak[rows] = np.minimum.reduceat(np.where(is_max, pix, pix.max() + 1), starts)
+        ypeak, xpeak = np.divmod(peak, labels.shape[-1])
+
+        # Bounding box (slice convention, i.e. max is outside)
+        xmin, xmax, ymin, ymax = [-np.ones(n_labels, dtype=int) for _ in range(4)]
+        if len(starts):
+            xmin[rows] = np.minimum.reduceat(x, starts)
+            xmax[rows] = np.maximum.reduceat(x, starts) + 1
+            ymin[rows] = np.minimum.reduceat(y, starts)
+            ymax[rows] = np.maximum.reduceat(y, starts) + 1
+
+        empty = (area == 0)
+        xpeak, ypeak = xpeak.astype(float), ypeak.astype(float)
+        xpeak[empty], ypeak[empty] = np.nan, np.nan
+
+        table.add_column(Column(data=xc + FITS_OFFSET, name='X_IMAGE'))
+        table.add_column(Column(data=yc + FITS_OFFSET, name='Y_IMAGE'))
         table.add_column(Column(data=xpeak + FITS_OFFSET, name='XPEAK_IMAGE'))
         table.add_column(Column(data=ypeak + FITS_OFFSET, name='YPEAK_IMAGE'))
         table.add_column(Column(data=xmin + FITS_OFFSET, name='XMIN_IMAGE'))
@@ -223,11 +300,18 @@ def measure_labeled_regions(data, labels, tag='IMAGE',
         table.add_column(Column(data=ymin + FITS_OFFSET, name='YMIN_IMAGE'))
         table.add_column(Column(data=ymax + FITS_OFFSET + BBOX_OFFSET, name='YMAX_IMAGE'))
         table.add_column(Column(data=area, name='AREA'))
+        table.add_column(Column(data=x2, name='X2_IMAGE'))
+        table.add_column(Column(data=y2, name='Y2_IMAGE'))
+        table.add_column(Column(data=xy, name='XY_IMAGE'))
 
     if measure_values:
-        table.add_column(Column(data=max, name=tag + '_MAX'))
-        table.add_column(Column(data=sum, name=tag + '_SUM'))
-        table.add_column(Column(data=mean, name=tag + '_MEAN'))
+        for name in sorted(values, key=lambda _: _ != tag):
+            total = sums(values[name])
+            with np.errstate(invalid='ignore', divide='ignore'):
+                mean = total / area
+            table.add_column(Column(data=maxima(values[name]), name=name + '_MAX'))
+            table.add_column(Column(data=total, name=name + '_SUM'))
+            table.add_column(Column(data=mean, name=name + '_MEAN'))
 
     return table
 
@@ -362,6 +446,104 @@ def measure_image_moments(image):
     return A, x_cms, y_cms, x_sigma, y_sigma, np.sqrt(x_sigma * y_sigma)
 
 
+def _radial_profile(rr, data):
+    """Cumulative image sum as a function of distance.
+
+    Parameters
+    ----------
+    rr : array
+        Squared distance of each pixel.
+    data : array
+        Image values, non-finite values must have been replaced by zero.
+
+    Returns
+    -------
+    rr_sorted : array
+        Sorted squared distances (1-dim)
+    cumsum : array
+        ``cumsum[i]`` is the sum of the ``i`` pixels closest to the position,
+        i.e. ``cumsum[0] = 0`` and ``len(cumsum) = len(rr_sorted) + 1``.
+    """
+    rr = rr.ravel()
+    order = np.argsort(rr, kind='mergesort')
+    cumsum = np.empty(rr.size + 1)
+    cumsum[0] = 0
+    np.cumsum(data.ravel()[order], out=cumsum[1:])
+    return rr[order], cumsum
+
+
+class _RadialProfiles(object):
+    """Radial profiles around positions in one image.
+
+    Coordinate images, pixel scale and the image with non-finite values
+    set to zero are computed once and re-used for all positions.
+    Profiles are computed in square cutouts around the positions.
+    """
+
+    def __init__(self, image):
+        from astropy.wcs import WCS
+        from astropy.wcs.utils import proj_plane_pixel_scales
+        self.wcs = WCS(image.header)
+        self.glon, self.glat = coordinates(image, lon_sym=True)
+        data = image.data
+        self.data = np.where(np.isfinite(data), data, 0)
+        self.pixel_scale = proj_plane_pixel_scales(self.wcs).min()
+
+    def cutout(self, glon, glat, radius):
+        """Cutout containing the circle of given radius (slices).
+
+        The pixel scale is only known at the reference pixel, for other
+        projections than CAR it changes across the image. The cutout is
+        therefore grown until the pixels on its border (except at the image
+        edges) are outside of the circle.
+
+        Returns ``None`` if the cutout covers the whole image.
+        """
+        x, y = self.wcs.wcs_world2pix(glon, glat, 0)
+        x, y = int(np.round(x)), int(np.round(y))
+        ny, nx = self.data.shape
+        n = int(np.ceil(radius / self.pixel_scale)) + 2
+        while True:
+            if x - n <= 0 and y - n <= 0 and x + n >= nx - 1 and y + n >= ny - 1:
+                return None
+            window = (slice(np.clip(y - n, 0, ny), np.clip(y + n + 1, 0, ny)),
+                      slice(np.clip(x - n, 0, nx), np.clip(x + n + 1, 0, nx)))
+            if self._border_distance(glon, glat, window) > radius:
+                return window
+            n *= 2
+
+    def _border_distance(self, glon, glat, window):
+        """Smallest distance of the pixels on the cutout border to a position."""
+        (ys, xs), (ny, nx) = window, self.data.shape
+        borders = []
+        if ys.start > 0:
+            borders.append((ys.start, xs))
+        if ys.stop < ny:
+            borders.append((ys.stop - 1, xs))
+        if xs.start > 0:
+            borders.append((ys, xs.start))
+        if xs.stop < nx:
+            borders.append((ys, xs.stop - 1))
+
+        rr_min = np.inf
+        for border in borders:
+            rr = (self.glon[border] - glon) ** 2 + (self.glat[border] - glat) ** 2
+            if rr.size:
+                rr_min = min(rr_min, rr.min())
+        return np.sqrt(rr_min)
+
+    def profile(self, glon, glat, window=None):
+        """Radial profile around a position, see `_radial_profile`.
+
+        Only pixels within ``window`` (slices, see `cutout`) are used,
+        all pixels if ``window=None``.
+        """
+        if window is None:
+            window = Ellipsis
+        rr = (self.glon[window] - glon) ** 2 + (self.glat[window] - glat) ** 2
+        return _radial_profile(rr, self.data[window])
+
+
 def measure_containment(image, glon, glat, radius):
     """
     Measure containment in a given circle around the source position.
@@ -370,51 +552,85 @@ def measure_containment(image, glon, glat, radius):
     ----------
     image : `astropy.io.fits.ImageHDU`
         Image to measure on.
-    glon : float
+    glon : float or array_like
         Source longitude in degree.
-    glat : float
+    glat : float or array_like
         Source latitude in degree.
-    radius : float
+    radius : float or array_like
         Radius of the region to measure the containment in.
+
+    Returns
+    -------
+    containment : float or array
+        Sum of the finite image values within the circle,
+        array of shape ``glon.shape + radius.shape`` for array inputs.
     """
-    GLON, GLAT = coordinates(image, lon_sym=True)
-    rr = (GLON - glon) ** 2 + (GLAT - glat) ** 2
-    return measure_containment_fraction(radius, rr, image.data)
+    profiles = _RadialProfiles(image)
+    radius = np.asanyarray(radius, dtype=float)
+    glon, glat = np.broadcast_arrays(np.asanyarray(glon, dtype=float),
+                                     np.asanyarray(glat, dtype=float))
+
+    containment = np.empty(glon.shape + radius.shape)
+    for idx in np.ndindex(glon.shape):
+        window = profiles.cutout(glon[idx], glat[idx], radius.max())
+        rr, cumsum = profiles.profile(glon[idx], glat[idx], window)
+        containment[idx] = cumsum[np.searchsorted(rr, radius ** 2, side='left')]
+
+    if containment.ndim == 0:
+        return containment[()]
+    return containment
 
 
 def measure_containment_radius(image, glon, glat, containment_fraction=0.8):
     """Measure containment radius.
 
-    Uses `scipy.optimize.brentq`.
+    The image is normalised to the sum of its finite values. The radius
+    is found by linear interpolation of the cumulative radial profile,
+    the profile is computed in growing cutouts around the source,
+    until they contain the requested fraction.
 
     Parameters
     ----------
     image : `astropy.io.fits.ImageHDU`
         Image to measure on.
-    glon : float
+    glon : float or array_like
         Source longitude in degree.
-    glat : float
+    glat : float or array_like
         Source latitude in degree.
-    containment_fraction : float (default 0.8)
+    containment_fraction : float or array_like (default 0.8)
         Containment fraction
 
     Returns
     -------
-    containment_radius : float
-        Containment radius (pix)
+    containment_radius : float or array
+        Containment radius (deg), array of shape
+        ``glon.shape + containment_fraction.shape`` for array inputs.
     """
-    from scipy.optimize import brentq
-
-    GLON, GLAT = coordinates(image, lon_sym=True)
-    rr = (GLON - glon) ** 2 + (GLAT - glat) ** 2
-
-    # Normalize image
-    image.data = image.data / image.data[np.isfinite(image.data)].sum()
-
-    def func(r):
-        return measure_containment_fraction(r, rr, image.data) - containment_fraction
-
-    containment_radius = brentq(func, a=0, b=np.sqrt(rr.max()))
+    profiles = _RadialProfiles(image)
+    fraction = np.asanyarray(containment_fraction, dtype=float)
+    glon, glat = np.broadcast_arrays(np.asanyarray(glon, dtype=float),
+                                     np.asanyarray(glat, dtype=float))
+    target = fraction * profiles.data.sum()
+
+    containment_radius = np.empty(glon.shape + fraction.shape)
+    for idx in np.ndindex(glon.shape):
+        radius = 16 * profiles.pixel_scale
+        while True:
+            window = profiles.cutout(glon[idx], glat[idx], radius)
+            rr, cumsum = profiles.profile(glon[idx], glat[idx], window)
+            if window is None:
+                n_pix = len(rr)
+                break
+            # Only the circle inside the cutout is complete
+            n_pix = np.searchsorted(rr, radius ** 2, side='right')
+            if cumsum[n_pix] >= target.max():
+                break
+            radius *= 2
+        containment_radius[idx] = np.interp(target, cumsum[1:n_pix + 1],
+                                            np.sqrt(rr[:n_pix]))
+
+    if containment_radius.ndim == 0:
+        return containment_radius[()]
     return containment_radius
 
 
@@ -453,9 +669,9 @@ def measure_curve_of_growth(image, glon, glat, r_max=0.2, delta_r=0.01):
     ----------
     image : `astropy.io.fits.ImageHDU`
         Image to measure on.
-    glon : float
+    glon : float or array_like
         Source longitude in degree.
-    glat : float
+    glat : float or array_like
         Source latitude in degree.
     r_max : float (default 0.2)
         Maximal radius, up to which the containment is measured in degree.
@@ -467,39 +683,34 @@ def measure_curve_of_growth(image, glon, glat, r_max=0.2, delta_r=0.01):
     radii : array
         Radii where the containment was measured.
     containment : array
-        Corresponding contained flux.
+        Corresponding contained flux, shape ``glon.shape + radii.shape``
+        for several source positions.
     """
-    containment = []
     radii = np.arange(0, r_max, delta_r)
-    for radius in radii:
-        containment.append(measure_containment(image, glon, glat, radius))
-    return radii, np.array(containment)
-
-
-def _split_xys(pos):
-    """Helper function to work with `scipy.ndimage`."""
-    x = np.array(pos)[:, 1]
-    y = np.array(pos)[:, 0]
-    return x, y
-
-
-def _split_slices(slices):
-    """Helper function to work with `scipy.ndimage`."""
-    # scipy.ndimage.find_objects returns a list of
-    # tuples of slices, which is not what we want.
-    # The following list comprehensions extract
-    # the format we need.
-    xmin = np.asarray([t[1].start for t in slices])
-    xmax = np.asarray([t[1].stop for t in slices])
-    ymin = np.asarray([t[0].start for t in slices])
-    ymax = np.asarray([t[0].stop for t in slices])
-    return xmin, xmax, ymin, ymax
-
-
-def _measure_area(labels):
-    """Measure the area in pix of each segment."""
-    nsegments = labels.max()
-    area = np.zeros(nsegments)
-    for i in range(nsegments):
-        area[i] = (labels == i + 1).sum()
-    return area
+    containment = measure_containment(image, glon, glat, radii)
+    return radii, containment
+
+
+def _labeled_pixels(labels):
+    """Labeled pixels, sorted by label.
+
+    Returns
+    -------
+    pix : `~numpy.ndarray`
+        Flat image index of the labeled pixels, sorted by label
+        and in image order for the same label.
+    label : `~numpy.ndarray`
+        Labels of these pixels
+    starts : `~numpy.ndarray`
+        Index of the first pixel of each label in ``pix``
+    """
+    labels = np.asanyarray(labels).reshape(-1)
+    pix = np.flatnonzero(labels > 0)
+    label = labels[pix].astype(np.intp)
+    # A stable sort keeps pixels with the same label in image order
+    order = np.argsort(label, kind='mergesort')
+    pix, label = pix[order], label[order]
+    new_label = np.ones(len(label), dtype=bool)
+    new_label[1:] = label[1:] != label[:-1]
+    starts = np.flatnonzero(new_label)
+    return pix, label, starts
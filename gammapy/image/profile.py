@@ -52,68 +52,152 @@ def compute_binning(data, n_bins, method='equal width', eps=1e-10):
     return bin_edges
 
 
+def _digitize_chunked(x, edges, mask=None, chunk_size=2 ** 20):
+    """Bin labels for the values of ``x``, computed in chunks.
+
+    Under- and overflow and masked pixels get the label -1.
+    Working in chunks avoids full-size temporary arrays,
+    e.g. for memory-mapped images.
+
+    Parameters
+    ----------
+    x : array_like
+        Values
+    edges : array_like
+        Bin edges
+    mask : array_like, optional
+        Only pixels where ``mask`` is true are used.
+    chunk_size : int
+        Number of values processed at once
+
+    Returns
+    -------
+    labels : `~numpy.ndarray`
+        Bin labels (1-dim, int32)
+    """
+    x = np.asanyarray(x).reshape(-1)
+    if mask is not None:
+        mask = np.asanyarray(mask).reshape(-1)
+    n_bins = len(edges) - 1
+    labels = np.empty(x.size, dtype=np.int32)
+    for lo in range(0, x.size, chunk_size):
+        hi = lo + chunk_size
+        # By default np.digitize uses 0 as the underflow bin, thus the -1
+        label = np.digitize(x[lo:hi], edges) - 1
+        invalid = (label < 0) | (label >= n_bins)
+        if mask is not None:
+            invalid |= ~mask[lo:hi].astype(bool)
+        label[invalid] = -1
+        labels[lo:hi] = label
+    return labels
+
+
+def _bincount_chunked(labels, n_bins, weights=None, skip_nonfinite=False,
+                      chunk_size=2 ** 20):
+    """Sum weights per label, ignoring labels -1, computed in chunks.
+
+    Parameters
+    ----------
+    labels : `~numpy.ndarray`
+        Bin labels (1-dim)
+    n_bins : int
+        Number of bins
+    weights : array_like, optional
+        Weights, any shape with the same number of elements as ``labels``.
+    skip_nonfinite : bool
+        Ignore non-finite weights (like the pandas ``sum``). By default
+        they are summed, i.e. a NaN weight gives a NaN bin (like ``np.sum``).
+    chunk_size : int
+        Number of values processed at once
+
+    Returns
+    -------
+    sums : `~numpy.ndarray`
+        Sum of weights (or number of entries) per bin
+    """
+    if weights is not None:
+        weights = np.asanyarray(weights).reshape(-1)
+    sums = np.zeros(n_bins + 1)
+    for lo in range(0, labels.size, chunk_size):
+        hi = lo + chunk_size
+        # Shift by one so that the ignored label -1 goes to bin 0
+        label = labels[lo:hi] + 1
+        if weights is None:
+            sums += np.bincount(label, minlength=n_bins + 1)
+        else:
+            weight = np.asarray(weights[lo:hi], dtype=np.float64)
+            if skip_nonfinite:
+                finite = np.isfinite(weight)
+                if not finite.all():
+                    label, weight = label[finite], weight[finite]
+            sums += np.bincount(label, weights=weight, minlength=n_bins + 1)
+    return sums[1:]
+
+
 class FluxProfile(object):
     """Flux profile.
 
     Note: over- and underflow is ignored and not stored in the profile
 
-    Note: this is implemented by creating bin labels and storing the
-    input 2D data in 1D `pandas.DataFrame` tables.
-    The 1D profile is also stored as a `pandas.DataFrame` and computed
-    using the fast and flexible pandas groupby and apply functions.
+    Note: this is implemented by computing the bin label of every pixel once
+    and summing the input images per bin with `numpy.bincount`.
+    Images are processed in chunks, so memory-mapped images can be used.
+    Several profiles with the same binning (e.g. longitude profiles for
+    several latitude bands) can be computed at once by passing stacks of
+    ``x_image`` and / or ``mask`` images.
+
+    Note: non-finite pixel values (e.g. NaN) are ignored in the sums.
 
-    * TODO: take mask into account everywhere
     * TODO: separate FluxProfile.profile into a separate ProfileStack or HistogramStack class?
     * TODO: add ``solid_angle`` to input arrays.
 
     Parameters
     ----------
     x_image : array_like
-        Label image (2-dimensional)
+        Label image (2-dimensional), or stack of label images
+        (3-dimensional, one per profile).
     x_edges : array_like
         Defines binning in ``x`` (could be GLON, GLAT, DIST, ...)
     counts, background, exposure : array_like
         Input images (2-dimensional)
     mask : array_like
-        possibility to mask pixels (i.e. ignore in computations)
+        possibility to mask pixels (i.e. ignore in computations).
+        Pixels where the mask is true are used. Can be a stack of
+        masks (3-dimensional, one per profile).
     """
 
     def __init__(self, x_image, x_edges, counts, background, exposure, mask=None):
-        import pandas as pd
-        # Make sure inputs are numpy arrays
+        # Make sure inputs are numpy arrays (no copies, memmaps stay memmaps)
         x_edges = np.asanyarray(x_edges)
         x_image = np.asanyarray(x_image)
-        counts = np.asanyarray(counts)
-        background = np.asanyarray(background)
-        exposure = np.asanyarray(exposure)
-        if mask:
+        self.counts = np.asanyarray(counts)
+        self.background = np.asanyarray(background)
+        self.exposure = np.asanyarray(exposure)
+        if mask is not None:
             mask = np.asanyarray(mask)
 
-        assert (x_image.shape == counts.shape == background.shape ==
-                exposure.shape == mask.shape)
-
         # Remember the shape of the 2D input arrays
-        self.shape = x_image.shape
-
-        # Store all input data as 1D vectors in a pandas.DataFrame
-        d = pd.DataFrame(index=np.arange(x_image.size))
-        d['x'] = x_image.flat
-        # By default np.digitize uses 0 as the underflow bin.
-        # Here we ignore under- and overflow, thus the -1
-        d['label'] = np.digitize(d['x'], x_edges) - 1
-        d['counts'] = counts.flat
-        d['background'] = background.flat
-        d['exposure'] = exposure.flat
-        if mask:
-            d['mask'] = mask.flat
-        else:
-            d['mask'] = np.ones_like(d['x'])
-        self.data = d
-
-        self.bins = np.arange(len(x_edges) + 1)
+        self.shape = self.counts.shape
+        assert self.shape == self.background.shape == self.exposure.shape
+
+        # Number of profiles
+        stacks = [_ for _ in [x_image, mask] if _ is not None and _.ndim == 3]
+        self.n_profiles = stacks[0].shape[0] if stacks else 1
+        self.multiple = bool(stacks)
+
+        # Bin labels, computed once per profile
+        self.labels = []
+        for idx in range(self.n_profiles):
+            x = x_image[idx] if x_image.ndim == 3 else x_image
+            if mask is None:
+                m = None
+            else:
+                m = mask[idx] if mask.ndim == 3 else mask
+            assert x.shape == self.shape
+            self.labels.append(_digitize_chunked(x, x_edges, m))
 
-        # Store all per-profile bin info in a pandas.DataFrame
-        p = pd.DataFrame(index=np.arange(x_edges.size - 1))
+        # Store all per-profile bin info in a table
+        p = Table()
         p['x_lo'] = x_edges[:-1]
         p['x_hi'] = x_edges[1:]
         p['x_center'] = 0.5 * (p['x_hi'] + p['x_lo'])
@@ -129,39 +213,36 @@ class FluxProfile(object):
 
         TODO: call `~gammapy.stats.compute_total_stats` instead.
 
-        Note: the current implementation is very inefficienct in speed and memory.
-        There are various fast implementations, but none is flexible enough to
-        allow combining many input quantities (counts, background, exposure) in a
-        flexlible way:
-        - `numpy.histogram`
-        - `scipy.ndimage.measurements.labeled_comprehension` and special cases
-
-        pandas DataFrame groupby followed by apply is flexible enough, I think:
-
-        http://pandas.pydata.org/pandas-docs/dev/groupby.html
-
         Returns
         -------
-        results : dict
-            Dictionary of profile measurements, also stored in ``self.profile``.
+        results : `~astropy.table.Table`
+            Table of profile measurements, also stored in ``self.profile``.
+            For several profiles the columns have shape ``(n_bins, n_profiles)``.
 
         See also
         --------
         gammapy.stats.compute_total_stats
         """
-        # Shortcuts to access class info needed in this method
-        d = self.data
-        # Here the pandas magic happens: we group pixels by label
-        g = d.groupby('label')
+        n_bins = len(self.x_edges) - 1
+        sums = dict(n_entries=[], counts=[], background=[], exposure=[])
+        for labels in self.labels:
+            sums['n_entries'].append(_bincount_chunked(labels, n_bins))
+            for name in ['counts', 'background', 'exposure']:
+                weights = getattr(self, name)
+                sums[name].append(_bincount_chunked(labels, n_bins, weights,
+                                                    skip_nonfinite=True))
+
         p = self.profile
+        for name in ['n_entries', 'counts', 'background', 'exposure']:
+            values = np.array(sums[name]).T
+            p[name] = values if self.multiple else values[:, 0]
 
-        # Compute number of entries in each profile bin
-        p['n_entries'] = g['x'].aggregate(len)
-        for name in ['counts', 'background', 'exposure']:
-            p['{0}'.format(name)] = g[name].sum()
-            #p['{0}_mean'.format(name)] = p['{0}_sum'.format(name)] / p['n_entries']
-        p['excess'] = p['counts'] - p['background']
-        p['flux'] = p['excess'] / p['exposure']
+        with np.errstate(divide='ignore', invalid='ignore'):
+            p['excess'] = p['counts'] - p['background']
+            p['flux'] = p['excess'] / p['exposure']
+            p['counts_err'] = np.sqrt(p['counts'])
+            p['excess_err'] = p['counts_err']
+            p['flux_err'] = p['excess_err'] / p['exposure']
 
         return p
 
@@ -238,62 +319,41 @@ def image_profile(profile_axis, image, lats, lons, binsz, counts=None,
     -------
     table : `~astropy.table.Table`
         Galactic latitude or longitude profile as table, with latitude bin
-        boundaries, profile values and errors.
+        boundaries, profile values and errors. Bins containing NaN pixels
+        (that are not masked) have NaN values.
     """
 
     lon, lat = coordinates(image)
     mask_init = (lats[0] <= lat) & (lat < lats[1])
     mask_bounds = mask_init & (lons[0] <= lon) & (lon < lons[1])
-    if mask != None:
+    if mask is not None:
         mask = mask_bounds & mask
     else:
         mask = mask_bounds
 
-    # Need to preserve shape here so use multiply
-    cut_image = image.data * mask
-    if counts != None:
-        cut_counts = counts.data * mask
-    values = []
-    count_vals = []
-
     if profile_axis == 'lat':
-
-        bins = np.arange((lats[1] - lats[0]) / binsz)
-        glats_min = lats[0] + bins[:-1] * binsz
-        glats_max = lats[0] + bins[1:] * binsz
-
-        # Table is required here to avoid rounding problems with floats
-        bounds = Table([glats_min, glats_max], names=('GLAT_MIN', 'GLAT_MAX'))
-        for bin in bins[:-1]:
-            lat_mask = (bounds['GLAT_MIN'][bin] <= lat) & (lat < bounds['GLAT_MAX'][bin])
-            lat_band = cut_image[lat_mask]
-            values.append(lat_band.sum())
-            if counts != None:
-                count_band = cut_counts[lat_mask]
-                count_vals.append(count_band.sum())
-            else:
-                count_vals.append(0)
-
+        x, x_range, names = lat, lats, ('GLAT_MIN', 'GLAT_MAX')
     elif profile_axis == 'lon':
-
-        bins = np.arange((lons[1] - lons[0]) / binsz)
-        glons_min = lons[0] + bins[:-1] * binsz
-        glons_max = lons[0] + bins[1:] * binsz
-
-        # Table is required here to avoid rounding problems with floats
-        bounds = Table([glons_min, glons_max], names=('GLON_MIN', 'GLON_MAX'))
-        for bin in bins[:-1]:
-            lon_mask = (bounds['GLON_MIN'][bin] <= lon) & (lon < bounds['GLON_MAX'][bin])
-            lon_band = cut_image[lon_mask]
-            values.append(lon_band.sum())
-            if counts != None:
-                count_band = cut_counts[lon_mask]
-                count_vals.append(count_band.sum())
-            else:
-                count_vals.append(0)
+        x, x_range, names = lon, lons, ('GLON_MIN', 'GLON_MAX')
+    else:
+        raise ValueError('Invalid profile_axis: {0}'.format(profile_axis))
+
+    bins = np.arange((x_range[1] - x_range[0]) / binsz)
+    x_min = x_range[0] + bins[:-1] * binsz
+    x_max = x_range[0] + bins[1:] * binsz
+
+    # Pixels in bin i have x_min[i] <= x < x_max[i]
+    edges = np.append(x_min, x_max[-1:])
+    labels = _digitize_chunked(x, edges, mask)
+    n_bins = len(x_min)
+    values = _bincount_chunked(labels, n_bins, image.data)
+    if counts is not None:
+        count_vals = _bincount_chunked(labels, n_bins, counts.data)
+    else:
+        count_vals = np.zeros(n_bins)
 
     if errors == True:
-        if counts != None:
+        if counts is not None:
             rel_errors = 1. / np.sqrt(count_vals)
             error_vals = values * rel_errors
         else:
@@ -301,18 +361,10 @@ def image_profile(profile_axis, image, lats, lons, binsz, counts=None,
     else:
         error_vals = np.zeros_like(values)
 
-    if profile_axis == 'lat':
-        table = Table([Quantity(glats_min, 'deg'),
-                       Quantity(glats_max, 'deg'),
-                       values,
-                       error_vals],
-                      names=('GLAT_MIN', 'GLAT_MAX', 'BIN_VALUE', 'BIN_ERR'))
-
-    elif profile_axis == 'lon':
-        table = Table([Quantity(glons_min, 'deg'),
-                       Quantity(glons_max, 'deg'),
-                       values,
-                       error_vals],
-                      names=('GLON_MIN', 'GLON_MAX', 'BIN_VALUE', 'BIN_ERR'))
+    table = Table([Quantity(x_min, 'deg'),
+                   Quantity(x_max, 'deg'),
+                   values,
+                   error_vals],
+                  names=names + ('BIN_VALUE', 'BIN_ERR'))
 
     return table
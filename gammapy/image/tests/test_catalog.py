@@ -1,9 +1,11 @@
 # Licensed under a 3-clause BSD style license - see LICENSE.rst
 from __future__ import print_function, division
+import numpy as np
 from numpy.testing import assert_allclose
 from astropy.tests.helper import remote_data
 from astropy.tests.helper import pytest
 from astropy.units import Quantity
+from astropy.table import Table
 from astropy.wcs import WCS
 from .. import catalog
 from ...image import make_empty_image
@@ -44,6 +46,103 @@ def test_source_image():
     assert_allclose(actual, expected)
 
 
+def test_source_image_simulation():
+    reference_hdu = make_empty_image(20, 10, 0.5)
+    reference_wcs = WCS(reference_hdu.header)
+    energy = Quantity([10, 500], 'GeV')
+    reference = SpectralCube(data=reference_hdu.data,
+                             wcs=reference_wcs, energy=energy)
+
+    table = Table()
+    table['GLON'] = [0, 359, 2, 100]
+    table['GLAT'] = [0, 1, -1, 0]
+    table['flux'] = [1., 2., 3., 4.]
+    table['morph_type'] = ['delta2d', 'gauss2d', 'shell2d', 'gauss2d']
+    table['angular_extension'] = [0, 0.5, 1, 0.5]
+    table.meta['Energy Bins'] = energy
+
+    image, energies = catalog._source_image('simulation', reference, table,
+                                            total_flux=False)
+    assert_allclose(image.sum(), 6)
+    assert np.count_nonzero(image) == 3
+    x, y = reference_wcs.wcs_world2pix(0, 0, 0)
+    assert image[int(y), int(x)] == 1
+
+    image, energies = catalog._source_image('simulation', reference, table,
+                                            total_flux=False, source_type='all')
+    assert_allclose(image.sum(), 6, rtol=1e-3)
+    assert np.count_nonzero(image) > 3
+
+    image, energies = catalog._source_image('simulation', reference, table,
+                                            total_flux=False, source_type='extended')
+    assert_allclose(image.sum(), 5, rtol=1e-3)
+
+
+def test_source_image_simulation_sigma():
+    reference_hdu = make_empty_image(20, 10, 0.5)
+    reference_wcs = WCS(reference_hdu.header)
+    energy = Quantity([10, 500], 'GeV')
+    reference = SpectralCube(data=reference_hdu.data,
+                             wcs=reference_wcs, energy=energy)
+
+    # Gaussians use ``sigma``, shells ``angular_extension``
+    table = Table()
+    table['GLON'] = [0, 3]
+    table['GLAT'] = [0, 0]
+    table['flux'] = [1., 2.]
+    table['morph_type'] = ['gauss2d', 'shell2d']
+    table['sigma'] = [0.5, 0.1]
+    table['angular_extension'] = [3, 1]
+    table.meta['Energy Bins'] = energy
+    image, _ = catalog._source_image('simulation', reference, table,
+                                     total_flux=False, source_type='extended')
+
+    expected_table = table.copy()
+    del expected_table['sigma']
+    expected_table['angular_extension'] = [0.5, 1]
+    expected, _ = catalog._source_image('simulation', reference, expected_table,
+                                        total_flux=False, source_type='extended')
+    assert_allclose(image.sum(), 3, rtol=1e-3)
+    assert_allclose(image, expected)
+
+
+@pytest.mark.skipif('not HAS_SCIPY')
+def test_catalog_image_extended_requires_sim_table():
+    reference_hdu = make_empty_image(10, 10, 1)
+    with pytest.raises(ValueError):
+        catalog.catalog_image(reference_hdu, _ConstantTablePSF(), catalog='1FHL',
+                              source_type='extended')
+
+
+class _ConstantTablePSF(object):
+    """Minimal PSF with a constant 3x3 kernel in every energy band."""
+
+    def table_psf_in_energy_band(self, energy_band):
+        return self
+
+    def kernel(self, pixel_size, offset_max, normalize=True):
+        return np.ones((3, 3)) / 9.
+
+
+def test_psf_kernel_cache(monkeypatch):
+    monkeypatch.setattr(catalog, 'PSF_KERNEL_CACHE_SIZE', 2)
+    monkeypatch.setattr(catalog, '_psf_kernel_cache', catalog.OrderedDict())
+    psfs = [_ConstantTablePSF() for _ in range(3)]
+    band = Quantity([10, 500], 'GeV')
+
+    kernel = catalog._psf_kernel(psfs[0], band, 0.1)
+    assert catalog._psf_kernel(psfs[0], band, 0.1) is kernel
+    catalog._psf_kernel(psfs[1], band, 0.1)
+    # psfs[0] was used more recently than psfs[1]
+    catalog._psf_kernel(psfs[0], band, 0.1)
+    catalog._psf_kernel(psfs[2], band, 0.1)
+
+    assert len(catalog._psf_kernel_cache) == 2
+    cached = [value[0] for value in catalog._psf_kernel_cache.values()]
+    assert psfs[1] not in cached
+    assert catalog._psf_kernel(psfs[0], band, 0.1) is kernel
+
+
 @pytest.mark.skipif('not HAS_SCIPY')
 @remote_data
 def test_catalog_image():
@@ -72,8 +72,44 @@ def test_measure():
     image = generate_example_image()
     labels = np.zeros_like(image, dtype=int)
     labels[10:20, 20:30] = 1
+    labels[50:52, 60:63] = 3
     results = measure_labeled_regions(image, labels)
-    # TODO: check output!
+
+    assert_equal(results['NUMBER'], [1, 2, 3])
+    assert_equal(results['AREA'], [100, 0, 6])
+    assert_allclose(results['IMAGE_SUM'][0], image[10:20, 20:30].sum())
+    assert_allclose(results['IMAGE_MEAN'][2], image[50:52, 60:63].mean())
+    assert_allclose(results['IMAGE_MAX'][0], image[10:20, 20:30].max())
+    assert_equal(results['XMIN_IMAGE'][[0, 2]], [21, 61])
+    assert_equal(results['XMAX_IMAGE'][[0, 2]], [30, 63])
+    assert_equal(results['YMIN_IMAGE'][[0, 2]], [11, 51])
+    assert_equal(results['YMAX_IMAGE'][[0, 2]], [20, 52])
+    ypeak, xpeak = np.unravel_index(np.argmax(image[10:20, 20:30]), (10, 10))
+    assert_equal(results['XPEAK_IMAGE'][0], xpeak + 21)
+    assert_equal(results['YPEAK_IMAGE'][0], ypeak + 11)
+    assert np.isnan(results['IMAGE_MEAN'][1])
+
+    # Centroid and second moments
+    y, x = np.indices(image.shape)
+    region = labels == 1
+    w = image[region]
+    x_mean = (w * x[region]).sum() / w.sum()
+    assert_allclose(results['X_IMAGE'][0], x_mean + 1)
+    x2 = (w * (x[region] - x_mean) ** 2).sum() / w.sum()
+    assert_allclose(results['X2_IMAGE'][0], x2)
+
+
+def test_measure_labeled_regions_images():
+    """Several data images are measured at once"""
+    image = generate_example_image()
+    labels = np.zeros_like(image, dtype=int)
+    labels[10:20, 20:30] = 1
+    labels[50:52, 60:63] = 2
+    data = dict(COUNTS=image, EXPOSURE=2 * image)
+    results = measure_labeled_regions(data, labels, tag='COUNTS')
+    assert_allclose(results['EXPOSURE_SUM'], 2 * results['COUNTS_SUM'])
+    assert_allclose(results['EXPOSURE_MAX'], 2 * results['COUNTS_MAX'])
+    assert 'X2_IMAGE' in results.colnames
 
 
 def test_measure_image_moments():
@@ -107,6 +143,54 @@ def test_measure_curve_of_growth():
     assert_allclose(containment, containment_ana, rtol=0.1)
 
 
+def test_measure_containment_many_sources():
+    """Test containment measurement for several positions at once"""
+    image = generate_gaussian_image()
+    image.data[100, 100] = np.nan
+    data = image.data.copy()
+    glon, glat = [0, 0.3, -0.5], [0, 0.1, 0.2]
+    radius, containment = measure_curve_of_growth(image, glon, glat, 0.6, 0.05)
+    assert containment.shape == (3, len(radius))
+
+    # Compare with direct summation
+    GLON, GLAT = coordinates(image, lon_sym=True)
+    finite = np.isfinite(image.data)
+    for lon, lat, actual in zip(glon, glat, containment):
+        rr = (GLON - lon) ** 2 + (GLAT - lat) ** 2
+        desired = [image.data[finite & (rr < r ** 2)].sum() for r in radius]
+        assert_allclose(actual, desired)
+
+    assert_allclose(measure_containment(image, glon[1], glat[1], radius[3]), containment[1, 3])
+    # The image is not modified
+    assert_equal(image.data, data)
+
+
+def test_measure_containment_tan():
+    """Test measure_containment far from the reference pixel of a TAN image"""
+    image = make_empty_image(nxpix=1000, nypix=1000, binsz=0.1, fill=1, proj='TAN',
+                             dtype='float64')
+    GLON, GLAT = coordinates(image, lon_sym=True)
+    for lon, lat in [(0, 35), (30, 30)]:
+        rr = (GLON - lon) ** 2 + (GLAT - lat) ** 2
+        desired = image.data[rr < 1].sum()
+        assert_allclose(measure_containment(image, lon, lat, 1), desired)
+        radius = measure_containment_radius(image, lon, lat, desired / image.data.sum())
+        assert_allclose(radius, 1, rtol=0.01)
+
+
+@pytest.mark.skipif('not HAS_SCIPY')
+def test_measure_containment_radius_many_sources():
+    """Test measure_containment_radius for several fractions and positions"""
+    image = generate_gaussian_image()
+    image.data *= 3
+    fraction = np.array([0.39347, 0.8])
+    rad = measure_containment_radius(image, [0, 0.02], [0, 0], fraction)
+    assert rad.shape == (2, 2)
+    sigma = 0.2
+    assert_allclose(rad[0], sigma * np.sqrt(-2 * np.log(1 - fraction)), rtol=0.01)
+    assert rad[1, 1] > rad[0, 1]
+
+
 class _TestImageCoordinates(object):
 
     def setUp(self):
@@ -7,6 +7,7 @@ from ...datasets import FermiGalacticCenter
 from ...image import (coordinates,
                       compute_binning,
                       image_profile,
+                      FluxProfile,
                       )
 
 try:
@@ -100,3 +101,69 @@ def test_image_lon_profile():
                                  mask_array, errors=True)
 
     assert_allclose(lon_profile3['BIN_VALUE'].data, np.zeros(79))
+
+
+def test_FluxProfile():
+    random_state = np.random.RandomState(seed=0)
+    shape = (20, 30)
+    y, x = np.indices(shape)
+    counts = random_state.poisson(5, size=shape).astype(float)
+    background = 4 * np.ones(shape)
+    exposure = 2 * np.ones(shape)
+    x_edges = np.array([0, 5, 10, 20, 25])
+
+    # One profile per band in y
+    masks = np.array([y < 10, y >= 10])
+    profile = FluxProfile(x, x_edges, counts, background, exposure, mask=masks)
+    p = profile.compute()
+
+    assert p['counts'].shape == (4, 2)
+    assert_allclose(p['n_entries'][:, 0], [50, 50, 100, 50])
+    for idx, mask in enumerate(masks):
+        for bin in range(4):
+            pix = mask & (x_edges[bin] <= x) & (x < x_edges[bin + 1])
+            excess = counts[pix].sum() - background[pix].sum()
+            assert_allclose(p['counts'][bin, idx], counts[pix].sum())
+            assert_allclose(p['flux'][bin, idx], excess / exposure[pix].sum())
+            assert_allclose(p['flux_err'][bin, idx],
+                            np.sqrt(counts[pix].sum()) / exposure[pix].sum())
+
+    # Single profile, without mask
+    p = FluxProfile(x, x_edges, counts, background, exposure).compute()
+    assert_allclose(p['n_entries'], [100, 100, 200, 100])
+
+
+def test_image_profile_nan():
+    image = FermiGalacticCenter.counts()
+    lons, lats = coordinates(image)
+    image.data = np.ones_like(image.data, dtype=float)
+    image.data[10, 20] = np.nan
+    lat = [lats.min(), lats.max()]
+    lon = [lons.min(), lons.max()]
+
+    # NaN pixels propagate to their bin, as with np.sum
+    p = image_profile('lon', image, lat, lon, 0.5)
+    values = p['BIN_VALUE'].data
+    nan_bin = int((lons[10, 20] - lon[0]) // 0.5)
+    assert np.isnan(values[nan_bin])
+    assert np.isfinite(np.delete(values, nan_bin)).all()
+
+    # Masked NaN pixels are ignored
+    mask = np.ones_like(image.data, dtype=bool)
+    mask[10, 20] = False
+    p = image_profile('lon', image, lat, lon, 0.5, mask=mask)
+    assert np.isfinite(p['BIN_VALUE'].data).all()
+
+
+def test_FluxProfile_nan():
+    shape = (10, 20)
+    y, x = np.indices(shape)
+    counts = np.ones(shape)
+    counts[0, 0] = np.nan
+    background = np.zeros(shape)
+    exposure = np.ones(shape)
+
+    # NaN pixels are ignored in the sums
+    p = FluxProfile(x, [0, 10, 20], counts, background, exposure).compute()
+    assert_allclose(p['counts'], [99, 100])
+    assert_allclose(p['n_entries'], [100, 100])
@@ -0,0 +1,149 @@
+# Licensed under a 3-clause BSD style license - see LICENSE.rst
+from __future__ import print_function, division
+import numpy as np
+from numpy.testing import assert_allclose, assert_equal
+from astropy.tests.helper import pytest
+from astropy.io import fits
+from ...image import (make_header,
+                      disk_correlate,
+                      ring_correlate,
+                      binary_dilation_circle,
+                      exclusion_distance,
+                      block_reduce_hdu,
+                      ImageTile,
+                      TiledImageProcessor,
+                      )
+
+try:
+    import scipy
+    HAS_SCIPY = True
+except ImportError:
+    HAS_SCIPY = False
+
+try:
+    import skimage
+    HAS_SKIMAGE = True
+except ImportError:
+    HAS_SKIMAGE = False
+
+
+def test_make_tiles():
+    tiles = ImageTile.make_tiles((10, 25), (4, 10), halo=2)
+    assert len(tiles) == 9
+    assert tiles[4].core == (slice(4, 8), slice(10, 20))
+    assert tiles[4].halo == (slice(2, 10), slice(8, 22))
+    assert tiles[8].halo == (slice(6, 10), slice(18, 25))
+    assert tiles[8].crop == (slice(2, 4), slice(2, 7))
+
+    covered = np.zeros((10, 25), dtype=int)
+    for tile in tiles:
+        covered[tile.core] += 1
+    assert_equal(covered, 1)
+
+
+@pytest.mark.skipif('not HAS_SCIPY')
+@pytest.mark.parametrize('parallel', [False, True])
+def test_tiled_correlate(parallel):
+    random_state = np.random.RandomState(seed=0)
+    image = random_state.poisson(1, size=(50, 70)).astype(float)
+    processor = TiledImageProcessor(tile_shape=(16, 23), parallel=parallel,
+                                    processes=2)
+
+    actual = processor.disk_correlate(image, 4.5)
+    assert_allclose(actual, disk_correlate(image, 4.5))
+
+    actual = processor.ring_correlate(image, 3, 6, mode='reflect')
+    assert_allclose(actual, ring_correlate(image, 3, 6, mode='reflect'))
+
+
+@pytest.mark.skipif('not HAS_SCIPY')
+def test_tiled_morphology():
+    random_state = np.random.RandomState(seed=0)
+    mask = random_state.uniform(size=(60, 40)) > 0.99
+    processor = TiledImageProcessor(tile_shape=(16, 16))
+
+    actual = processor.binary_dilation_circle(mask, 3)
+    assert_equal(actual, binary_dilation_circle(mask, 3))
+
+    exclusion = ~binary_dilation_circle(mask, 2)
+    actual = processor.exclusion_distance(exclusion, max_distance=5)
+    desired = exclusion_distance(exclusion, max_distance=5)
+    assert_allclose(actual, desired)
+    assert_allclose(desired, np.clip(exclusion_distance(exclusion), -5, 5))
+
+
+@pytest.mark.skipif('not HAS_SCIPY')
+def test_tiled_fits_memmap(tmpdir, monkeypatch):
+    header = make_header(nxpix=70, nypix=50, binsz=0.1)
+    image = np.ones((50, 70), dtype='float32')
+    filename = str(tmpdir.join('image.fits'))
+    fits.PrimaryHDU(data=image, header=header).writeto(filename)
+
+    # Record the files opened by the processor
+    opened = []
+    fits_open = fits.open
+
+    def open_and_record(name, *args, **kwargs):
+        hdu_list = fits_open(name, *args, **kwargs)
+        opened.append((name, hdu_list))
+        return hdu_list
+
+    monkeypatch.setattr(fits, 'open', open_and_record)
+    out_filename = str(tmpdir.join('image_corr.fits'))
+    processor = TiledImageProcessor(tile_shape=(20, 20))
+    processor.disk_correlate(filename, 2, out=out_filename)
+    monkeypatch.undo()
+
+    # The input and output files are closed
+    inputs = [hdu_list for name, hdu_list in opened if name == filename]
+    assert len(inputs) == 1
+    assert inputs[0]._file.closed
+    outputs = [hdu_list for name, hdu_list in opened if name == out_filename]
+    assert len(outputs) == 1
+    assert outputs[0]._file.closed
+
+    hdu = fits.open(out_filename)[0]
+    assert hdu.header['CDELT2'] == 0.1
+    assert_allclose(hdu.data, disk_correlate(image, 2))
+
+
+def _fail_after_first_tile(image):
+    if image.shape != (20, 20) or image[0, 0] != 0:
+        raise RuntimeError('Tile failed')
+    return image
+
+
+def test_tiled_fits_memmap_error(tmpdir, monkeypatch):
+    image = np.arange(50 * 70, dtype='float32').reshape(50, 70)
+    out_filename = str(tmpdir.join('image_out.fits'))
+
+    opened = []
+    fits_open = fits.open
+
+    def open_and_record(name, *args, **kwargs):
+        hdu_list = fits_open(name, *args, **kwargs)
+        opened.append(hdu_list)
+        return hdu_list
+
+    monkeypatch.setattr(fits, 'open', open_and_record)
+    processor = TiledImageProcessor(tile_shape=(20, 20))
+    with pytest.raises(RuntimeError):
+        processor.run(_fail_after_first_tile, [image], out=out_filename)
+    monkeypatch.undo()
+
+    # The output file is closed if a tile fails
+    assert len(opened) == 1
+    assert opened[0]._file.closed
+
+
+@pytest.mark.skipif('not HAS_SKIMAGE')
+def test_tiled_block_reduce():
+    header = make_header(nxpix=70, nypix=50, binsz=0.1)
+    image = np.arange(50 * 70, dtype=float).reshape(50, 70)
+    hdu = fits.ImageHDU(data=image, header=header)
+    processor = TiledImageProcessor(tile_shape=(16, 16))
+
+    actual = processor.block_reduce_hdu(hdu, (4, 4), np.sum)
+    desired = block_reduce_hdu(hdu, (4, 4), np.sum)
+    assert_allclose(actual.data, desired.data)
+    assert actual.header['CDELT1'] == desired.header['CDELT1']
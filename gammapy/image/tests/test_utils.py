@@ -21,6 +21,8 @@ from ...image import (
     wcs_histogram2d,
     lookup,
     lon_lat_rectangle_mask,
+    process_image_pixels,
+    image_windows,
 )
 
 try:
@@ -128,6 +130,67 @@ def test_process_image_pixels():
     assert_allclose(actual, desired)
 
 
+def _weighted_sums(windows, kernel):
+    """Batched pixel function used in `test_process_image_pixels_vectorized`"""
+    return dict(sum=np.sum(windows['image'] * kernel, axis=(-2, -1)),
+                norm=np.sum(kernel, axis=(-2, -1)) * np.ones(windows['image'].shape[:2]))
+
+
+def _weighted_sum(image_parts, kernel):
+    """Per-pixel version of `_weighted_sums`"""
+    return dict(sum=np.sum(image_parts['image'] * kernel), norm=np.sum(kernel))
+
+
+@pytest.mark.parametrize('parallel', [False, True])
+def test_process_image_pixels_vectorized(parallel):
+    random_state = np.random.RandomState(seed=0)
+    image = random_state.uniform(size=(9, 12))
+    kernel = random_state.uniform(size=(3, 5))
+
+    results = []
+    for pixel_function, vectorized in [(_weighted_sum, False), (_weighted_sums, True)]:
+        out = dict(sum=np.empty_like(image), norm=np.empty_like(image))
+        process_image_pixels(dict(image=image), kernel, out, pixel_function,
+                             vectorized=vectorized, tile_rows=4, parallel=parallel,
+                             processes=2)
+        results.append(out)
+
+    assert_allclose(results[0]['sum'], results[1]['sum'])
+    assert_allclose(results[0]['norm'], results[1]['norm'])
+    assert_allclose(results[1]['norm'][4, 5], kernel.sum())
+    assert_allclose(results[1]['norm'][0, 0], kernel[1:, 2:].sum())
+
+    # Padding mode: same as correlation with the full kernel
+    out = np.empty_like(image)
+    process_image_pixels(dict(image=image), kernel, out,
+                         lambda w, k: np.sum(w['image'] * k, axis=(-2, -1)),
+                         vectorized=True, mode='reflect')
+    windows = image_windows(image, kernel.shape, mode='reflect')
+    assert windows.shape == (9, 12, 3, 5)
+    assert_allclose(out[0, 0], np.sum(windows[0, 0] * kernel))
+    assert_allclose(windows[0, 0], np.pad(image, ((1, 1), (2, 2)), mode='reflect')[:3, :5])
+
+
+def test_process_image_pixels_nested():
+    """A pixel function can call process_image_pixels itself"""
+    random_state = np.random.RandomState(seed=0)
+    image = random_state.uniform(size=(6, 7))
+    kernel = np.ones((3, 3))
+
+    def inner_sum(image_parts, kernel_part):
+        out = np.empty_like(image_parts['image'])
+        process_image_pixels(image_parts, np.ones((1, 1)), out,
+                             lambda parts, k: np.sum(parts['image'] * k))
+        return out.sum()
+
+    out = np.empty_like(image)
+    process_image_pixels(dict(image=image), kernel, out, inner_sum, tile_rows=2)
+    desired = np.empty_like(image)
+    process_image_pixels(dict(image=image), kernel, desired,
+                         lambda parts, k: np.sum(parts['image']))
+    assert_allclose(out, desired)
+
+
 @pytest.mark.skipif('not HAS_SKIMAGE')
 class TestBlockReduceHDU():
 
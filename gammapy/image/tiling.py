@@ -0,0 +1,379 @@
+# Licensed under a 3-clause BSD style license - see LICENSE.rst
+"""Process large images in tiles.
+
+Survey images (e.g. the Galactic plane at 0.01 deg binning) and their
+auxiliary maps don't necessarily fit into memory as float64 arrays.
+The tools here split an image (e.g. a memory-mapped FITS image) into tiles,
+extend each tile by a halo sized to the footprint of the operation,
+process the tiles one by one (optionally in parallel) and write the
+results into an output array, which can be a memory-mapped FITS image.
+"""
+from __future__ import print_function, division
+import numpy as np
+from astropy.io import fits
+from . import utils
+
+__all__ = ['ImageTile',
+           'TiledImageProcessor',
+           'make_fits_memmap',
+           ]
+
+
+class ImageTile(object):
+    """Image tile with halo.
+
+    Parameters
+    ----------
+    core : tuple of slice
+        Image region where the tile output is valid
+    halo : tuple of slice
+        Image region that is passed to the operation,
+        i.e. ``core`` extended by the halo and clipped at the image edges.
+    """
+
+    def __init__(self, core, halo):
+        self.core = core
+        self.halo = halo
+
+    @property
+    def crop(self):
+        """Position of ``core`` in the halo tile (tuple of slice)"""
+        return tuple(slice(c.start - h.start, c.stop - h.start)
+                     for c, h in zip(self.core, self.halo))
+
+    def __repr__(self):
+        return 'ImageTile(core={0}, halo={1})'.format(self.core, self.halo)
+
+    @staticmethod
+    def make_tiles(shape, tile_shape, halo=0):
+        """Split an image into tiles.
+
+        Parameters
+        ----------
+        shape : tuple
+            Image shape
+        tile_shape : tuple
+            Maximum shape of the tile cores
+        halo : int
+            Halo width in pixels
+
+        Returns
+        -------
+        tiles : list of `ImageTile`
+            Tiles in image order
+        """
+        edges = [list(range(0, n, t)) + [n] for n, t in zip(shape, tile_shape)]
+        tiles = []
+        for y_lo, y_hi in zip(edges[0][:-1], edges[0][1:]):
+            for x_lo, x_hi in zip(edges[1][:-1], edges[1][1:]):
+                core = (slice(y_lo, y_hi), slice(x_lo, x_hi))
+                halo_ = (slice(max(y_lo - halo, 0), min(y_hi + halo, shape[0])),
+                         slice(max(x_lo - halo, 0), min(x_hi + halo, shape[1])))
+                tiles.append(ImageTile(core, halo_))
+        return tiles
+
+
+def make_fits_memmap(filename, header, shape, dtype='float32', clobber=False):
+    """Create a FITS image file and open its data as a memory map.
+
+    The file is created without allocating the image in memory.
+
+    Parameters
+    ----------
+    filename : str
+        Output file name
+    header : `~astropy.io.fits.Header` or None
+        Header with the WCS information for the image
+    shape : tuple
+        Image shape
+    dtype : str
+        Image data type
+    clobber : bool
+        Overwrite existing file?
+
+    Returns
+    -------
+    hdu_list : `~astropy.io.fits.HDUList`
+        File opened in update mode, ``hdu_list[0].data`` is the memory map.
+        Call ``hdu_list.close()`` to make sure all data is written.
+    """
+    import os
+    if os.path.exists(filename) and not clobber:
+        raise IOError('File exists: {0}'.format(filename))
+
+    hdu = fits.PrimaryHDU(data=np.zeros((1, 1), dtype=dtype))
+    if header is not None:
+        # Copy everything except the keywords describing the data layout
+        skip = ('', 'COMMENT', 'HISTORY', 'XTENSION', 'EXTEND',
+                'PCOUNT', 'GCOUNT', 'BSCALE', 'BZERO')
+        for key in header:
+            if key in skip or key.startswith('NAXIS') or key in hdu.header:
+                continue
+            hdu.header[key] = header[key]
+    hdu.header['NAXIS1'] = shape[1]
+    hdu.header['NAXIS2'] = shape[0]
+
+    header_bytes = hdu.header.tostring().encode('ascii')
+    n_bytes = shape[0] * shape[1] * np.dtype(dtype).itemsize
+    # FITS files consist of 2880 byte blocks
+    n_bytes = ((n_bytes + 2879) // 2880) * 2880
+    with open(filename, 'wb') as fh:
+        fh.write(header_bytes)
+        fh.seek(len(header_bytes) + n_bytes - 1)
+        fh.write(b'\0')
+
+    return fits.open(filename, mode='update', memmap=True)
+
+
+def _process_tile(images, function, kwargs, crop):
+    """Run ``function`` on one tile and crop the halo."""
+    result = function(*images, **kwargs)
+    return result[crop]
+
+
+def _open_image(image):
+    """Image data array and header for a filename, HDU or array.
+
+    Returns
+    -------
+    data : `~numpy.ndarray`
+        Image data (memory map for a filename)
+    header : `~astropy.io.fits.Header` or None
+        Image header
+    hdu_list : `~astropy.io.fits.HDUList` or None
+        Opened file for a filename, to be closed by the caller.
+    """
+    if hasattr(image, 'header'):
+        return image.data, image.header, None
+    elif hasattr(image, 'shape'):
+        return np.asanyarray(image), None, None
+    else:
+        hdu_list = fits.open(image, memmap=True)
+        return hdu_list[0].data, hdu_list[0].header, hdu_list
+
+
+class TiledImageProcessor(object):
+    """Apply image operations tile by tile.
+
+    Inputs can be arrays (e.g. `numpy.memmap`), HDUs or FITS file names,
+    which are opened as memory maps. Only one tile per process is in memory
+    at any time. Each tile is extended by a halo of ``halo`` pixels, so for
+    operations with a footprint radius of at most ``halo`` pixels the result
+    is identical to processing the whole image at once.
+
+    The methods of this class wrap the corresponding functions
+    in `gammapy.image.utils` with the appropriate halo width.
+
+    Parameters
+    ----------
+    tile_shape : tuple
+        Shape of the tile cores
+    parallel : bool
+        Process tiles in parallel with a `multiprocessing.Pool`.
+        The operation must be picklable, i.e. defined at module level.
+    processes : int, optional
+        Number of processes for ``parallel=True``, default: number of CPUs.
+
+    Examples
+    --------
+    Correlate a large counts image with a disk and write the result to
+    a new FITS file::
+
+        from gammapy.image import TiledImageProcessor
+        processor = TiledImageProcessor(tile_shape=(2000, 2000), parallel=True)
+        processor.disk_correlate('counts.fits', radius=10,
+                                 out='counts_corr.fits')
+    """
+
+    def __init__(self, tile_shape=(1024, 1024), parallel=False, processes=None):
+        self.tile_shape = tuple(tile_shape)
+        self.parallel = parallel
+        self.processes = processes
+
+    def _prepare_out(self, out, shape, dtype, header):
+        """Output array and HDU list (if a file was created)."""
+        if out is None:
+            return np.empty(shape, dtype=dtype), None
+        elif not hasattr(out, 'shape'):
+            # FITS has no boolean images
+            if np.dtype(dtype) == np.bool_:
+                dtype = np.uint8
+            hdu_list = make_fits_memmap(out, header, shape, dtype)
+            return hdu_list[0].data, hdu_list
+        else:
+            if out.shape != tuple(shape):
+                raise ValueError('Invalid output shape: {0}. Expected: {1}'
+                                 ''.format(out.shape, shape))
+            return out, None
+
+    def run(self, function, images, halo=0, out=None, dtype=None,
+            block_size=1, **kwargs):
+        """Apply ``function`` to images tile by tile.
+
+        Parameters
+        ----------
+        function : callable
+            Operation ``function(*image_tiles, **kwargs)``,
+            returning an image of the same shape as the tiles
+            (or reduced by ``block_size``).
+        images : list
+            Input images (arrays, HDUs or FITS filenames) of the same shape
+        halo : int
+            Halo width in pixels, i.e. the footprint radius of the operation
+        out : array_like or str, optional
+            Output array or FITS filename. By default an array is created.
+        dtype : str, optional
+            Output data type, by default the one returned by ``function``.
+        block_size : int
+            Output pixels are blocks of ``block_size`` input pixels
+            (for block reduce operations). The tile shape is rounded to a
+            multiple of ``block_size``.
+        kwargs : dict
+            Passed to ``function``
+
+        Returns
+        -------
+        out : `~numpy.ndarray`
+            Output image. For a FITS filename ``out`` the file is written
+            and closed (also if ``function`` raises), and its data is
+            returned as a new copy-on-write memory map of the file.
+        """
+        opened = [_open_image(image) for image in images]
+        try:
+            return self._run(function, [_[0] for _ in opened], opened[0][1],
+                             halo, out, dtype, block_size, kwargs)
+        finally:
+            for _, _, hdu_list in opened:
+                if hdu_list is not None:
+                    hdu_list.close()
+
+    def _run(self, function, arrays, header, halo, out, dtype, block_size, kwargs):
+        """Apply ``function`` to opened images, see `run`."""
+        from functools import partial
+        shape = arrays[0].shape
+        for array in arrays:
+            if array.shape != shape:
+                raise ValueError('Images must have the same shape')
+
+        if block_size > 1 and halo:
+            raise ValueError('Halo is not supported for block reduce operations')
+        tile_shape = [max(block_size, (_ // block_size) * block_size)
+                      for _ in self.tile_shape]
+        tiles = ImageTile.make_tiles(shape, tile_shape, halo)
+        out_shape = tuple(-(-n // block_size) for n in shape)
+
+        compute = partial(_process_tile, function=function, kwargs=kwargs)
+
+        def read(tile):
+            return [np.array(array[tile.halo]) for array in arrays]
+
+        def write(tile, result):
+            core = tuple(slice(s.start // block_size, -(-s.stop // block_size))
+                         for s in tile.core)
+            out_array[core] = result
+
+        # The first tile determines the output data type
+        first = compute(read(tiles[0]), crop=tiles[0].crop)
+        dtype = first.dtype if dtype is None else dtype
+        out_array, hdu_list = self._prepare_out(out, out_shape, dtype, header)
+        try:
+            write(tiles[0], first)
+            del first
+            tiles = tiles[1:]
+
+            if self.parallel:
+                self._run_parallel(compute, tiles, read, write)
+            else:
+                for tile in tiles:
+                    write(tile, compute(read(tile), crop=tile.crop))
+        finally:
+            if hdu_list is not None:
+                # Flushes the data and releases the file
+                hdu_list.close()
+
+        if hdu_list is not None:
+            # Re-open the written file, the returned memory map owns its file
+            return fits.getdata(out, memmap=True)
+        return out_array
+
+    def _run_parallel(self, compute, tiles, read, write):
+        """Process ``tiles`` with a `multiprocessing.Pool`."""
+        from multiprocessing import Pool, cpu_count
+        processes = self.processes or cpu_count()
+        pool = Pool(processes=processes)
+        try:
+            # Submit a few tiles per process at a time to bound the memory
+            n_batch = 2 * processes
+            for lo in range(0, len(tiles), n_batch):
+                batch = tiles[lo:lo + n_batch]
+                results = [pool.apply_async(compute, (read(tile), ),
+                                            dict(crop=tile.crop))
+                           for tile in batch]
+                for tile, result in zip(batch, results):
+                    write(tile, result.get())
+        finally:
+            pool.close()
+            pool.join()
+
+    def disk_correlate(self, image, radius, mode='constant', out=None):
+        """Tiled `~gammapy.image.disk_correlate`."""
+        return self.run(utils.disk_correlate, [image], halo=_halo(radius),
+                        out=out, radius=radius, mode=mode)
+
+    def ring_correlate(self, image, r_in, r_out, mode='constant', out=None):
+        """Tiled `~gammapy.image.ring_correlate`."""
+        return self.run(utils.ring_correlate, [image], halo=_halo(r_out),
+                        out=out, r_in=r_in, r_out=r_out, mode=mode)
+
+    def binary_dilation_circle(self, input, radius, out=None):
+        """Tiled `~gammapy.image.binary_dilation_circle`."""
+        return self.run(utils.binary_dilation_circle, [input], halo=_halo(radius),
+                        out=out, radius=radius)
+
+    def exclusion_distance(self, exclusion, max_distance, out=None):
+        """Tiled `~gammapy.image.exclusion_distance`.
+
+        Distances are only computed up to ``max_distance``,
+        which sets the halo width.
+        """
+        return self.run(utils.exclusion_distance, [exclusion],
+                        halo=_halo(max_distance) + 1, out=out,
+                        max_distance=max_distance)
+
+    def threshold(self, array, threshold=5, out=None):
+        """Tiled `~gammapy.image.threshold`."""
+        return self.run(utils.threshold, [array], out=out, threshold=threshold)
+
+    def block_reduce_hdu(self, input_hdu, block_size, func, cval=0, out=None):
+        """Tiled `~gammapy.image.block_reduce_hdu` for 2-dim images.
+
+        Only square blocks are supported.
+
+        Returns
+        -------
+        image_hdu : `~astropy.io.fits.ImageHDU`
+            Rebinned image HDU
+        """
+        if block_size[0] != block_size[1]:
+            raise ValueError('Only square blocks are supported.')
+        data, header, hdu_list = _open_image(input_hdu)
+        try:
+            # Compute the new header on a small dummy image
+            dummy = fits.ImageHDU(np.zeros((1, 1)), header)
+            header = utils.block_reduce_hdu(dummy, block_size, np.sum, cval).header
+            data = self.run(_block_reduce, [data], out=out, block_size=block_size[0],
+                            factor=block_size[0], func=func, cval=cval)
+        finally:
+            if hdu_list is not None:
+                hdu_list.close()
+        return fits.ImageHDU(data=data, header=header)
+
+
+def _halo(radius):
+    """Halo width for a disk footprint of given radius."""
+    return int(np.ceil(radius))
+
+
+def _block_reduce(data, factor, func, cval):
+    from skimage.measure import block_reduce
+    return block_reduce(data, (factor, factor), func, cval)
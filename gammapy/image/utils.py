@@ -7,6 +7,7 @@ import numpy as np
 from astropy.units import Quantity
 from astropy.io import fits
 from astropy.wcs import WCS
+from ..utils.wcs import geometry_cache
 
 
 __all__ = ['atrous_hdu',
@@ -28,6 +29,7 @@ __all__ = ['atrous_hdu',
            'downsample_2N',
            'exclusion_distance',
            'image_groupby',
+           'image_windows',
            'images_to_cube',
            'lon_lat_rectangle_mask',
            'make_empty_image',
@@ -266,7 +268,7 @@ def shape_2N(shape, N=3):
     return tuple(new_shape)
 
 
-def exclusion_distance(exclusion):
+def exclusion_distance(exclusion, max_distance=None):
     """Distance to nearest exclusion region.
 
     Compute distance map, i.e. the Euclidean (=Cartesian 2D)
@@ -282,6 +284,10 @@ def exclusion_distance(exclusion):
     ----------
     exclusion : `~numpy.ndarray`
 	Exclusion regions as mask.
+    max_distance : float, optional
+        Clip distances at ``max_distance``. Only exclusion regions within
+        this distance are relevant, so the distance can be computed in tiles
+        (see `~gammapy.image.TiledImageProcessor`).
 
     Returns
     -------
@@ -289,9 +295,19 @@ def exclusion_distance(exclusion):
 	Map of distance to nearest exclusion region.
     """
     from scipy.ndimage import distance_transform_edt
-    distance_outside = distance_transform_edt(exclusion)
-    distance_inside = distance_transform_edt(np.invert(exclusion))
+    exclusion = np.asanyarray(exclusion, dtype=bool)
+
+    def distance_to_false(mask):
+        if max_distance is not None and mask.all():
+            # No pixel to measure the distance to
+            return np.inf * np.ones(mask.shape)
+        return distance_transform_edt(mask)
+
+    distance_outside = distance_to_false(exclusion)
+    distance_inside = distance_to_false(np.invert(exclusion))
     distance = np.where(exclusion, distance_outside, -distance_inside)
+    if max_distance is not None:
+        distance = np.clip(distance, -max_distance, max_distance)
     return distance
 
 
@@ -349,12 +365,16 @@ def atrous_hdu(hdu, n_levels):
     return hdus
 
 
-def coordinates(image, world=True, lon_sym=True, radians=False):
+def coordinates(image, world=True, lon_sym=True, radians=False, dtype='float64'):
     """Get coordinate images for a given image.
 
     This function is useful if you want to compute
     an image with values that are a function of position.
 
+    World coordinate images are cached per header and shape
+    (see `~gammapy.utils.wcs.WCSGeometryCache`), so calling this
+    repeatedly for the same geometry is cheap.
+
     Parameters
     ----------
     image : `~astropy.io.fits.ImageHDU` or `~numpy.ndarray`
@@ -364,7 +384,9 @@ def coordinates(image, world=True, lon_sym=True, radians=False):
     lon_sym : bool, optional
         Use symmetric longitude range ``(-180, 180)`` (or ``(0, 360)``)?
     radians : bool, optional
-	Return coordinates in radians or degrees?
+        Return coordinates in radians or degrees?
+    dtype : {'float64', 'float32'}
+        Data type of the world coordinate images.
 
     Returns
     -------
@@ -379,22 +401,24 @@ def coordinates(image, world=True, lon_sym=True, radians=False):
     >>> lon, lat = coordinates(FermiGalacticCenter.counts())
     >>> dist = np.sqrt(lon ** 2 + lat ** 2)
     """
-    # Create arrays of pixel coordinates
-    y, x = np.indices(image.shape, dtype='int32')
-
     if not world:
+        # Create arrays of pixel coordinates
+        y, x = np.indices(image.shape, dtype='int32')
         return x, y
 
-    wcs = WCS(image.header)
-    origin = 0  # convention for gammapy
-    lon, lat = wcs.wcs_pix2world(x, y, origin)
+    lon, lat = geometry_cache.coordinates(image.header, image.shape, dtype)
 
+    # The cached images are read-only, always return new arrays
     if lon_sym:
         lon = np.where(lon > 180, lon - 360, lon)
+    else:
+        lon = lon.copy()
 
     if radians:
         lon = np.radians(lon)
         lat = np.radians(lat)
+    else:
+        lat = lat.copy()
 
     return lon, lat
 
@@ -456,7 +480,129 @@ def separation(image, center, world=True, radians=False):
     return d
 
 
-def process_image_pixels(images, kernel, out, pixel_function):
+def image_windows(image, window_shape, mode='constant', cval=0):
+    """Strided view of the windows centered on every image pixel.
+
+    The image is padded once according to ``mode``, the returned array
+    is a view into the padded image, i.e. no data is copied per window.
+    Don't write to the returned array, windows of neighbouring pixels
+    share memory.
+
+    Parameters
+    ----------
+    image : `~numpy.ndarray`
+        2-dim image
+    window_shape : tuple
+        Window shape ``(k0, k1)``, both must be odd.
+    mode : str
+        Edge handling, passed to `numpy.pad` (e.g. 'constant', 'edge',
+        'reflect', 'symmetric', 'wrap').
+    cval : float
+        Fill value for ``mode='constant'``.
+
+    Returns
+    -------
+    windows : `~numpy.ndarray`
+        Array of shape ``image.shape + window_shape``,
+        ``windows[i0, i1]`` is the window centered on pixel ``(i0, i1)``.
+    """
+    k0, k1 = window_shape
+    if (k0 % 2 == 0) or (k1 % 2 == 0):
+        raise ValueError('Window shape must have odd dimensions')
+
+    pad_width = ((k0 // 2, k0 // 2), (k1 // 2, k1 // 2))
+    if mode == 'constant':
+        padded = np.pad(image, pad_width, mode=mode, constant_values=cval)
+    else:
+        padded = np.pad(image, pad_width, mode=mode)
+    return _padded_windows(padded, window_shape)
+
+
+def _padded_windows(padded, window_shape):
+    """Windows view for an image that is padded by half the window size."""
+    from numpy.lib.stride_tricks import as_strided
+    k0, k1 = window_shape
+    shape = (padded.shape[0] - k0 + 1, padded.shape[1] - k1 + 1, k0, k1)
+    return as_strided(padded, shape=shape, strides=padded.strides * 2)
+
+
+# Padded images of the running `process_image_pixels` call,
+# only set in the worker processes for parallel processing
+_process_images = dict()
+
+
+def _init_process_images(shared):
+    """Pool initializer: wrap shared memory buffers as arrays."""
+    _process_images.clear()
+    for name, (buffer, shape, dtype) in shared.items():
+        _process_images[name] = np.frombuffer(buffer, dtype=dtype).reshape(shape)
+
+
+def _process_rows(rows, pixel_function, kernel, vectorized, crop, padded=None):
+    """Compute output for image rows ``rows[0]:rows[1]``.
+
+    ``padded`` are the padded images, by default the images
+    of the worker process (see `_init_process_images`).
+    """
+    if padded is None:
+        padded = _process_images
+    if not vectorized:
+        return _pixel_function_adapter(rows, pixel_function, kernel, crop, padded)
+
+    lo, hi = rows
+    windows = dict()
+    for name, image in padded.items():
+        windows[name] = _padded_windows(image, kernel.shape)[lo:hi]
+    valid = windows.pop('__valid__', None)
+    if valid is not None:
+        kernel = np.where(valid, kernel, 0)
+    return pixel_function(windows, kernel)
+
+
+def _pixel_function_adapter(rows, pixel_function, kernel, crop, padded):
+    """Call a per-pixel function with the old signature for a block of rows.
+
+    ``pixel_function(image_parts, kernel_part)`` is called for every pixel.
+    With ``crop=True`` the image parts and kernel are cut at the image edges,
+    otherwise full-size windows of the padded images are passed.
+    """
+    lo, hi = rows
+    k0, k1 = kernel.shape
+    h0, h1 = k0 // 2, k1 // 2
+    images = dict((name, image) for name, image in padded.items()
+                  if name != '__valid__')
+    shape = list(images.values())[0].shape
+    n0, n1 = shape[0] - 2 * h0, shape[1] - 2 * h1
+
+    results = []
+    for i0 in range(lo, hi):
+        row = []
+        for i1 in range(n1):
+            if crop:
+                # Low and high extension (# pixels, not counting central pixel)
+                i0_lo, i0_hi = min(h0, i0), min(h0, n0 - i0 - 1)
+                i1_lo, i1_hi = min(h1, i1), min(h1, n1 - i1 - 1)
+            else:
+                i0_lo, i0_hi, i1_lo, i1_hi = h0, h0, h1, h1
+
+            # Pixel (i0, i1) is at (i0 + h0, i1 + h1) in the padded images.
+            # Slicing creates views, i.e. is fast and memory efficient.
+            part = (slice(i0 + h0 - i0_lo, i0 + h0 + i0_hi + 1),
+                    slice(i1 + h1 - i1_lo, i1 + h1 + i1_hi + 1))
+            image_parts = dict((name, image[part]) for name, image in images.items())
+            kernel_part = kernel[h0 - i0_lo: h0 + i0_hi + 1,
+                                 h1 - i1_lo: h1 + i1_hi + 1]
+            row.append(pixel_function(image_parts, kernel_part))
+        results.append(row)
+
+    if isinstance(results[0][0], dict):
+        return dict((name, np.array([[_[name] for _ in row] for row in results]))
+                    for name in results[0][0])
+    return np.array(results)
+
+
+def process_image_pixels(images, kernel, out, pixel_function, vectorized=False,
+                         mode='crop', tile_rows=None, parallel=False, processes=None):
     """Process images for a given kernel and per-pixel function.
 
     This is a helper function for the following common task:
@@ -465,8 +611,13 @@ def process_image_pixels(images, kernel, out, pixel_function):
     cut out kernel-shaped parts from the images and call a function
     to compute output values for that position.
 
-    This function loops over image pixels and takes care of bounding
-    box computations, including image boundary handling.
+    The images are processed in tiles of ``tile_rows`` rows.
+    With ``vectorized=True``, ``pixel_function(windows, kernel)`` is called
+    once per tile with a dict of stacked window views of shape
+    ``(n_rows, n1, k0, k1)`` (see `image_windows`) and must return an array
+    of shape ``(n_rows, n1)`` or a dict of such arrays.
+    Otherwise ``pixel_function(image_parts, kernel_part)`` is called for
+    every pixel with kernel-shaped parts of the images.
 
     Parameters
     ----------
@@ -476,7 +627,26 @@ def process_image_pixels(images, kernel, out, pixel_function):
         kernel shape must be odd-valued
     out : single array or dict of arrays
         These arrays must have been pre-created by the caller
-    pixel_function : function to process a part of the images
+    pixel_function : function
+        Function to process a part of the images
+    vectorized : bool
+        Is ``pixel_function`` a batched function of stacked windows?
+    mode : {'crop', 'constant', 'edge', 'reflect', 'symmetric', 'wrap'}
+        Edge handling. With ``'crop'`` image parts and kernel are cut at
+        the image edges. Batched functions always get full-size windows,
+        so for them the images are zero-padded and ``kernel`` is passed as an
+        array of shape ``(n_rows, n1, k0, k1)`` that is zero outside the image.
+        Other values are passed to `numpy.pad` (zero fill for ``'constant'``)
+        and the full kernel is used for every pixel.
+    tile_rows : int, optional
+        Number of image rows per tile. By default tiles are chosen to have
+        about four million window pixels.
+    parallel : bool
+        Process tiles in parallel with a `multiprocessing.Pool`.
+        The padded images are put in shared memory, ``pixel_function``
+        must be picklable, i.e. defined at module level.
+    processes : int, optional
+        Number of processes for ``parallel=True``, default: number of CPUs.
 
     Examples
     --------
@@ -496,14 +666,19 @@ def process_image_pixels(images, kernel, out, pixel_function):
             process_image_pixels(images, kernel, out, convolve_function)
             return out['image']
 
-    * TODO: add different options to treat the edges
-    * TODO: implement multiprocessing version
-    * TODO: this function is similar to view_as_windows in scikit-image:
-            http://scikit-image.org/docs/dev/api/skimage.util.html#view-as-windows
-            Is this function needed or can everything be done with view_as_windows?
+    The same with a batched function, which avoids the Python loop
+    over pixels::
+
+        def convolve_function(windows, kernel):
+            value = np.sum(windows['image'] * kernel, axis=(-2, -1))
+            return dict(image=value)
+        process_image_pixels(images, kernel, out, convolve_function,
+                             vectorized=True)
     """
+    from functools import partial
+    kernel = np.asanyarray(kernel)
     if isinstance(out, dict):
-        n0, n1 = out.values()[0].shape
+        n0, n1 = list(out.values())[0].shape
     else:
         n0, n1 = out.shape
 
@@ -511,42 +686,47 @@ def process_image_pixels(images, kernel, out, pixel_function):
     k0, k1 = kernel.shape
     if (k0 % 2 == 0) or (k1 % 2 == 0):
         raise ValueError('Kernel shape must have odd dimensions')
-    k0, k1 = (k0 - 1) / 2, (k1 - 1) / 2
-
-    # Loop over all pixels
-    for i0 in range(0, n0):
-        for i1 in range(0, n1):
-            # Compute low and high extension
-            # (# pixels, not counting central pixel)
-            i0_lo = min(k0, i0)
-            i1_lo = min(k1, i1)
-            i0_hi = min(k0, n0 - i0 - 1)
-            i1_hi = min(k1, n1 - i1 - 1)
-
-            # Cut out relevant parts of the image arrays
-            # This creates views, i.e. is fast and memory efficient
-            image_parts = dict()
-            for name, image in images.items():
-                # hi + 1 because with Python slicing the hi edge is not included
-                part = image[i0 - i0_lo: i0 + i0_hi + 1,
-                             i1 - i1_lo: i1 + i1_hi + 1]
-                image_parts[name] = part
-
-            # Cut out relevant part of the kernel array
-            # This only applies when close to the edge
-            # hi + 1 because with Python slicing the hi edge is not included
-            kernel_part = kernel[k0 - i0_lo: k0 + i0_hi + 1,
-                                 k1 - i1_lo: k1 + i1_hi + 1]
-
-            # Call pixel_function for this one part
-            out_part = pixel_function(image_parts, kernel_part)
-
-            if isinstance(out_part, dict):
-                # Store output
-                for name, image in out.items():
-                    out[name][i0, i1] = out_part[name]
-            else:
-                out[i0, i1] = out_part
+
+    crop = (mode == 'crop')
+    pad_width = ((k0 // 2, k0 // 2), (k1 // 2, k1 // 2))
+    pad_mode = 'constant' if crop else mode
+    padded = dict()
+    for name, image in images.items():
+        padded[name] = np.pad(np.asanyarray(image), pad_width, mode=pad_mode)
+    if crop and vectorized:
+        valid = np.ones((n0, n1), dtype=bool)
+        padded['__valid__'] = np.pad(valid, pad_width, mode='constant')
+
+    if tile_rows is None:
+        tile_rows = max(1, int(4e6 // (n1 * kernel.size)))
+    tiles = [(lo, min(lo + tile_rows, n0)) for lo in range(0, n0, tile_rows)]
+
+    compute = partial(_process_rows, pixel_function=pixel_function, kernel=kernel,
+                      vectorized=vectorized, crop=crop)
+
+    if parallel:
+        from multiprocessing import Pool, RawArray
+        shared = dict()
+        for name, image in padded.items():
+            buffer = RawArray('b', image.nbytes)
+            np.frombuffer(buffer, dtype=image.dtype).reshape(image.shape)[...] = image
+            shared[name] = (buffer, image.shape, image.dtype)
+        pool = Pool(processes=processes, initializer=_init_process_images,
+                    initargs=(shared,))
+        try:
+            results = pool.map(compute, tiles)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = [compute(tile, padded=padded) for tile in tiles]
+
+    for (lo, hi), result in zip(tiles, results):
+        if isinstance(out, dict):
+            for name in out:
+                out[name][lo:hi] = result[name]
+        else:
+            out[lo:hi] = result
 
 
 def image_groupby(images, labels):
@@ -811,18 +991,10 @@ def solid_angle(image):
     area_image : `~astropy.units.Quantity`
         Solid angle image (matching the input image) in steradians.
     """
-    # Area of one pixel at the equator
-    cdelt0 = image.header['CDELT1']
-    cdelt1 = image.header['CDELT2']
-    equator_area = Quantity(abs(cdelt0 * cdelt1), 'deg2')
-
-    # Compute image with fraction of pixel area at equator
-    glat = coordinates(image)[1]
-    area_fraction = np.cos(np.radians(glat))
+    # Pixel area at the equator times cos(lat), cached per header and shape
+    area = geometry_cache.solid_angle(image.header, image.shape)
 
-    result = area_fraction * equator_area.to('sr')
-
-    return result
+    return Quantity(area, 'sr')
 
 
 def make_header(nxpix=100, nypix=100, binsz=0.1, xref=0, yref=0,
@@ -1065,7 +1237,8 @@ def paste_cutout_into_image(total, cutout, method='sum'):
     Parameters
     ----------
     total, cutout : `~astropy.io.fits.ImageHDU`
-        Total and cutout image.
+        Total and cutout image. Parts of the cutout outside the
+        total image are ignored.
     method : {'sum', 'replace'}, optional
         Sum or replace total values with cutout values.
 
@@ -1083,16 +1256,31 @@ def paste_cutout_into_image(total, cutout, method='sum'):
     lon, lat = WCS(cutout.header).wcs_pix2world(0, 0, origin)
     x, y = WCS(total.header).wcs_world2pix(lon, lat, origin)
     x, y = int(np.round(x)), int(np.round(y))
+
+    _paste_array(total.data, cutout.data, x, y, method)
+
+    return total
+
+
+def _paste_array(total, cutout, x, y, method='sum'):
+    """Paste cutout array with lower left pixel at ``(x, y)`` into total array.
+
+    Parts of the cutout outside the total array are ignored.
+    """
+    if method not in ['sum', 'replace']:
+        raise ValueError('Invalid method: {0}'.format(method))
     dy, dx = cutout.shape
+    ny, nx = total.shape
+    x_lo, y_lo = max(x, 0), max(y, 0)
+    x_hi, y_hi = min(x + dx, nx), min(y + dy, ny)
+    if x_lo >= x_hi or y_lo >= y_hi:
+        return
 
+    part = cutout[y_lo - y: y_hi - y, x_lo - x: x_hi - x]
     if method == 'sum':
-        total.data[y: y + dy, x: x + dx] += cutout.data
-    elif method == 'replace':
-        total.data[y: y + dy, x: x + dx] = cutout.data
+        total[y_lo: y_hi, x_lo: x_hi] += part
     else:
-        raise ValueError('Invalid method: {0}'.format(method))
-
-    return total
+        total[y_lo: y_hi, x_lo: x_hi] = part
 
 
 def block_reduce_hdu(input_hdu, block_size, func, cval=0):
@@ -44,6 +44,11 @@ class EnergyDispersion(object):
         self._pdf_threshold = pdf_threshold
         self._interpolate2d_func = None
 
+    @property
+    def pdf_matrix(self):
+        """PDF matrix ``[true energy, reco energy]`` (`~numpy.ndarray`)"""
+        return self._pdf_matrix
+
     @property
     def pdf_threshold(self):
         """PDF matrix zero-suppression threshold (float)"""
@@ -29,6 +29,16 @@ Here's an example for the `~cash` statistic::
     array([ -0.56353481,  -5.56922612, -21.54566271])
     >>> cash(data, model).sum()
     -27.678423645645118
+
+When the statistic is evaluated many times for the same data, e.g. in a fit,
+use the fit statistic classes instead. They pre-compute all terms that only
+depend on the data, evaluate the summed statistic and its gradient for a whole
+batch of model vectors at once and re-use internal work buffers::
+
+    >>> from gammapy.stats import Cash
+    >>> stat = Cash(data)
+    >>> stat([[3.3, 6.8, 9.2], [3, 5, 9]])
+    array([-27.67842365, -28.23609525])
 """
 from __future__ import (absolute_import, division, print_function,
                         unicode_literals)
@@ -37,6 +47,7 @@ import numpy as np
 __all__ = ['cash', 'cstat', 'wstat', 'lstat', 'pgstat',
            'chi2', 'chi2constvar', 'chi2datavar',
            'chi2gehrels', 'chi2modvar', 'chi2xspecvar',
+           'FitStatistic', 'Cash', 'CStat', 'WStat',
            ]
 
 N_OBSERVED_MIN = 1e-25
@@ -131,12 +142,48 @@ def cstat(n_observed, mu_observed, n_observed_min=N_OBSERVED_MIN):
     return stat
 
 
-def wstat():
+def wstat(n_on, n_off, alpha, mu_signal):
     r"""W statistic, for Poisson data with Poisson background.
 
-    Reference: http://heasarc.nasa.gov/xanadu/xspec/manual/XSappendixStatistics.html
+    The expected background counts are not a model parameter, but are
+    profiled out, i.e. for every bin the background that maximises
+    the likelihood for the given signal :math:`\mu_{signal}` is used.
+
+    With :math:`\mu_{off}` the profiled expected counts in the OFF region,
+    the statistic is
+
+    .. math::
+        W = 2 \left[ \mu_{signal} + (1 + \alpha) \mu_{off}
+            - n_{on} \log(\mu_{signal} + \alpha \mu_{off})
+            - n_{off} \log(\mu_{off})
+            + n_{on} (\log(n_{on}) - 1) + n_{off} (\log(n_{off}) - 1) \right]
+
+    Parameters
+    ----------
+    n_on : array_like
+        Observed counts in the ON region
+    n_off : array_like
+        Observed counts in the OFF region
+    alpha : array_like
+        Background efficiency ratio ON / OFF
+    mu_signal : array_like
+        Expected signal counts in the ON region
+
+    Returns
+    -------
+    stat : ndarray
+        Statistic per bin
+
+    See Also
+    --------
+    WStat
+
+    References
+    ----------
+    * `XSpec manual statistics page
+      <http://heasarc.nasa.gov/xanadu/xspec/manual/XSappendixStatistics.html>`_
     """
-    pass
+    return WStat(n_on, n_off, alpha).per_bin(mu_signal)
 
 
 def lstat():
@@ -271,3 +318,245 @@ def chi2xspecvar(N_S, N_B, A_S, A_B):
     stat = np.where(mask, 1, chi2datavar(N_S, N_B, A_S, A_B))
 
     return stat
+
+
+class FitStatistic(object):
+    """Fit statistic for given data, evaluated for many model vectors.
+
+    Sub-classes pre-compute all terms that only depend on the data once.
+    Model vectors ``mu`` are arrays with the number of bins as last axis,
+    a 2-dim array of shape ``(n_models, n_bins)`` evaluates a whole batch
+    of models in one call. Work arrays are cached per model shape,
+    so repeated calls with the same shape don't allocate temporaries.
+
+    Sub-classes implement ``_evaluate`` and ``_gradient``, which write the
+    per-bin statistic and its derivative into the given work arrays.
+
+    Parameters
+    ----------
+    n_observed : array_like
+        Observed counts (one value per bin)
+    """
+
+    def __init__(self, n_observed):
+        self.n_observed = np.asanyarray(n_observed, dtype=np.float64)
+        self._buffers = dict()
+
+    def _work(self, shape):
+        """Cached float and bool work arrays for a given model shape."""
+        if shape not in self._buffers:
+            self._buffers[shape] = (np.empty(shape, dtype=np.float64),
+                                    np.empty(shape, dtype=bool))
+        return self._buffers[shape]
+
+    def __call__(self, mu, out=None):
+        """Summed statistic for one or several model vectors.
+
+        Parameters
+        ----------
+        mu : array_like
+            Model vector(s), bins along the last axis.
+        out : `~numpy.ndarray`, optional
+            Output array, shape ``mu.shape[:-1]``.
+
+        Returns
+        -------
+        stat : `~numpy.ndarray`
+            Statistic summed over bins, one value per model vector.
+        """
+        mu = np.asanyarray(mu, dtype=np.float64)
+        work = self._evaluate(mu, *self._work(mu.shape))
+        return np.sum(work, axis=-1, out=out)
+
+    def per_bin(self, mu):
+        """Statistic per bin (`~numpy.ndarray`)."""
+        mu = np.asanyarray(mu, dtype=np.float64)
+        return self._evaluate(mu, *self._work(mu.shape)).copy()
+
+    def gradient(self, mu, out=None):
+        """Derivative of the statistic with respect to each model bin value.
+
+        Parameters
+        ----------
+        mu : array_like
+            Model vector(s), bins along the last axis.
+        out : `~numpy.ndarray`, optional
+            Output array, same shape as ``mu``.
+
+        Returns
+        -------
+        gradient : `~numpy.ndarray`
+            Gradient, same shape as ``mu``.
+        """
+        mu = np.asanyarray(mu, dtype=np.float64)
+        if out is None:
+            out = np.empty(mu.shape)
+        return self._gradient(mu, out, self._work(mu.shape)[1])
+
+
+class Cash(FitStatistic):
+    """Cash statistic for given data.
+
+    See `cash` for the definition.
+
+    Parameters
+    ----------
+    n_observed : array_like
+        Observed counts
+    """
+
+    def _evaluate(self, mu, work, invalid):
+        with np.errstate(divide='ignore', invalid='ignore'):
+            np.log(mu, out=work)
+        work *= self.n_observed
+        np.subtract(mu, work, out=work)
+        work *= 2
+        np.less_equal(mu, 0, out=invalid)
+        np.copyto(work, 0, where=invalid)
+        return work
+
+    def _gradient(self, mu, out, invalid):
+        with np.errstate(divide='ignore', invalid='ignore'):
+            np.divide(self.n_observed, mu, out=out)
+        np.subtract(1, out, out=out)
+        out *= 2
+        np.less_equal(mu, 0, out=invalid)
+        np.copyto(out, 0, where=invalid)
+        return out
+
+
+class CStat(Cash):
+    """C statistic for given data.
+
+    See `cstat` for the definition.
+
+    Parameters
+    ----------
+    n_observed : array_like
+        Observed counts
+    n_observed_min : array_like
+        ``n_observed`` is clipped to this value, see `cstat`.
+    """
+
+    def __init__(self, n_observed, n_observed_min=N_OBSERVED_MIN):
+        super(CStat, self).__init__(n_observed)
+        n_observed_min = np.asanyarray(n_observed_min, dtype=np.float64)
+        n = np.where(self.n_observed <= n_observed_min,
+                     n_observed_min, self.n_observed)
+        self.n_observed = n
+        self._data_term = 2 * (n * np.log(n) - n)
+
+    def _evaluate(self, mu, work, invalid):
+        with np.errstate(divide='ignore', invalid='ignore'):
+            np.log(mu, out=work)
+        work *= self.n_observed
+        np.subtract(mu, work, out=work)
+        work *= 2
+        work += self._data_term
+        np.less_equal(mu, 0, out=invalid)
+        np.copyto(work, 0, where=invalid)
+        return work
+
+
+class WStat(FitStatistic):
+    """W statistic for given ON / OFF data, with profiled background.
+
+    See `wstat` for the definition. Model vectors are the expected
+    signal counts in the ON region. The gradient is the total derivative
+    for the profiled background.
+
+    Parameters
+    ----------
+    n_on : array_like
+        Observed counts in the ON region
+    n_off : array_like
+        Observed counts in the OFF region
+    alpha : array_like
+        Background efficiency ratio ON / OFF
+    """
+
+    def __init__(self, n_on, n_off, alpha):
+        n_on, n_off, alpha = np.broadcast_arrays(np.asanyarray(n_on, dtype=np.float64),
+                                                 np.asanyarray(n_off, dtype=np.float64),
+                                                 np.asanyarray(alpha, dtype=np.float64))
+        super(WStat, self).__init__(n_on)
+        self.n_on = self.n_observed
+        self.n_off = n_off
+        self.alpha = alpha
+
+        self._on_zero = n_on == 0
+        self._off_zero = n_off == 0
+        self._alpha_1 = 1 + alpha
+        self._c_data = alpha * (n_on + n_off)
+        self._d_data = 4 * alpha * (1 + alpha) * n_off
+        self._b_norm = 2 * alpha * (1 + alpha)
+        # Data term n (log(n) - 1), with the limit 0 for n = 0
+        self._data_term = n_on * (np.log(np.where(self._on_zero, 1, n_on)) - 1)
+        self._data_term += n_off * (np.log(np.where(self._off_zero, 1, n_off)) - 1)
+
+    def _work(self, shape):
+        """Cached work arrays, with two extra float arrays for the profile."""
+        if shape not in self._buffers:
+            self._buffers[shape] = (np.empty(shape), np.empty(shape, dtype=bool),
+                                    np.empty(shape), np.empty(shape))
+        return self._buffers[shape]
+
+    def _mu_off(self, mu, c, d):
+        """Profiled expected OFF counts, written into ``c``.
+
+        This is the positive root of a quadratic equation. For negative ``c``
+        the equivalent form ``2 n_off mu / (d - c)`` avoids cancellation.
+        """
+        # c = alpha (n_on + n_off) - (1 + alpha) mu
+        np.multiply(self._alpha_1, mu, out=c)
+        np.subtract(self._c_data, c, out=c)
+        # d = sqrt(c ** 2 + 4 alpha (1 + alpha) n_off mu)
+        np.multiply(self._d_data, mu, out=d)
+        d += c * c
+        np.sqrt(d, out=d)
+
+        negative = c < 0
+        with np.errstate(divide='ignore', invalid='ignore'):
+            small = 2 * self.n_off * mu / (d - c)
+        c += d
+        c /= self._b_norm
+        np.copyto(c, small, where=negative)
+        return c
+
+    def _evaluate(self, mu, work, invalid, c, d):
+        mu_off = self._mu_off(mu, c, d)
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            # ON term: - n_on log(mu + alpha mu_off)
+            np.multiply(self.alpha, mu_off, out=d)
+            d += mu
+            np.log(d, out=d)
+            d *= self.n_on
+            np.copyto(d, 0, where=self._on_zero)
+            # OFF term: - n_off log(mu_off)
+            np.log(mu_off, out=work)
+            work *= self.n_off
+            np.copyto(work, 0, where=self._off_zero)
+
+        work += d
+        np.negative(work, out=work)
+        work += mu
+        mu_off *= self._alpha_1
+        work += mu_off
+        work += self._data_term
+        work *= 2
+        return work
+
+    def _gradient(self, mu, out, invalid):
+        _, _, c, d = self._work(mu.shape)
+        mu_off = self._mu_off(mu, c, d)
+        # Envelope theorem: the derivative with respect to the profiled
+        # background is zero, so only the explicit dependence on mu remains.
+        np.multiply(self.alpha, mu_off, out=out)
+        out += mu
+        with np.errstate(divide='ignore', invalid='ignore'):
+            np.divide(self.n_on, out, out=out)
+        np.copyto(out, 0, where=self._on_zero)
+        np.subtract(1, out, out=out)
+        out *= 2
+        return out
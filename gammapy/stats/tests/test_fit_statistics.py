@@ -6,7 +6,11 @@ from numpy.testing import assert_allclose
 from astropy.tests.helper import pytest
 from ...stats import (cash,
                       cstat,
+                      wstat,
                       chi2datavar,
+                      Cash,
+                      CStat,
+                      WStat,
                       )
 
 # TODO: test against Sherpa results
@@ -32,3 +36,51 @@ def test_chi2_stats():
     N_B = A_S
     actual = chi2datavar(N_S, N_B, A_S, A_B)
     assert_allclose(actual, 43)
+
+
+def test_cash_cstat_batch():
+    random_state = np.random.RandomState(seed=0)
+    n_observed = random_state.poisson(5, size=10)
+    mu = random_state.uniform(0.1, 10, size=(3, 10))
+    mu[0, 0] = 0
+
+    for stat, func in [(Cash(n_observed), cash), (CStat(n_observed), cstat)]:
+        expected = func(n_observed, mu)
+        assert_allclose(stat.per_bin(mu), expected)
+        assert_allclose(stat(mu), expected.sum(axis=1))
+        # Second call re-uses the work buffers
+        assert_allclose(stat(mu[1]), expected[1].sum())
+        assert_allclose(stat(mu[1]), expected[1].sum())
+
+        eps = 1e-6
+        numeric = (stat.per_bin(mu + eps) - stat.per_bin(mu - eps)) / (2 * eps)
+        assert_allclose(stat.gradient(mu)[:, 1:], numeric[:, 1:], rtol=1e-5)
+
+
+def test_wstat():
+    n_on = np.array([0, 0, 3, 10, 20])
+    n_off = np.array([0, 5, 0, 20, 100])
+    alpha = 0.2
+    mu_signal = np.array([1., 2, 3, 4, 0.5])
+
+    actual = wstat(n_on, n_off, alpha, mu_signal)
+
+    # Profile the background numerically on a fine grid
+    mu_off = np.logspace(-12, 3, 300001)[:, np.newaxis]
+    mu_on = mu_signal + alpha * mu_off
+    with np.errstate(divide='ignore', invalid='ignore'):
+        on_term = np.where(n_on > 0, n_on * np.log(n_on / mu_on) - n_on, 0)
+        off_term = np.where(n_off > 0, n_off * np.log(n_off / mu_off) - n_off, 0)
+    desired = 2 * (mu_on + mu_off + on_term + off_term).min(axis=0)
+    assert_allclose(actual, desired, atol=1e-5)
+
+    # n_on = n_off = 0: background profiles to zero
+    assert_allclose(actual[0], 2 * mu_signal[0])
+
+    stat = WStat(n_on, n_off, alpha)
+    eps = 1e-6
+    numeric = (stat.per_bin(mu_signal + eps) - stat.per_bin(mu_signal - eps)) / (2 * eps)
+    assert_allclose(stat.gradient(mu_signal), numeric, rtol=1e-5)
+
+    batch = np.vstack([mu_signal, 2 * mu_signal])
+    assert_allclose(stat(batch), [actual.sum(), stat.per_bin(2 * mu_signal).sum()])
@@ -1,10 +1,81 @@
 from __future__ import print_function, division
+import types
+from functools import partial
+from collections import OrderedDict
+from numbers import Number
 import numpy as np
-from astropy.extern.six.moves import range
+from astropy.modeling import Model
 from ...utils.random import get_random_state
 
 __all__ = ['GeneralRandom']
 
+# Lookup tables of `GeneralRandom`, keyed by distribution and range
+_lookup_table_cache = OrderedDict()
+_LOOKUP_TABLE_CACHE_SIZE = 32
+
+
+def _distribution_key(dist):
+    """Hashable key identifying a distribution by value.
+
+    Supported are `~astropy.modeling.Model` instances (class and
+    parameter values), module-level functions and `functools.partial`
+    objects of these with number or string arguments.
+
+    Returns `None` for other callables (e.g. lambdas or closures,
+    which can depend on state that isn't visible here), which
+    are then not cached.
+    """
+    if isinstance(dist, Model):
+        return type(dist), tuple(np.ravel(dist.parameters))
+    elif isinstance(dist, partial):
+        keys = [_distribution_key(dist.func)]
+        keys += [_distribution_key(_) for _ in dist.args]
+        keywords = sorted((dist.keywords or {}).items())
+        keys += [_distribution_key(value) for _, value in keywords]
+        if any(_ is None for _ in keys):
+            return None
+        return partial, tuple(keys), tuple(name for name, _ in keywords)
+    elif isinstance(dist, types.FunctionType):
+        return dist if dist.__closure__ is None else None
+    elif isinstance(dist, (Number, str)):
+        return dist
+    else:
+        return None
+
+
+def _lookup_tables(pdf, min_range, max_range, ninversecdf, ran_res):
+    """Compute the (read-only) lookup tables of `GeneralRandom`.
+
+    Returns
+    -------
+    x, pdf, cdf, inversecdf, delta_inversecdf : `~numpy.ndarray`
+        See `GeneralRandom`
+    """
+    x = np.linspace(min_range, max_range, int(ran_res))
+    pdf = np.asarray(pdf(x), dtype=float)
+
+    # old solution has problems with first bin:
+    # self.pdf = pdf/float(pdf.sum()) #normalize it
+    # self.cdf = self.pdf.cumsum()
+
+    # Trapezoidal integration of the pdf
+    cdf = np.zeros(x.size)
+    cdf[1:] = np.cumsum((pdf[1:] + pdf[:-1]) * np.diff(x) / 2)
+
+    pdf = pdf / cdf.max()  # normalize pdf
+    cdf = cdf / cdf.max()  # normalize cdf
+
+    # Linear interpolation of the inverse of the cdf
+    y = np.arange(ninversecdf) / float(ninversecdf)
+    inversecdf = np.interp(y, cdf, x)
+    inversecdf[0] = x[0]
+    delta_inversecdf = np.concatenate((np.diff(inversecdf), [0]))
+
+    tables = x, pdf, cdf, inversecdf, delta_inversecdf
+    for array in tables:
+        array.flags.writeable = False
+    return tables
+
 
 class GeneralRandom(object):
     """Fast random number generation with an arbitrary pdf
@@ -35,47 +106,33 @@ class GeneralRandom(object):
         Lookup is computed and stored in:
         cdf: cumulative pdf
         inversecdf: the inverse lookup table
-        delta_inversecdf: difference of inversecdf"""
+        delta_inversecdf: difference of inversecdf
+
+        The lookup tables are cached for distributions that can be
+        identified by value (see `_distribution_key`), i.e. they are
+        only computed once per distribution and range. The cached
+        arrays are shared and read-only."""
         self.ran_res = ran_res  # Resolution of the PDF
-        x = np.linspace(min_range, max_range, ran_res)
         # This is a good default for the number of reverse
         # lookups to not loose much information in the pdf
         if ninversecdf is None:
-            ninversecdf = 5 * x.size
-
-        self.nx = x.size
-        self.x = x
-        self.pdf = pdf(x)
-
-        # old solution has problems with first bin:
-        # self.pdf = pdf/float(pdf.sum()) #normalize it
-        # self.cdf = self.pdf.cumsum()
-
-        self.cdf = np.empty(self.nx, dtype=float)
-        self.cdf[0] = 0
-        for i in range(1, self.nx):
-            self.cdf[i] = self.cdf[i - 1] + (self.pdf[i] + self.pdf[i - 1]) * (self.x[i] - self.x[i - 1]) / 2
-
-        self.pdf = self.pdf / self.cdf.max()  # normalize pdf
-        self.cdf = self.cdf / self.cdf.max()  # normalize cdf
-
+            ninversecdf = 5 * int(ran_res)
         self.ninversecdf = ninversecdf
-        y = np.arange(ninversecdf) / float(ninversecdf)
-        # delta = 1.0/ninversecdf
-        self.inversecdf = np.empty(ninversecdf)
-        self.inversecdf[0] = self.x[0]
-        cdf_idx = 0
-        for n in range(1, self.ninversecdf):
-            while self.cdf[cdf_idx] < y[n] and cdf_idx < ninversecdf:
-                cdf_idx += 1
-            self.inversecdf[n] = self.x[cdf_idx - 1] + \
-                (self.x[cdf_idx] - self.x[cdf_idx - 1]) * \
-                (y[n] - self.cdf[cdf_idx - 1]) / \
-                (self.cdf[cdf_idx] - self.cdf[cdf_idx - 1])
-            if cdf_idx >= ninversecdf:
-                break
-        self.delta_inversecdf = \
-            np.concatenate((np.diff(self.inversecdf), [0]))
+
+        key = _distribution_key(pdf)
+        if key is not None:
+            key = (key, min_range, max_range, ninversecdf, int(ran_res))
+            tables = _lookup_table_cache.get(key)
+            if tables is None:
+                tables = _lookup_tables(pdf, min_range, max_range, ninversecdf, ran_res)
+                _lookup_table_cache[key] = tables
+                while len(_lookup_table_cache) > _LOOKUP_TABLE_CACHE_SIZE:
+                    _lookup_table_cache.popitem(last=False)
+        else:
+            tables = _lookup_tables(pdf, min_range, max_range, ninversecdf, ran_res)
+
+        self.x, self.pdf, self.cdf, self.inversecdf, self.delta_inversecdf = tables
+        self.nx = self.x.size
 
     def draw(self, N=1000, random_state='random-seed'):
         """Returns an array of random numbers with the requested distribution.
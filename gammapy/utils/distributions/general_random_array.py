@@ -11,47 +11,172 @@ class GeneralRandomArray(object):
     given by a numpy array.
     The array dimension can be arbitrary.
 
-    Note that drawing a random number from an array with N entries
-    is not a constant cost operation. Even the efficient implementation
-    using a binary tree used here costs log(N).
+    Two sampling methods are available:
 
-    For a general description of the method see the end of the following page:
-    http://www.cs.utk.edu/~parker/Courses/CS302-Fall06/Notes/PQueues/random_num_gen.html
-    """
+    * ``'cdf'`` : inverse transform sampling, i.e. a binary search
+      in the cumulative distribution, which costs log(N) per draw
+      for an array with N entries.
+      For a general description of the method see the end of the following page:
+      http://www.cs.utk.edu/~parker/Courses/CS302-Fall06/Notes/PQueues/random_num_gen.html
+    * ``'alias'`` : Walker's alias method, which costs O(N) to set up the
+      alias table and O(1) per draw. This is faster if many draws
+      are made from the same array (e.g. photon positions from a model cube).
 
-    def __init__(self, pdf):
-        """Computes the cdf from the pdf.
-        """
+    Parameters
+    ----------
+    pdf : array_like
+        Probability distribution (normalization not necessary)
+    method : {'cdf', 'alias'}
+        Sampling method
+    """
 
-        # Note that numpy flattens the array automatically,
-        # i.e. cdf is a 1D array (normalization not necessary)
-        self.cdf = pdf.cumsum()
-        self.cdfmax = self.cdf.max()
+    def __init__(self, pdf, method='cdf'):
+        pdf = np.asanyarray(pdf)
 
         # Remember the dimension and shape for unravel_index()
         self.ndim = pdf.ndim
         self.shape = pdf.shape
+        self.method = method
 
-    def draw(self, n=1, return_flat_index=False, random_state='random-seed'):
-        """Returns n draws from the pdf
-        If return_flat_index == true, a linearized index is returned.
+        if method == 'cdf':
+            # Note that numpy flattens the array automatically,
+            # i.e. cdf is a 1D array (normalization not necessary)
+            self.cdf = pdf.cumsum()
+            self.cdfmax = self.cdf.max()
+        elif method == 'alias':
+            self.prob, self.alias = _alias_table(pdf.ravel())
+        else:
+            raise ValueError('Invalid method: {0}'.format(method))
+
+    def _draw_flat(self, n, random_state):
+        """Draw ``n`` flat indices."""
+        if self.method == 'cdf':
+            u = random_state.uniform(0, self.cdfmax, size=n)
+            return self.cdf.searchsorted(u)
+        else:
+            # One uniform number per draw: the integer part selects
+            # the column of the alias table, the fractional part
+            # decides between the column and its alias.
+            u = random_state.uniform(0, self.prob.size, size=n)
+            indices = u.astype(np.int64)
+            np.minimum(indices, self.prob.size - 1, out=indices)
+            u -= indices
+            return np.where(u < self.prob[indices], indices, self.alias[indices])
+
+    def _unravel(self, indices):
+        """Unravel flat indices to an array of shape ``(n, ndim)``."""
+        return np.column_stack(np.unravel_index(indices, self.shape)).astype(np.int64)
+
+    def iter_draw(self, n=1, return_flat_index=False, random_state='random-seed',
+                  chunk_size=2 ** 20):
+        """Draw ``n`` samples in chunks.
+
+        The memory needed is bounded by ``chunk_size``, so this can be used
+        to process very large samples.
 
         Parameters
         ----------
+        n : int
+            Number of samples
+        return_flat_index : bool
+            Return linearized indices?
         random_state : {int, 'random-seed', 'global-rng', `~numpy.random.RandomState`}
             Defines random number generator initialisation.
             Passed to `~gammapy.utils.random.get_random_state`.
+        chunk_size : int
+            Maximum number of samples per chunk
+
+        Yields
+        ------
+        indices : `~numpy.ndarray`
+            Sampled indices, see `draw`.
         """
         random_state = get_random_state(random_state)
+        n = int(n)
+        for lo in range(0, n, chunk_size):
+            indices = self._draw_flat(min(chunk_size, n - lo), random_state)
+            if return_flat_index:
+                yield indices
+            else:
+                yield self._unravel(indices)
+
+    def draw(self, n=1, return_flat_index=False, random_state='random-seed',
+             chunk_size=2 ** 20):
+        """Returns n draws from the pdf
+        If return_flat_index == true, a linearized index is returned.
 
-        u = random_state.uniform(0, self.cdfmax, size=n)
-        indices = self.cdf.searchsorted(u)
+        Parameters
+        ----------
+        random_state : {int, 'random-seed', 'global-rng', `~numpy.random.RandomState`}
+            Defines random number generator initialisation.
+            Passed to `~gammapy.utils.random.get_random_state`.
+        chunk_size : int
+            Samples are computed in chunks of this size (see `iter_draw`),
+            which limits the size of temporary arrays.
+
+        Returns
+        -------
+        indices : `~numpy.ndarray`
+            Array of shape ``(n,)`` for ``return_flat_index=True``,
+            otherwise of shape ``(n, ndim)``.
+        """
+        n = int(n)
         if return_flat_index:
-            return indices
+            indices = np.empty(n, dtype=np.int64)
         else:
-            # @todo: vectorize unravel_index
-            # This for loop is a dirty hack and most likely is very slow.
-            unraveled_indices = np.empty((n, self.ndim), dtype=np.int64)
-            for i in np.arange(n):
-                unraveled_indices[i] = np.unravel_index(indices[i], self.shape)
-            return unraveled_indices
+            indices = np.empty((n, self.ndim), dtype=np.int64)
+
+        chunks = self.iter_draw(n, return_flat_index, random_state, chunk_size)
+        for lo, chunk in zip(range(0, n, chunk_size), chunks):
+            indices[lo:lo + len(chunk)] = chunk
+        return indices
+
+
+def _alias_table(pdf):
+    """Alias table for Walker's alias method.
+
+    The table is constructed with Vose's algorithm, but instead of pairing
+    one small with one large entry at a time, all small entries are
+    distributed onto the large entries in one step (using the cumulative
+    sums of their deficits and excesses). Large entries that drop below
+    one become small entries of the next iteration.
+
+    Parameters
+    ----------
+    pdf : `~numpy.ndarray`
+        Probability distribution (1-dim, normalization not necessary)
+
+    Returns
+    -------
+    prob : `~numpy.ndarray`
+        Probability to keep the entry instead of its alias
+    alias : `~numpy.ndarray`
+        Alias indices
+    """
+    n = pdf.size
+    prob = np.asarray(pdf, dtype=np.float64) * (n / pdf.sum())
+    alias = np.arange(n)
+
+    small = np.flatnonzero(prob < 1)
+    large = np.flatnonzero(prob >= 1)
+    while small.size and large.size:
+        deficit = 1 - prob[small]
+        excess = prob[large] - 1
+        deficit_start = np.cumsum(deficit) - deficit
+        # Each small entry goes to the large entry with excess left
+        # at the start of its deficit
+        idx = np.searchsorted(np.cumsum(excess), deficit_start, side='right')
+        # Rounding errors can push the last entries beyond the end
+        np.minimum(idx, large.size - 1, out=idx)
+
+        alias[small] = large[idx]
+        prob[large] -= np.bincount(idx, weights=deficit, minlength=large.size)
+
+        is_small = prob[large] < 1
+        small = large[is_small]
+        large = large[~is_small]
+
+    # Remaining entries are one up to rounding errors
+    prob[small] = 1
+    prob[large] = 1
+    return prob, alias
@@ -1,7 +1,51 @@
 from __future__ import print_function, division
 import numpy as np
+from numpy.testing import assert_allclose
 from astropy.tests.helper import pytest
-from ....utils.distributions import GeneralRandom
+from astropy.modeling.models import Gaussian1D
+from ....utils.distributions import GeneralRandom, draw, pdf
+
+
+def test_inversecdf():
+    # pdf(x) = 2 x on [0, 1] has the inverse cdf sqrt(y)
+    r = GeneralRandom(lambda x: 2 * x, 0, 1)
+    y = np.arange(r.ninversecdf) / r.ninversecdf
+    assert_allclose(r.cdf, r.x ** 2, atol=1e-6)
+    assert_allclose(r.inversecdf, np.sqrt(y), atol=1e-3)
+
+    x = r.draw(100000, random_state=0)
+    assert ((0 <= x) & (x <= 1)).all()
+    assert_allclose(x.mean(), 2. / 3, rtol=1e-2)
+
+
+def test_lookup_table_cache():
+    r1 = GeneralRandom(Gaussian1D(1, 0, 1), -5, 5)
+    r2 = GeneralRandom(Gaussian1D(1, 0, 1), -5, 5)
+    assert r1.inversecdf is r2.inversecdf
+    assert not r1.inversecdf.flags.writeable
+
+    r3 = GeneralRandom(Gaussian1D(1, 0, 2), -5, 5)
+    assert r3.inversecdf is not r1.inversecdf
+    r4 = GeneralRandom(Gaussian1D(1, 0, 1), -4, 4)
+    assert r4.inversecdf is not r1.inversecdf
+
+    # Closures are not cached
+    r5 = GeneralRandom(lambda x: np.exp(-0.5 * x ** 2), -5, 5)
+    r6 = GeneralRandom(lambda x: np.exp(-0.5 * x ** 2), -5, 5)
+    assert r5.inversecdf is not r6.inversecdf
+    assert_allclose(r5.inversecdf, r1.inversecdf)
+
+    # Radial pdf helper
+    r7 = GeneralRandom(pdf(Gaussian1D(1, 0, 1)), 0, 5)
+    r8 = GeneralRandom(pdf(Gaussian1D(1, 0, 1)), 0, 5)
+    assert r7.inversecdf is r8.inversecdf
+
+    x = draw(0, 5, 1000, _gauss, sigma=0.5)
+    assert x.max() < 3
+
+
+def _gauss(x, sigma):
+    return np.exp(-0.5 * (x / sigma) ** 2)
 
 
 @pytest.mark.xfail
@@ -1,6 +1,43 @@
 from __future__ import print_function, division
 import numpy as np
+from numpy.testing import assert_allclose, assert_equal
+from astropy.tests.helper import pytest
 from ....utils.distributions import GeneralRandomArray
+from ..general_random_array import _alias_table
+
+
+def test_alias_table():
+    random_state = np.random.RandomState(seed=0)
+    pdf = random_state.exponential(size=1000) ** 3
+    pdf[:10] = 0
+    prob, alias = _alias_table(pdf)
+    assert ((0 <= prob) & (prob <= 1)).all()
+
+    # Probability of each entry encoded in the table
+    n = len(pdf)
+    actual = prob + np.bincount(alias, weights=1 - prob, minlength=n)
+    assert_allclose(actual / n, pdf / pdf.sum(), atol=1e-12)
+
+
+@pytest.mark.parametrize('method', ['cdf', 'alias'])
+def test_general_random_array(method):
+    pdf = np.array([[1, 3, 0], [4, 2, 6]])
+    r = GeneralRandomArray(pdf, method=method)
+    indices = r.draw(1e5, random_state=0, chunk_size=30000)
+    assert indices.shape == (100000, 2)
+
+    counts = np.histogramdd(indices, bins=pdf.shape)[0]
+    expected = 1e5 * pdf / pdf.sum()
+    assert counts[0, 2] == 0
+    assert_allclose(counts, expected, atol=5 * np.sqrt(expected.max()))
+
+    flat = r.draw(1e5, return_flat_index=True, random_state=0, chunk_size=30000)
+    assert_equal(np.ravel_multi_index(indices.T, pdf.shape), flat)
+
+    chunks = list(r.iter_draw(1e5, return_flat_index=True, random_state=0,
+                              chunk_size=30000))
+    assert [len(_) for _ in chunks] == [30000, 30000, 30000, 10000]
+    assert_equal(np.concatenate(chunks), flat)
 
 
 def plot_simple_1d():
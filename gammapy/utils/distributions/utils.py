@@ -1,5 +1,6 @@
 """Helper functions to work with distributions."""
 from __future__ import print_function, division
+from functools import partial
 from ...utils.distributions import GeneralRandom
 
 __all__ = ['normalize', 'density', 'draw', 'pdf']
@@ -16,13 +17,16 @@ def normalize(func, x_min, x_max):
     return f
 
 
+def _pdf(x, func):
+    return x * func(x)
+
+
 def pdf(func):
     """Returns the one dimensional PDF of a given radial surface density.
     """
-    def f(x):
-        return x * func(x)
-
-    return f
+    # A partial (instead of a closure) lets `GeneralRandom`
+    # identify and cache the distribution
+    return partial(_pdf, func=func)
 
 
 def density(func):
@@ -35,10 +39,21 @@ def density(func):
 
 
 def draw(low, high, size, dist, *args, **kwargs):
-    """Allows drawing of random numbers from any distribution."""
-    def f(x):
-        return dist(x, *args, **kwargs)
+    """Allows drawing of random numbers from any distribution.
+
+    The keyword argument ``random_state`` is passed to
+    `~gammapy.utils.distributions.GeneralRandom.draw`,
+    all other arguments are passed to ``dist``.
+    """
+    random_state = kwargs.pop('random_state', 'random-seed')
+    if args:
+        def f(x):
+            return dist(x, *args, **kwargs)
+    elif kwargs:
+        f = partial(dist, **kwargs)
+    else:
+        f = dist
 
     d = GeneralRandom(f, low, high)
-    array = d.draw(size)
+    array = d.draw(size, random_state=random_state)
     return array
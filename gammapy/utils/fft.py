@@ -0,0 +1,305 @@
+# Licensed under a 3-clause BSD style license - see LICENSE.rst
+"""FFT convolution helpers with cached kernel transforms.
+"""
+from __future__ import print_function, division
+import numpy as np
+
+__all__ = ['FFTConvolver',
+           'fast_fft_length',
+           ]
+
+# Map `scipy.ndimage` boundary modes to the equivalent `numpy.pad` modes
+_PAD_MODES = dict(reflect='symmetric',
+                  mirror='reflect',
+                  nearest='edge',
+                  wrap='wrap',
+                  constant='constant')
+
+
+def fast_fft_length(n):
+    """Smallest 5-smooth integer (only prime factors 2, 3 and 5) ``>= n``.
+
+    FFTs of such lengths are fast for all common FFT implementations.
+
+    Parameters
+    ----------
+    n : int
+        Minimum length
+
+    Returns
+    -------
+    length : int
+        Fast FFT length
+    """
+    n = int(n)
+    if n <= 6:
+        return max(n, 1)
+
+    best = 2 ** int(np.ceil(np.log2(n)))
+    p5 = 1
+    while p5 < best:
+        p35 = p5
+        while p35 < best:
+            # Smallest power of two that brings p35 to >= n
+            quotient = -(-n // p35)
+            p2 = 2 ** int(np.ceil(np.log2(quotient)))
+            best = min(best, p2 * p35)
+            p35 *= 3
+        p5 *= 5
+    return best
+
+
+class FFTConvolver(object):
+    """Convolve same-shaped images with a fixed set of kernels.
+
+    The Fourier transforms of the kernels are computed once and cached,
+    and the transform of an image can be re-used for all kernels.
+    Results are identical (up to floating point round-off) to
+    `scipy.ndimage.convolve` with the same ``mode``, including the
+    pixel origin convention for even-shaped kernels.
+
+    Parameters
+    ----------
+    shape : tuple
+        Shape of the images that will be convolved.
+    kernels : `~numpy.ndarray` or list of `~numpy.ndarray`
+        Convolution kernel(s), must have the same number of dimensions
+        as the images.
+    mode : {'reflect', 'constant', 'nearest', 'mirror', 'wrap'}
+        Boundary handling, same meaning as for `scipy.ndimage.convolve`.
+        For ``'constant'`` the image is padded with zeros.
+    method : {'auto', 'fft', 'direct'}
+        Use FFT or direct (`scipy.ndimage.convolve`) convolution.
+        With ``'auto'`` kernels with few pixels compared to the
+        logarithm of the image size are convolved directly, which is
+        faster and avoids FFT round-off for them.
+
+    Examples
+    --------
+    >>> import numpy as np
+    >>> from gammapy.utils.fft import FFTConvolver
+    >>> image = np.random.random((100, 100))
+    >>> convolver = FFTConvolver(image.shape, [np.ones((3, 3)), np.ones((5, 5))])
+    >>> image_fft = convolver.transform(image)
+    >>> smooth_3 = convolver.convolve(image, index=0, image_fft=image_fft)
+    >>> smooth_5 = convolver.convolve(image, index=1, image_fft=image_fft)
+    """
+
+    def __init__(self, shape, kernels, mode='reflect', method='auto'):
+        if isinstance(kernels, np.ndarray):
+            kernels = [kernels]
+        if mode not in _PAD_MODES:
+            raise ValueError('Invalid mode: {0}'.format(mode))
+
+        self.shape = tuple(shape)
+        self.mode = mode
+        self.kernels = [np.asanyarray(_, dtype=float) for _ in kernels]
+
+        for kernel in self.kernels:
+            if kernel.ndim != len(self.shape):
+                raise ValueError('Kernel and image dimensions must match.')
+
+        # Kernel centers, using the `scipy.ndimage.convolve` convention
+        self._centers = [np.array(kernel.shape) // 2 for kernel in self.kernels]
+        kernel_shapes = np.array([kernel.shape for kernel in self.kernels])
+        centers = np.array(self._centers)
+        self._pad_lo = (kernel_shapes - 1 - centers).max(axis=0)
+        self._pad_hi = centers.max(axis=0)
+
+        padded_shape = np.array(self.shape) + self._pad_lo + self._pad_hi
+        self.padded_shape = tuple(padded_shape)
+        self.fft_shape = tuple(fast_fft_length(_) for _ in padded_shape)
+
+        self._kernel_ffts = [np.fft.rfftn(kernel, self.fft_shape)
+                             for kernel in self.kernels]
+
+        if method == 'auto':
+            max_size = 1.25 * np.log2(np.prod(self.fft_shape))
+            self.direct = [kernel.size <= max_size for kernel in self.kernels]
+        elif method in ['fft', 'direct']:
+            self.direct = [method == 'direct'] * self.n_kernels
+        else:
+            raise ValueError('Invalid method: {0}'.format(method))
+        self._footprint_ffts = dict()
+
+    @property
+    def n_kernels(self):
+        """Number of kernels (int)"""
+        return len(self.kernels)
+
+    def _pad(self, image):
+        """Pad image according to the boundary mode."""
+        image = np.asanyarray(image, dtype=float)
+        if image.shape != self.shape:
+            raise ValueError('Image shape {0} does not match convolver shape {1}'
+                             ''.format(image.shape, self.shape))
+        pad_width = list(zip(self._pad_lo, self._pad_hi))
+        return np.pad(image, pad_width, mode=_PAD_MODES[self.mode])
+
+    def _crop(self, index):
+        """Slices to crop the valid part of a padded convolution result."""
+        start = self._centers[index] + self._pad_lo
+        return tuple(slice(lo, lo + n) for lo, n in zip(start, self.shape))
+
+    def transform(self, image):
+        """Fourier transform of the padded image.
+
+        Compute this once and pass it as ``image_fft`` to `convolve`
+        to convolve the same image with several kernels.
+
+        Parameters
+        ----------
+        image : `~numpy.ndarray`
+            Image
+
+        Returns
+        -------
+        image_fft : `~numpy.ndarray`
+            Complex Fourier transform of the padded image.
+        """
+        return np.fft.rfftn(self._pad(image), self.fft_shape)
+
+    def convolve(self, image=None, index=0, image_fft=None, out=None,
+                 propagate_nan=False):
+        """Convolve image with one of the kernels.
+
+        Parameters
+        ----------
+        image : `~numpy.ndarray`, optional
+            Image (not needed if ``image_fft`` is given).
+        index : int
+            Kernel index
+        image_fft : `~numpy.ndarray`, optional
+            Cached transform of the image, as returned by `transform`.
+        out : `~numpy.ndarray`, optional
+            Output array the result is written to.
+        propagate_nan : bool
+            Set output pixels to NaN if a non-finite input pixel lies within
+            the non-zero part of the kernel, like `scipy.ndimage.convolve` does.
+            Non-finite values are treated as zero otherwise.
+            Requires ``image`` to be given.
+
+        Returns
+        -------
+        out : `~numpy.ndarray`
+            Convolved image
+        """
+        invalid = None
+        if image is not None:
+            image = np.asanyarray(image, dtype=float)
+            invalid = ~np.isfinite(image)
+            if invalid.any():
+                image = np.where(invalid, 0, image)
+                image_fft = None
+            else:
+                invalid = None
+
+        if self.direct[index] and image is not None:
+            from scipy.ndimage import convolve
+            result = convolve(image, self.kernels[index], mode=self.mode, cval=0)
+        else:
+            if image_fft is None:
+                image_fft = self.transform(image)
+            result = np.fft.irfftn(image_fft * self._kernel_ffts[index], self.fft_shape)
+            result = result[self._crop(index)]
+
+        if propagate_nan and invalid is not None:
+            footprint = self._footprint_fft(index)
+            invalid_fft = np.fft.rfftn(self._pad(invalid), self.fft_shape)
+            spread = np.fft.irfftn(invalid_fft * footprint, self.fft_shape)
+            result[spread[self._crop(index)] > 0.5] = np.nan
+
+        if out is None:
+            return result
+        out[...] = result
+        return out
+
+    def convolve_all(self, image=None, image_fft=None):
+        """Convolve image with all kernels, transforming it only once.
+
+        Parameters
+        ----------
+        image : `~numpy.ndarray`, optional
+            Image (not needed if ``image_fft`` is given).
+        image_fft : `~numpy.ndarray`, optional
+            Cached transform of the image, as returned by `transform`.
+
+        Returns
+        -------
+        out : `~numpy.ndarray`
+            Stacked convolved images, shape ``(n_kernels,) + shape``.
+        """
+        if image_fft is None:
+            image_fft = self.transform(image)
+
+        out = np.empty((self.n_kernels,) + self.shape)
+        for index in range(self.n_kernels):
+            self.convolve(index=index, image_fft=image_fft, out=out[index])
+        return out
+
+    def update(self, delta, out, index=0):
+        """Add the convolution of a sparse difference image to ``out``.
+
+        Because convolution is linear, a result can be updated for a change
+        of the input image by convolving only the difference.
+        If the non-zero part of the (padded) difference image is compact,
+        only its bounding box is convolved, otherwise the cached
+        kernel transform is used on the full image.
+
+        Parameters
+        ----------
+        delta : `~numpy.ndarray`
+            Difference image
+        out : `~numpy.ndarray`
+            Previous convolution result, updated in place.
+        index : int
+            Kernel index
+
+        Returns
+        -------
+        out : `~numpy.ndarray`
+            Updated convolution result
+        """
+        from scipy.signal import convolve
+
+        delta_padded = self._pad(delta)
+        nonzero = delta_padded != 0
+
+        bounds = []
+        for axis in range(nonzero.ndim):
+            other = tuple(_ for _ in range(nonzero.ndim) if _ != axis)
+            idx = np.flatnonzero(nonzero.any(axis=other))
+            if len(idx) == 0:
+                return out
+            bounds.append((idx[0], idx[-1] + 1))
+
+        box_size = np.prod([hi - lo for lo, hi in bounds])
+        if box_size > 0.25 * delta_padded.size:
+            out += self.convolve(delta, index=index)
+            return out
+
+        box = tuple(slice(lo, hi) for lo, hi in bounds)
+        method = 'direct' if self.direct[index] else 'auto'
+        part = convolve(delta_padded[box], self.kernels[index], mode='full', method=method)
+
+        # `part` starts at the padded coordinate of the box lower corner,
+        # shift it into output image coordinates and add the overlap.
+        offset = self._centers[index] + self._pad_lo
+        out_slices, part_slices = [], []
+        for (lo, _), n_out, n_part, off in zip(bounds, self.shape, part.shape, offset):
+            start = lo - off
+            out_lo, out_hi = max(start, 0), min(start + n_part, n_out)
+            if out_hi <= out_lo:
+                return out
+            out_slices.append(slice(out_lo, out_hi))
+            part_slices.append(slice(out_lo - start, out_hi - start))
+
+        out[tuple(out_slices)] += part[tuple(part_slices)]
+        return out
+
+    def _footprint_fft(self, index):
+        """Cached transform of the non-zero support of a kernel."""
+        if index not in self._footprint_ffts:
+            footprint = (self.kernels[index] != 0).astype(float)
+            self._footprint_ffts[index] = np.fft.rfftn(footprint, self.fft_shape)
+        return self._footprint_ffts[index]
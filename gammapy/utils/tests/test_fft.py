@@ -0,0 +1,58 @@
+# Licensed under a 3-clause BSD style license - see LICENSE.rst
+from __future__ import print_function, division
+import numpy as np
+from numpy.testing import assert_allclose, assert_equal
+from astropy.tests.helper import pytest
+from ..fft import FFTConvolver, fast_fft_length
+
+try:
+    import scipy
+    HAS_SCIPY = True
+except ImportError:
+    HAS_SCIPY = False
+
+
+def test_fast_fft_length():
+    lengths = [fast_fft_length(_) for _ in [1, 7, 11, 13, 17, 101, 1025]]
+    assert_equal(lengths, [1, 8, 12, 15, 18, 108, 1080])
+
+
+@pytest.mark.skipif('not HAS_SCIPY')
+@pytest.mark.parametrize('mode', ['reflect', 'constant', 'nearest', 'mirror', 'wrap'])
+@pytest.mark.parametrize('method', ['fft', 'direct'])
+def test_fft_convolver(mode, method):
+    from scipy.ndimage import convolve
+    random_state = np.random.RandomState(seed=0)
+    image = random_state.uniform(size=(37, 50))
+    # Include even-shaped kernels to check the pixel origin convention
+    kernels = [random_state.uniform(size=_) for _ in [(3, 3), (4, 6), (5, 2)]]
+
+    convolver = FFTConvolver(image.shape, kernels, mode=mode, method=method)
+    image_fft = convolver.transform(image)
+    stacked = convolver.convolve_all(image_fft=image_fft)
+
+    delta = np.zeros_like(image)
+    delta[2, 3], delta[20, 30] = 1.5, -2
+
+    for index, kernel in enumerate(kernels):
+        expected = convolve(image, kernel, mode=mode)
+        assert_allclose(convolver.convolve(image, index=index), expected)
+        assert_allclose(stacked[index], expected)
+
+        actual = convolver.update(delta, expected.copy(), index=index)
+        assert_allclose(actual, convolve(image + delta, kernel, mode=mode))
+
+
+@pytest.mark.skipif('not HAS_SCIPY')
+def test_fft_convolver_nan():
+    from scipy.ndimage import convolve
+    image = np.ones((20, 20))
+    image[10, 10] = np.nan
+    kernel = np.ones((3, 3))
+    kernel[0, 0] = 0
+
+    convolver = FFTConvolver(image.shape, kernel, method='fft')
+    actual = convolver.convolve(image, propagate_nan=True)
+    expected = convolve(image, kernel)
+    assert_equal(np.isnan(actual), np.isnan(expected))
+    assert_allclose(actual[0, 0], expected[0, 0])
@@ -1,10 +1,14 @@
 # Licensed under a 3-clause BSD style license - see LICENSE.rst
 from __future__ import (absolute_import, division, print_function,
                         unicode_literals)
+import numpy as np
+from numpy.testing import assert_allclose
 from astropy.coordinates import Angle
-from astropy.tests.helper import assert_quantity_allclose
+from astropy.tests.helper import assert_quantity_allclose, pytest
+from astropy.wcs import WCS
 from ...utils.wcs import (linear_wcs_to_arrays,
-                          linear_arrays_to_wcs)
+                          linear_arrays_to_wcs,
+                          WCSGeometryCache)
 
 
 def test_wcs_object():
@@ -18,3 +22,86 @@ def test_wcs_object():
     # test: reconstructed bins should match original bins
     assert_quantity_allclose(reco_bins_x, bins_x)
     assert_quantity_allclose(reco_bins_y, bins_y)
+
+
+def _make_header(proj='CAR', yref=0):
+    from astropy.io import fits
+    header = fits.Header()
+    header['NAXIS'] = 2
+    header['CTYPE1'] = 'GLON-' + proj
+    header['CTYPE2'] = 'GLAT-' + proj
+    header['CRPIX1'] = 20.5
+    header['CRPIX2'] = 10.5
+    header['CRVAL1'] = 0
+    header['CRVAL2'] = yref
+    header['CDELT1'] = -0.5
+    header['CDELT2'] = 0.5
+    return header
+
+
+@pytest.mark.parametrize(('proj', 'yref'), [('CAR', 0), ('CAR', 10), ('TAN', 10)])
+def test_geometry_cache_coordinates(proj, yref):
+    header = _make_header(proj, yref)
+    shape = (20, 40)
+    cache = WCSGeometryCache()
+    lon, lat = cache.coordinates(header, shape)
+
+    y, x = np.indices(shape)
+    lon_ref, lat_ref = WCS(header).wcs_pix2world(x, y, 0)
+    assert_allclose(lon, lon_ref)
+    assert_allclose(lat, lat_ref)
+    assert not lon.flags.writeable
+
+    # Second call returns the cached arrays
+    assert cache.coordinates(header, shape)[0] is lon
+    assert cache.coordinates(WCS(header), shape)[1] is not None
+
+    lon32, lat32 = cache.coordinates(header, shape, dtype='float32')
+    assert lon32.dtype == np.float32
+    assert_allclose(lat32, lat_ref, rtol=1e-6)
+
+    solid_angle = cache.solid_angle(header, shape)
+    desired = 0.25 * np.cos(np.radians(lat_ref)) * (np.pi / 180) ** 2
+    assert_allclose(solid_angle, desired)
+
+    vectors = cache.unit_vectors(header, shape)
+    assert vectors.shape == (3,) + shape
+    assert_allclose((vectors ** 2).sum(axis=0), 1)
+    assert_allclose(np.degrees(np.arcsin(vectors[2])), lat_ref, atol=1e-10)
+
+
+def test_geometry_cache_eviction():
+    shape = (20, 40)
+    nbytes = 2 * 8 * shape[0] * shape[1]
+    cache = WCSGeometryCache(max_bytes=2 * nbytes)
+    headers = [_make_header(yref=yref) for yref in [0, 1, 2]]
+    for header in headers:
+        cache.coordinates(header, shape)
+    assert cache.nbytes == 2 * nbytes
+
+    # The least recently used entry was evicted
+    lon = cache.coordinates(headers[2], shape)[0]
+    assert cache.coordinates(headers[2], shape)[0] is lon
+    cache.coordinates(headers[0], shape)
+    assert cache.nbytes == 2 * nbytes
+
+    cache.clear()
+    assert cache.nbytes == 0
+
+
+def test_geometry_cache_hit_no_wcs(monkeypatch):
+    header = _make_header()
+    shape = (20, 40)
+    cache = WCSGeometryCache()
+    cache.coordinates(header, shape)
+    cache.solid_angle(header, shape)
+    cache.unit_vectors(header, shape)
+
+    # Cache hits only compute the key, no WCS object is built
+    def fail(wcs):
+        raise AssertionError('WCS built on cache hit')
+
+    monkeypatch.setattr(WCSGeometryCache, '_as_wcs', staticmethod(fail))
+    cache.coordinates(header, shape)
+    cache.solid_angle(header, shape)
+    cache.unit_vectors(header, shape)
@@ -5,9 +5,13 @@ from __future__ import (absolute_import, division, print_function,
 
 __all__ = ['linear_wcs_to_arrays',
            'linear_arrays_to_wcs',
+           'WCSGeometryCache',
+           'geometry_cache',
            ]
 
+from collections import OrderedDict
 import numpy as np
+from astropy.io import fits
 from astropy.wcs import WCS
 from astropy.coordinates import Angle
 
@@ -131,3 +135,202 @@ def linear_arrays_to_wcs(name_x, name_y, bin_edges_x, bin_edges_y):
                    (bin_edges_y[0] + (wcs.wcs.crpix[1] - 0.5)*delta_y).to(unit_y).value]
 
     return wcs
+
+
+class WCSGeometryCache(object):
+    """Cache of coordinate images for WCS image geometries.
+
+    Coordinate, solid angle and unit vector images are computed once per
+    WCS header, image shape and dtype and stored, so that repeated calls for
+    the same geometry don't call `~astropy.wcs.WCS.wcs_pix2world` again.
+    Least recently used entries are evicted when the total memory of the
+    stored images exceeds ``max_bytes``.
+
+    For CAR projections with the reference point on the equator and no
+    rotation, longitude only depends on the x and latitude only on the
+    y pixel coordinate. For these only one row and one column are transformed.
+
+    Returned arrays are read-only views of the cached arrays,
+    make a copy before modifying them.
+
+    Parameters
+    ----------
+    max_bytes : int
+        Maximum memory used by the cached images.
+
+    Examples
+    --------
+    >>> from gammapy.image import make_header
+    >>> from gammapy.utils.wcs import geometry_cache
+    >>> header = make_header(nxpix=100, nypix=50)
+    >>> lon, lat = geometry_cache.coordinates(header, shape=(50, 100))
+    """
+
+    def __init__(self, max_bytes=2 ** 28):
+        self.max_bytes = max_bytes
+        self._cache = OrderedDict()
+        self._nbytes = 0
+
+    @property
+    def nbytes(self):
+        """Memory used by the cached images (int)"""
+        return self._nbytes
+
+    def clear(self):
+        """Remove all cached images."""
+        self._cache.clear()
+        self._nbytes = 0
+
+    @staticmethod
+    def _header_hash(wcs):
+        """Hash of a header or of the header of a WCS, used in the cache keys."""
+        from hashlib import sha1
+        if isinstance(wcs, fits.Header):
+            header = wcs.tostring()
+        else:
+            header = wcs.to_header_string()
+        return sha1(header.encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def _as_wcs(wcs):
+        """WCS object for a header or WCS (only needed on cache misses)."""
+        if isinstance(wcs, fits.Header):
+            return WCS(wcs)
+        return wcs
+
+    def _get(self, key):
+        value = self._cache.pop(key)
+        self._cache[key] = value
+        return value
+
+    def _put(self, key, arrays):
+        for array in arrays:
+            array.setflags(write=False)
+        nbytes = sum(_.nbytes for _ in arrays)
+        self._cache[key] = arrays
+        self._nbytes += nbytes
+        while self._nbytes > self.max_bytes and len(self._cache) > 1:
+            _, evicted = self._cache.popitem(last=False)
+            self._nbytes -= sum(_.nbytes for _ in evicted)
+        return arrays
+
+    @staticmethod
+    def _is_separable(wcs):
+        """Check if lon only depends on x and lat only on y."""
+        ctype = wcs.wcs.ctype
+        if not (ctype[0].endswith('-CAR') and ctype[1].endswith('-CAR')):
+            return False
+        pc = wcs.wcs.get_pc()
+        return pc[0, 1] == 0 and pc[1, 0] == 0 and wcs.wcs.crval[1] == 0
+
+    def coordinates(self, wcs, shape, dtype='float64'):
+        """Longitude and latitude images in degrees.
+
+        Longitudes are in the range returned by WCS, usually ``(0, 360)``.
+
+        Parameters
+        ----------
+        wcs : `~astropy.io.fits.Header` or `~astropy.wcs.WCS`
+            Image WCS (2-dim)
+        shape : tuple
+            Image shape
+        dtype : {'float32', 'float64'}
+            Data type of the images
+
+        Returns
+        -------
+        lon, lat : `~numpy.ndarray`
+            Coordinate images
+        """
+        return self._coordinates(wcs, self._header_hash(wcs), shape, dtype)
+
+    def _coordinates(self, wcs, header_hash, shape, dtype):
+        key = ('coordinates', header_hash, tuple(shape), np.dtype(dtype).str)
+        if key in self._cache:
+            return self._get(key)
+
+        wcs = self._as_wcs(wcs)
+        origin = 0  # convention for gammapy
+        ny, nx = shape
+        if self._is_separable(wcs):
+            x = np.arange(nx)
+            y = np.arange(ny)
+            lon_x = wcs.wcs_pix2world(x, np.zeros(nx), origin)[0]
+            lat_y = wcs.wcs_pix2world(np.zeros(ny), y, origin)[1]
+            lon = np.empty(shape, dtype=dtype)
+            lat = np.empty(shape, dtype=dtype)
+            lon[...] = lon_x
+            lat[...] = lat_y[:, np.newaxis]
+        else:
+            y, x = np.indices(shape, dtype='int32')
+            lon, lat = wcs.wcs_pix2world(x, y, origin)
+            lon = lon.astype(dtype, copy=False)
+            lat = lat.astype(dtype, copy=False)
+        return self._put(key, (lon, lat))
+
+    def solid_angle(self, wcs, shape, dtype='float64'):
+        """Solid angle image in steradian.
+
+        The pixel area at the equator is scaled with ``cos(lat)``,
+        which is only correct for CAR maps.
+
+        Parameters
+        ----------
+        wcs : `~astropy.io.fits.Header` or `~astropy.wcs.WCS`
+            Image WCS (2-dim)
+        shape : tuple
+            Image shape
+        dtype : {'float32', 'float64'}
+            Data type of the image
+
+        Returns
+        -------
+        solid_angle : `~numpy.ndarray`
+            Solid angle image
+        """
+        header_hash = self._header_hash(wcs)
+        key = ('solid_angle', header_hash, tuple(shape), np.dtype(dtype).str)
+        if key in self._cache:
+            return self._get(key)[0]
+
+        wcs = self._as_wcs(wcs)
+        # Pixel area at the equator, also correct for CD matrix headers
+        cdelt_pc = wcs.wcs.cdelt[:, np.newaxis] * wcs.wcs.get_pc()
+        equator_area = np.abs(np.linalg.det(cdelt_pc)) * (np.pi / 180) ** 2
+        lat = self._coordinates(wcs, header_hash, shape, 'float64')[1]
+        solid_angle = (equator_area * np.cos(np.radians(lat))).astype(dtype, copy=False)
+        return self._put(key, (solid_angle,))[0]
+
+    def unit_vectors(self, wcs, shape, dtype='float64'):
+        """Cartesian unit vector images of the pixel directions.
+
+        Parameters
+        ----------
+        wcs : `~astropy.io.fits.Header` or `~astropy.wcs.WCS`
+            Image WCS (2-dim)
+        shape : tuple
+            Image shape
+        dtype : {'float32', 'float64'}
+            Data type of the images
+
+        Returns
+        -------
+        unit_vectors : `~numpy.ndarray`
+            Array of shape ``(3,) + shape``
+        """
+        header_hash = self._header_hash(wcs)
+        key = ('unit_vectors', header_hash, tuple(shape), np.dtype(dtype).str)
+        if key in self._cache:
+            return self._get(key)[0]
+
+        lon, lat = self._coordinates(wcs, header_hash, shape, 'float64')
+        lon, lat = np.radians(lon), np.radians(lat)
+        vectors = np.empty((3,) + tuple(shape), dtype=dtype)
+        vectors[0] = np.cos(lat) * np.cos(lon)
+        vectors[1] = np.cos(lat) * np.sin(lon)
+        vectors[2] = np.sin(lat)
+        return self._put(key, (vectors,))[0]
+
+
+# Cache used by the gammapy image and cube classes and functions
+geometry_cache = WCSGeometryCache()